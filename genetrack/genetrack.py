@@ -7,7 +7,7 @@ By Pindi Albert, 2011
 
 Run with no arguments or -h for usage and command line options
 
-Input: either idx, bed or gff format. Format will be autodetected.
+Input: either idx, bed or gff format, or a binary index made by idxtobin.py. Format will be autodetected.
 
 Output: Called peaks in either gff
 
@@ -16,42 +16,142 @@ Output: Called peaks in either gff
 .bed format: 6 column bed with strand information
 """
 
-from optparse import OptionParser, IndentedHelpFormatter
-import csv, logging, numpy, math, bisect, sys, os, copy
+from optparse import OptionParser, IndentedHelpFormatter, Values
+import csv, logging, numpy, math, bisect, sys, os, copy, collections, multiprocessing, struct, itertools, hashlib
+import tempfile, shutil, atexit, contextlib, time, json, gzip, zlib, re, io
+from multiprocessing.pool import ThreadPool
+try:
+    import resource
+except ImportError: # Not available on Windows
+    resource = None
 
 logging.basicConfig(format='%(levelname)s:%(message)s')
 
 WIDTH = 100
+readsize = 0 # Length of the reads, set when the format of a file is detected
 
-def gff_row(cname, start, end, score, source, type='.', strand='.', phase='.', attrs={}):
-    global readsize
-    if strand != '+':
-        start += readsize
-        end += readsize
+# Kernels at least this long are convolved by FFT, in blocks of FFT_SIZE (direct is faster below).
+# FFT results are rounded to FFT_BITS significant bits relative to the largest value.
+FFT_MIN_KERNEL = 80
+FFT_SIZE = 2 ** 14
+FFT_BITS = 44
 
-    attrs['ID']= (start+end)/2
-    return (cname, source, type, start, end, score, strand, phase, gff_attrs(attrs))
+# Smoothed reads are held in arrays of ARRAY_DTYPE, or of the float dtype of another --precision, which
+# also keeps reads as rows of its integer dtype. --max-memory sizes chunks assuming a process takes
+# PROCESS_BYTES before loading reads, the parent another PARSE_BYTES to parse them, and a chunk two arrays
+# of its length plus SMOOTH_BYTES per base for the float64 temporaries of smoothing one strand, and
+# ROW_BYTES per read row for the rows, their copies and the peaks found among them (measured on sparse
+# and dense reads, sigmas 5 to 20).
+ARRAY_DTYPE = numpy.float
+PRECISIONS = {'double': (numpy.float64, numpy.int), 'single': (numpy.float32, numpy.int32)}
+PROCESS_BYTES = 32 * 2 ** 20
+PARSE_BYTES = 64 * 2 ** 20
+SMOOTH_BYTES = 24
+ROW_BYTES = 128
+
+# Text input is parsed in blocks of BLOCK_SIZE bytes, using these columns for each format
+BLOCK_SIZE = 2 ** 22
+BLOCK_COLUMNS = {'idx': (1, 2, 3), 'bed': (1, 5), 'gff': (3, 6)}
+
+# Binary indexes (see BinaryChromosomeManager) start with these bytes, reads take 3 int32 each
+BINARY_MAGIC = 'GTBIDX1\n'
+INDEX_EXTENSION = '.gti'
+SORT_MEMORY = 1024 # MB
+READ_BYTES = 12
+INT32_MAX = 2 ** 31 - 1
+
+# Text input may be compressed with gzip, or with BGZF (as bgzip writes it), whose blocks are decompressed
+# BGZF_BATCH at a time on DECOMPRESS_THREADS threads, ahead of the parser
+GZIP_MAGIC = '\x1f\x8b'
+COMPRESSED_EXTENSIONS = ('.gz', '.bgz')
+DECOMPRESS_THREADS = 4
+BGZF_BATCH = 64
+
+# Peaks are called into tables of this type, one per strand, which are filtered and passed to the writer
+PEAK_DTYPE = [('index', int), ('start', int), ('end', int), ('value', numpy.float), ('height', numpy.float),
+              ('readcount', int), ('stddev', numpy.float)]
+
+# Output lines of each format. The gff attributes are in the order gff_attrs used to give them.
+OUTPUT_LINES = {
+    'gff': '%s\tgenetrack\t.\t%d\t%d\t%s\t%s\t.\treadcount=%d;ID=%d;stddev=%s;height=%s\n',
+    'txt': '%s\t%s\t%d\t%d\t%s\n',
+    'bed': '%s\t%d\t%d\tpeak\t%s\t%s\n',
+}
+OUTPUT_BUFFER = 2 ** 20
+
+# Settings call_peaks_array uses when they are not given, the defaults of the command line
+PEAK_SETTINGS = {'sigma': 5, 'exclusion': 20, 'up_width': 0, 'down_width': 0, 'filter': 3, 'precision': 'double'}
+
+# Tracks are runs of bases with the same (quantized) smoothed value, passed to the track writers as tables of
+# this type. Binary tracks store them, and their summaries at each zoom level, as records of TRACK_RECORD.
+TRACK_DTYPE = [('start', int), ('end', int), ('value', numpy.float)]
+TRACK_RECORD = [('start', '<i4'), ('end', '<i4'), ('mean', '<f4'), ('max', '<f4')]
+TRACK_MAGIC = 'GTTRACK1\n'
+ZOOM_SIZES = (100, 1000, 10000, 100000)
+HASH_BLOCK = 2 ** 20
+INTEGER = re.compile(r'[ \r\f\v]*[-+]?\d+[ \r\f\v]*$') # What int() reads within a tab separated field
+
+ZOOM_DTYPE = [('bin', int), ('start', int), ('end', int), ('sum', numpy.float), ('covered', int), ('max', numpy.float)]
 
-def gff_attrs(d):
-    if not d:
-        return '.'
-    return ';'.join('%s=%s' % item for item in d.items())
 
 class InvalidFileError(Exception):
     pass
 
-class Peak(object):
-    def __init__(self, index, pos_width, neg_width, height):
-        self.index = index
-        self.start = index - neg_width
-        self.end = index + pos_width
-        self.value = 0
-        self.readcount = 0
-        self.height = height
-        self.deleted = False
-        self.safe = False
-    def __repr__(self):
-        return '[%d] %d' % (self.index, self.value)
+def cpu_time():
+    ''' Returns the user and system CPU time of this process '''
+    times = os.times()
+    return times[0] + times[1]
+
+def peak_rss():
+    ''' Returns the largest resident set size of this process so far, in bytes, or None if unknown '''
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 # Kilobytes on Linux
+
+class StageTimer(object):
+    ''' Accumulates the wall and CPU time spent in named stages of processing a chunk,
+    together with other facts about it. Used as "with timer('stage'):". '''
+    def __init__(self, **facts):
+        self.stages = collections.OrderedDict()
+        self.facts = collections.OrderedDict(sorted(facts.items()))
+    
+    @contextlib.contextmanager
+    def __call__(self, name):
+        wall, cpu = time.time(), cpu_time()
+        try:
+            yield
+        finally:
+            stage = self.stages.setdefault(name, {'wall': 0.0, 'cpu': 0.0})
+            stage['wall'] += time.time() - wall
+            stage['cpu'] += cpu_time() - cpu
+    
+    def count(self, name, value):
+        ''' Adds value to a fact '''
+        self.facts[name] = self.facts.get(name, 0) + value
+    
+    def note(self, name, value):
+        ''' Sets a fact '''
+        self.facts[name] = value
+    
+    def report(self):
+        report = collections.OrderedDict(self.facts)
+        report['stages'] = self.stages
+        return report
+
+class NullTimer(object):
+    ''' Stands in for a StageTimer when no statistics are kept '''
+    def __call__(self, name):
+        return self
+    def __enter__(self):
+        pass
+    def __exit__(self, *args):
+        pass
+    def count(self, name, value):
+        pass
+    def note(self, name, value):
+        pass
+
+NO_TIMER = NullTimer()
 
 def is_int(i):
     try:
@@ -63,6 +163,8 @@ def is_int(i):
         
 class ChromosomeManager(object):
     ''' Manages a CSV reader of an index file to only load one chrom at a time '''
+    index = None # Managers that can seek_chromosome have an index of the chromosomes in the file
+    
     def __init__(self, reader):
         self.done = False
         self.reader = reader
@@ -170,7 +272,7 @@ class ChromosomeManager(object):
                 break
         self.processed_chromosomes.append(cname)
         self.current_index = 0
-        data = self.data
+        data = numpy.array(self.data, int).reshape(-1, 3)
         del self.data # Don't retain reference anymore to save memory
         return data
     
@@ -211,50 +313,1025 @@ class ChromosomeManager(object):
         ''' Skip the current chromosome, discarding data '''
         self.load_chromosome(collect_data=False)
     
+    def read_blocks(self):
+        ''' Generates the reads of the current chromosome in blocks, here a single one '''
+        yield self.load_chromosome()
+    
             
-def make_keys(data):
-    return [read[0] for read in data]
+class BlockChromosomeManager(ChromosomeManager):
+    ''' Manages a file like ChromosomeManager, but parses it in blocks of about block_size
+    bytes. Each block is split in one go and its columns are converted with numpy. BED and
+    GFF reads are summed per index in bulk rather than one read at a time.
+    
+    Given the chromosome index of the file (see get_chromosome_index), it can seek to any
+    chromosome. With offsets set, it records the byte offset at which each chromosome
+    starts in offsets, as (name, offset) pairs; the file must then be seekable. '''
+    def __init__(self, f, block_size=BLOCK_SIZE, index=None, offsets=False):
+        self.file = f
+        self.block_size = block_size
+        self.index = index
+        self.offsets = [] if offsets else None
+        self.done = False
+        self.processed_chromosomes = []
+        self.segments = collections.deque()
+        self.next_valid()
     
-def make_peak_keys(peaks):
-    return [peak.index for peak in peaks]
+    def next_valid(self):
+        ''' Advance to the first valid line and parse the block that starts with it '''
+        s = 0
+        for line in iter(self.file.readline, ''):
+            fields = line.rstrip('\r\n').split('\t')
+            if self.is_valid(fields):
+                self.columns = [0] + list(BLOCK_COLUMNS[self.format])
+                self.width = len(fields)
+                self.read_block(line)
+                break
+            s += 1
+        else:
+            name = getattr(self.file, 'name', None) # Standard input is named by its descriptor
+            logging.error('%s has no valid line' % ('"%s"' % name if isinstance(name, basestring) else 'Standard input'))
+            raise InvalidFileError
+        if s > 0:
+            logging.info('Skipped initial %d line(s) of file' % s)
+    
+    def read_block(self, text=''):
+        ''' Parse the next block of the file into (chromosome name, reads) segments.
+        Returns False at the end of the file. '''
+        if self.offsets is not None:
+            position = self.file.tell() - len(text)
+        text += self.file.read(self.block_size)
+        text += self.file.readline() # Complete the last line
+        raw = text
+        if '\r' in text:
+            text = text.replace('\r', '')
+        if not text or text.isspace():
+            return False
+        if not text.endswith('\n'):
+            text += '\n'
+        segments = self.parse_block(text)
+        if segments is None:
+            segments = self.parse_lines(text)
+        self.segments.extend(segments)
+        if self.offsets is not None:
+            self.find_offsets(raw, position, segments)
+        return True
+    
+    def find_offsets(self, text, position, segments):
+        ''' Records the offsets of the chromosomes starting in a block of text read from
+        the position in the file '''
+        at = 0
+        for name, reads in segments:
+            if self.offsets and self.offsets[-1][0] == name:
+                continue
+            if not (at == 0 and text.startswith(name + '\t')):
+                at = text.find('\n' + name + '\t', at) + 1
+            self.offsets.append((name, position + at))
+    
+    def parse_block(self, text):
+        ''' Parses a block of lines without splitting it into strings: the tabs and line ends
+        are located in the raw bytes and each column is converted for all lines at once.
+        Returns the (chromosome name, reads) segments of the block, or None if its lines have
+        uneven numbers of fields or unexpected values, leaving it to parse_lines. '''
+        buf = numpy.frombuffer(text, numpy.uint8)
+        ends = numpy.flatnonzero(buf == ord('\n'))
+        tabs = numpy.flatnonzero(buf == ord('\t'))
+        lines = len(ends)
+        if len(tabs) != lines * (self.width - 1):
+            return None
+        tabs = tabs.reshape(lines, self.width - 1)
+        starts = numpy.concatenate(([0], ends[:-1] + 1))
+        if (tabs[:, 0] < starts).any() or (tabs[:, -1] > ends).any():
+            return None
+        
+        def field(column):
+            # Offsets of the first character and the end of a column on every line
+            begin = starts if column == 0 else tabs[:, column - 1] + 1
+            end = ends if column == self.width - 1 else tabs[:, column]
+            return begin, end
+        
+        if self.format == 'idx':
+            columns = [parse_digits(buf, *field(column)) for column in self.columns[1:]]
+            if any(column is None for column in columns):
+                return None
+            reads = numpy.column_stack(columns)
+        else:
+            index = parse_digits(buf, *field(self.columns[1]))
+            begin, end = field(self.columns[2])
+            if index is None or (end - begin != 1).any():
+                return None
+            forward = buf[begin] == ord('+')
+            reverse = buf[begin] == ord('-')
+            if not (forward | reverse).all():
+                return None
+            if self.format == 'bed':
+                index += 1 # turn it into one based interval
+            reads = numpy.column_stack((index, forward, reverse))
+        
+        begin, end = field(0)
+        return self.split_block(text, buf, begin, end, reads)
+    
+    def split_block(self, text, buf, begin, end, reads):
+        ''' Splits the reads of a block into (chromosome name, reads) segments, given the
+        offsets of the chromosome name of each line in the text of the block '''
+        bounds = [0] + list(find_changes(buf, begin, end)) + [len(reads)]
+        return [(text[begin[a]:end[a]], reads[a:b]) for a, b in zip(bounds[:-1], bounds[1:])]
+    
+    def parse_lines(self, text):
+        ''' Parses a block of lines one by one. Slower than parse_block, but copes with uneven
+        lines and reports invalid values. Returns the (chromosome name, reads) segments. '''
+        rows = [line.split('\t') for line in text.split('\n') if line.strip()]
+        try:
+            columns = [[row[column] for row in rows] for column in self.columns]
+        except IndexError:
+            logging.error('File has lines with too few columns')
+            raise InvalidFileError
+        
+        names = columns[0]
+        if self.format == 'idx':
+            reads = numpy.column_stack([parse_column(column, rows) for column in columns[1:]])
+        else:
+            index = parse_column(columns[1], rows)
+            strands = numpy.array(columns[2])
+            forward = strands == '+'
+            reverse = strands == '-'
+            if not (forward | reverse).all():
+                i = numpy.flatnonzero(~(forward | reverse))[0]
+                logging.error('Strand "%s" at chromosome "%s" index %d is not valid.' % (strands[i], names[i], index[i]))
+                raise InvalidFileError
+            if self.format == 'bed':
+                index += 1 # turn it into one based interval
+            reads = numpy.column_stack((index, forward, reverse))
+        
+        return self.split_lines(names, reads)
+    
+    def split_lines(self, names, reads):
+        ''' Splits the reads of a block into (chromosome name, reads) segments, given the
+        chromosome name of each line '''
+        segments, start = [], 0
+        for name, group in itertools.groupby(names):
+            end = start + sum(1 for _ in group)
+            segments.append((name, reads[start:end]))
+            start = end
+        return segments
+        
+    def chromosome_name(self):
+        ''' Return the name of the chromosome about to be loaded '''
+        return self.segments[0][0]
+    
+    def read_blocks(self):
+        ''' Generates the reads of the current chromosome one block at a time, each an
+        (index, forward, reverse) array sorted by index. BED and GFF reads are summed per
+        index within a block, an index may continue at the start of the next block. '''
+        cname = self.chromosome_name()
+        if cname in self.processed_chromosomes:
+            logging.error('File is not grouped by chromosome')
+            raise InvalidFileError
+        self.processed_chromosomes.append(cname)
+        current_index = 0
+        while self.segments[0][0] == cname:
+            reads = self.segments.popleft()[1]
+            unsorted = numpy.flatnonzero(numpy.diff(reads[:, 0]) < 0)
+            if reads[0, 0] < current_index or len(unsorted):
+                if reads[0, 0] >= current_index:
+                    current_index = reads[unsorted[0], 0]
+                logging.error('Reads in chromosome %s are not sorted by index. (At index %d)' % (cname, current_index))
+                raise InvalidFileError
+            current_index = reads[-1, 0]
+            yield reads if self.format == 'idx' else sum_reads(reads)
+            if not self.segments and not self.read_block():
+                self.done = True
+                break
+    
+    def seek_chromosome(self, cname):
+        ''' Moves to the start of a chromosome. Returns False if it is not in the file. '''
+        if cname not in self.index:
+            return False
+        self.file.seek(self.index[cname][0])
+        self.segments.clear()
+        self.done = not self.read_block()
+        if cname in self.processed_chromosomes:
+            self.processed_chromosomes.remove(cname)
+        return not self.done
+    
+    def load_chromosome(self, collect_data=True):
+        ''' Load the current chromosome into an array and return it '''
+        blocks = [reads for reads in self.read_blocks() if collect_data]
+        if not collect_data:
+            return
+        data = numpy.concatenate(blocks)
+        if self.format != 'idx':
+            data = sum_reads(data) # Join indexes split between blocks
+        return data
+
+def parse_column(values, rows):
+    ''' Converts a list of integer strings, a column of the split lines in rows, to an array.
+    Every value is checked first, as numpy.fromstring reads '2.5' or '2x' as 2 when last. '''
+    for i, value in enumerate(values):
+        if not INTEGER.match(value):
+            logging.error('Could not read "%s" as an integer in line "%s"' % (value.strip(), '\t'.join(rows[i]).strip()))
+            raise InvalidFileError
+    return numpy.fromstring('\t'.join(values), dtype=int, sep='\t')
+
+def parse_digits(buf, begin, end):
+    ''' Reads the integers held in buf[begin:end] for every pair of offsets, one digit place
+    at a time for all of them together. Returns None if any is not a plain integer. '''
+    lengths = end - begin
+    if not len(lengths) or lengths.min() < 1 or lengths.max() > 18:
+        return None
+    values = numpy.zeros(len(lengths), int)
+    for place in range(lengths.max()):
+        digits = buf.take(end - 1 - place) - ord('0') # Wraps around below '0'
+        digits[place >= lengths] = 0
+        if (digits > 9).any():
+            return None
+        values += digits.astype(int) * 10 ** place
+    return values
 
+def find_changes(buf, begin, end):
+    ''' Returns the positions at which the string held in buf[begin:end] differs from the one
+    before it, comparing all of them one character at a time '''
+    lengths = end - begin
+    changed = lengths[1:] != lengths[:-1]
+    for place in range(lengths.max()):
+        chars = numpy.where(place < lengths, buf.take(numpy.minimum(begin + place, len(buf) - 1)), 0)
+        changed |= chars[1:] != chars[:-1]
+    return numpy.flatnonzero(changed) + 1
+
+def sum_reads(reads):
+    ''' Sums the forward and reverse counts of reads at the same index. The reads must be
+    sorted by index. '''
+    starts = numpy.flatnonzero(numpy.diff(reads[:, 0])) + 1
+    starts = numpy.concatenate(([0], starts))
+    summed = numpy.add.reduceat(reads, starts)
+    summed[:, 0] = reads[starts, 0]
+    return summed
+
+class BinaryChromosomeManager(object):
+    ''' Manages a binary index written by idxtobin.py. Works like ChromosomeManager, but each
+    chromosome is loaded as a view into a memory map of the file, so nothing is parsed.
+
+    The file holds the BINARY_MAGIC bytes, then the reads of each chromosome as little endian
+    int32 (index, forward, reverse) rows, then a tab separated table and, in its last 8 bytes,
+    the byte offset of that table as a little endian int64. The table has a readsize and a
+    format line followed by a name, byte offset, read count, lowest and highest index line
+    for each chromosome. '''
+    def __init__(self, path):
+        global readsize
+        f = open(path, 'rb')
+        f.seek(-8, os.SEEK_END)
+        table_offset, = struct.unpack('<q', f.read(8))
+        f.seek(table_offset)
+        table = [line.split('\t') for line in f.read()[:-8].splitlines()]
+        f.close()
+        
+        readsize = int(table[0][1])
+        self.format = table[1][1]
+        self.chromosomes = [(name, int(offset), int(count), int(lo), int(hi)) for name, offset, count, lo, hi in table[2:]]
+        rows = (table_offset - len(BINARY_MAGIC)) // READ_BYTES
+        if rows:
+            self.reads = numpy.memmap(path, '<i4', 'r', len(BINARY_MAGIC), (rows, 3))
+        self.index = collections.OrderedDict((chromosome[0], i) for i, chromosome in enumerate(self.chromosomes))
+        self.current = 0
+        self.done = not self.chromosomes
+        logging.debug('Binary index of %d chromosome(s) in %s format' % (len(self.chromosomes), self.format))
+        
+    def chromosome_name(self):
+        ''' Return the name of the chromosome about to be loaded '''
+        return self.chromosomes[self.current][0]
+        
+    def load_chromosome(self):
+        ''' Return a view of the current chromosome's reads and move on to the next '''
+        name, offset, count, lo, hi = self.chromosomes[self.current]
+        start = (offset - len(BINARY_MAGIC)) // READ_BYTES
+        self.current += 1
+        self.done = self.current == len(self.chromosomes)
+        return self.reads[start:start + count]
+    
+    def skip_chromosome(self):
+        ''' Skip the current chromosome '''
+        self.load_chromosome()
+    
+    def seek_chromosome(self, cname):
+        ''' Moves to a chromosome. Returns False if it is not in the file. '''
+        if cname not in self.index:
+            return False
+        self.current = self.index[cname]
+        self.done = False
+        return True
+    
+    def read_blocks(self):
+        ''' Generates the reads of the current chromosome in blocks, here a single view '''
+        yield self.load_chromosome()
+
+def write_binary_index(manager, f):
+    '''
+    Writes the reads of all chromosomes of a manager to an open file, in
+    the binary index format read by BinaryChromosomeManager. Raises
+    InvalidFileError if the reads do not fit in it.
+    '''
+    f.write(BINARY_MAGIC)
+    table = []
+    while not manager.done:
+        cname = manager.chromosome_name()
+        logging.info('Processing chromosome %s' % cname)
+        data = manager.load_chromosome()
+        if not len(data):
+            continue
+        if data.min() < 0 or data.max() > INT32_MAX:
+            logging.error('Reads in chromosome %s do not fit the binary index' % cname)
+            raise InvalidFileError
+        table.append((cname, f.tell(), len(data), data[0][0], data[-1][0]))
+        f.write(data.astype('<i4').tostring())
+    
+    table_offset = f.tell()
+    f.write('readsize\t%d\n' % readsize)
+    f.write('format\t%s\n' % manager.format)
+    for row in table:
+        f.write('%s\t%d\t%d\t%d\t%d\n' % row)
+    f.write(struct.pack('<q', table_offset))
+
+class UnsortedChromosomeManager(BlockChromosomeManager):
+    '''
+    Manages a file whose reads are in any order. The whole file is parsed
+    up front, in blocks like BlockChromosomeManager, and the reads of each
+    block are partitioned by chromosome in bulk. BED and GFF reads are kept as one int64 per
+    read (index * 2 + 1 for reverse reads), idx reads as their rows. Once
+    the partitions take more than memory bytes, they are appended to a
+    temporary file per chromosome. Chromosomes are loaded in order of their
+    names, each sorted with numpy when it is loaded, so only one is held
+    sorted at a time.
+    '''
+    def __init__(self, f, memory=SORT_MEMORY * 2 ** 20):
+        self.memory = memory
+        self.directory = None
+        self.partitions = collections.OrderedDict()
+        self.spilled = {} # Temporary file of each chromosome written out
+        self.size = 0
+        
+        BlockChromosomeManager.__init__(self, f)
+        while not self.done:
+            while self.segments:
+                self.add(*self.segments.popleft())
+            self.done = not self.read_block()
+        if self.spilled:
+            self.spill()
+        
+        self.names = sorted(self.partitions)
+        self.index = collections.OrderedDict((name, i) for i, name in enumerate(self.names))
+        self.current = 0
+        self.done = not self.names
+        logging.debug('Partitioned %d chromosome(s) in %s format' % (len(self.names), self.format))
+    
+    def split_block(self, text, buf, begin, end, reads):
+        ''' Splits the reads of a block by chromosome name, in any order '''
+        lengths = end - begin
+        width = lengths.max()
+        chars = buf.take(numpy.minimum(begin[:, None] + numpy.arange(width), len(buf) - 1))
+        chars[numpy.arange(width) >= lengths[:, None]] = 0
+        return self.split_lines(chars.view('S%d' % width).ravel(), reads)
+    
+    def split_lines(self, names, reads):
+        ''' Splits the reads of a block by chromosome name, in any order '''
+        names, inverse = numpy.unique(names, return_inverse=True)
+        order = numpy.argsort(inverse, kind='mergesort')
+        bounds = numpy.searchsorted(inverse[order], numpy.arange(len(names) + 1))
+        return [(str(name), reads[order[a:b]]) for name, a, b in zip(names, bounds[:-1], bounds[1:])]
+    
+    def add(self, name, reads):
+        ''' Adds a segment of reads to the partition of its chromosome '''
+        if self.format != 'idx':
+            reads = reads[:, 0] * 2 + reads[:, 2]
+        self.partitions.setdefault(name, []).append(reads)
+        self.size += reads.nbytes
+        if self.size > self.memory:
+            self.spill()
+    
+    def spill(self):
+        ''' Appends the partitions held in memory to their temporary files '''
+        if self.directory is None:
+            self.directory = tempfile.mkdtemp(prefix='genetrack')
+            atexit.register(self.close)
+        logging.debug('Spilling %d MB of reads to %s' % (self.size // 2 ** 20, self.directory))
+        for name, parts in self.partitions.items():
+            if not parts:
+                continue
+            path = self.spilled.setdefault(name, os.path.join(self.directory, '%d.reads' % len(self.spilled)))
+            f = open(path, 'ab')
+            for reads in parts:
+                f.write(reads.tostring())
+            f.close()
+            del parts[:]
+        self.size = 0
+    
+    def chromosome_name(self):
+        ''' Return the name of the chromosome about to be loaded '''
+        return self.names[self.current]
+    
+    def load_chromosome(self, collect_data=True):
+        ''' Load the current chromosome, sorted by index, and move on to the next '''
+        name = self.chromosome_name()
+        self.current += 1
+        self.done = self.current == len(self.names)
+        if not collect_data:
+            return
+        parts = self.partitions[name]
+        if name in self.spilled:
+            parts = [numpy.fromfile(self.spilled[name], int)]
+        if self.format == 'idx':
+            data = numpy.concatenate(parts).reshape(-1, 3)
+            data = data[numpy.argsort(data[:, 0], kind='mergesort')]
+        else:
+            keys = numpy.sort(numpy.concatenate(parts))
+            data = sum_reads(numpy.column_stack((keys >> 1, 1 - (keys & 1), keys & 1)))
+        return data
+    
+    def skip_chromosome(self):
+        ''' Skip the current chromosome '''
+        self.load_chromosome(collect_data=False)
+    
+    def seek_chromosome(self, cname):
+        ''' Moves to a chromosome. Returns False if it is not in the file. '''
+        if cname not in self.index:
+            return False
+        self.current = self.index[cname]
+        self.done = False
+        return True
+    
+    def read_blocks(self):
+        ''' Generates the reads of the current chromosome in blocks, here a single one '''
+        yield self.load_chromosome()
+    
+    def close(self):
+        ''' Removes the temporary files '''
+        if self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+class MergedChromosomeManager(object):
+    '''
+    Manages several inputs, such as replicates, as one. Each is read by
+    its own manager and streams its chromosomes in the order it lists
+    them, which the inputs must share, although each may lack some
+    chromosomes. The chromosome to load next is the first of those the
+    inputs are at, by name as sort and --unsorted order them or, where
+    the inputs listed so far rule that out, by name with its numbers
+    compared as numbers (chr2 before chr10). An input then listing a
+    chromosome already loaded is an error, so a wrong guess of the
+    order never pools a chromosome from only some of the inputs.
+    Inputs with an index (when indexed, unsorted or binary) instead
+    seek to each chromosome, and add theirs once the streamed inputs
+    are done. The reads of a chromosome are merged from the inputs that
+    have it a block at a time, summing the reads at the same index.
+    '''
+    ORDER_KEYS = (lambda cname: cname,
+                  lambda cname: [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', cname)])
+    
+    def __init__(self, paths, indexed=False, unsorted=False, memory=SORT_MEMORY * 2 ** 20):
+        global readsize
+        self.managers = []
+        sizes = []
+        for path in paths:
+            self.managers.append(get_manager(path, indexed, unsorted, memory // len(paths)))
+            sizes.append(readsize)
+        if len(set(sizes)) > 1:
+            logging.warning('Inputs have reads of different sizes (%s), using %d' % (', '.join(map(str, sizes)), sizes[0]))
+        readsize = sizes[0]
+        self.streams = [manager for manager in self.managers if manager.index is None]
+        self.indexed = [manager for manager in self.managers if manager.index is not None]
+        # The chromosomes each streamed input has listed, to tell the order they share
+        self.listed = dict((id(manager), []) for manager in self.streams)
+        self.index = None
+        if not self.streams:
+            self.index = collections.OrderedDict()
+            for manager in self.managers:
+                for cname in manager.index:
+                    self.index.setdefault(cname, None)
+        self.processed_chromosomes = set()
+        self.name = None
+    
+    @property
+    def done(self):
+        return (all(manager.done for manager in self.streams) and
+            all(cname in self.processed_chromosomes for manager in self.indexed for cname in manager.index))
+    
+    def chromosome_name(self):
+        ''' Return the name of the chromosome about to be loaded '''
+        if self.name is None:
+            streams = [manager for manager in self.streams if not manager.done]
+            self.name = self.next_streamed(streams) if streams else self.next_indexed()
+            self.selected = [manager for manager in streams if manager.chromosome_name() == self.name]
+            for manager in self.indexed:
+                if self.name in manager.index:
+                    if manager.done or manager.chromosome_name() != self.name:
+                        manager.seek_chromosome(self.name)
+                    self.selected.append(manager)
+        return self.name
+    
+    def next_streamed(self, streams):
+        ''' Returns the first chromosome the streamed inputs are at, in the first order all
+        they have listed so far fits '''
+        names = set(manager.chromosome_name() for manager in streams)
+        if names & self.processed_chromosomes:
+            logging.error('Inputs list chromosome %s twice or in different orders, use --index to pool them' % ', '.join(sorted(names & self.processed_chromosomes)))
+            raise InvalidFileError
+        if len(names) == 1:
+            return names.pop()
+        for key in self.ORDER_KEYS:
+            if all(in_order(self.listed[id(manager)] + [manager.chromosome_name()], key) for manager in streams):
+                return min(names, key=key)
+        logging.error('Inputs list their chromosomes in different orders (they are at %s), use --index to pool them' % ', '.join(sorted(names)))
+        raise InvalidFileError
+    
+    def next_indexed(self):
+        ''' Returns the next chromosome not yet loaded of the indexed inputs, preferring the
+        one an input is at so that it reads on without seeking '''
+        for manager in self.indexed:
+            if not manager.done and manager.chromosome_name() not in self.processed_chromosomes:
+                return manager.chromosome_name()
+            for cname in manager.index:
+                if cname not in self.processed_chromosomes:
+                    return cname
+    
+    def process(self):
+        ''' Marks the current chromosome processed, returning the managers that have it '''
+        cname = self.chromosome_name()
+        self.processed_chromosomes.add(cname)
+        for manager in self.selected:
+            if manager.index is None:
+                self.listed[id(manager)].append(cname)
+        self.name = None
+        return self.selected
+    
+    def read_blocks(self):
+        ''' Generates the merged reads of the current chromosome a block at a time '''
+        cname = self.chromosome_name()
+        if cname in self.processed_chromosomes:
+            logging.error('Input lists chromosome %s twice' % cname)
+            raise InvalidFileError
+        return merge_blocks([manager.read_blocks() for manager in self.process()])
+    
+    def load_chromosome(self):
+        ''' Load the current chromosome into an array and return it '''
+        return numpy.concatenate(list(self.read_blocks()) or [numpy.zeros((0, 3), int)])
+    
+    def skip_chromosome(self):
+        ''' Skip the current chromosome, discarding data '''
+        for manager in self.process():
+            manager.skip_chromosome()
+    
+    def seek_chromosome(self, cname):
+        ''' Moves to a chromosome. Returns False if no input has it. '''
+        self.selected = [manager for manager in self.managers if manager.seek_chromosome(cname)]
+        self.name = cname if self.selected else None
+        self.processed_chromosomes.discard(cname)
+        return bool(self.selected)
+
+def in_order(names, key):
+    ''' Returns True if the names are strictly increasing by key '''
+    keys = [key(name) for name in names]
+    return all(a < b for a, b in zip(keys, keys[1:]))
+
+def merge_blocks(streams):
+    ''' Merges streams of blocks of reads sorted by index, such as those generated by
+    read_blocks, into one. Each merged block holds the reads below the lowest last index of
+    the blocks at hand, as only reads at or after it may follow, with the reads at the same
+    index summed. '''
+    streams = [iter(stream) for stream in streams]
+    buffers = [numpy.zeros((0, 3), int) for stream in streams]
+    def refill(i):
+        ''' Appends the next block of a stream to its buffer, returning False at its end '''
+        for reads in streams[i]:
+            if len(reads):
+                buffers[i] = numpy.concatenate((buffers[i], reads))
+                return True
+        return False
+    
+    active = [i for i in range(len(streams)) if refill(i)]
+    while True:
+        # Streams that have ended leave the rest of their buffer to be merged as the bound passes it
+        bound = min(buffers[i][-1, 0] for i in active) if active else None
+        parts = []
+        for i, reads in enumerate(buffers):
+            cut = len(reads) if bound is None else numpy.searchsorted(reads[:, 0], bound)
+            parts.append(reads[:cut])
+            buffers[i] = reads[cut:]
+        reads = numpy.concatenate(parts)
+        if len(reads):
+            yield sum_reads(reads[numpy.argsort(reads[:, 0], kind='mergesort')])
+        if bound is None:
+            return
+        active = [i for i in active if buffers[i][-1, 0] != bound or refill(i)]
+
+class InflatingReader(object):
+    ''' Reads decompressed text a batch at a time, as more adds it to the buffer '''
+    buffer = ''
+    
+    def more(self):
+        ''' Adds the next batch of text to the buffer. Returns False at the end. '''
+        return False
+    
+    def read(self, size=-1):
+        while (size < 0 or len(self.buffer) < size) and self.more():
+            pass
+        if size < 0:
+            size = len(self.buffer)
+        text, self.buffer = self.buffer[:size], self.buffer[size:]
+        return text
+    
+    def readline(self):
+        while '\n' not in self.buffer and self.more():
+            pass
+        end = self.buffer.find('\n') + 1 or len(self.buffer)
+        line, self.buffer = self.buffer[:end], self.buffer[end:]
+        return line
+    
+    def __iter__(self):
+        return iter(self.readline, '')
+
+class BgzfReader(InflatingReader):
+    '''
+    Reads a BGZF file as text. BGZF files are gzip files made of members
+    of at most 64KB, each giving its compressed size in a BC extra field,
+    so they can be split without decompressing them. Batches of members
+    are decompressed on a pool of threads, keeping twice as many batches
+    in flight as there are threads, and joined in order as the file is
+    read. Supports read and readline, but not seeking.
+    '''
+    def __init__(self, path, threads=DECOMPRESS_THREADS):
+        self.name = path
+        self.file = open(path, 'rb')
+        self.threads = threads
+        self.pool = ThreadPool(threads)
+        self.pending = collections.deque()
+        self.buffer = ''
+        self.ended = False # All of the file is read, not necessarily decompressed
+        self.fill()
+    
+    def read_member(self):
+        ''' Returns the next member of the file as (deflated data, CRC, size), or None at the end '''
+        header = self.file.read(12)
+        if not header:
+            return None
+        if len(header) < 12 or not header.startswith(GZIP_MAGIC) or not ord(header[3]) & 4:
+            logging.error('File is not in BGZF format')
+            raise InvalidFileError
+        extra = self.file.read(struct.unpack('<H', header[10:12])[0])
+        at = 0
+        while at + 4 <= len(extra):
+            field, length = extra[at:at + 2], struct.unpack('<H', extra[at + 2:at + 4])[0]
+            if field == 'BC':
+                size = struct.unpack('<H', extra[at + 4:at + 6])[0] + 1
+                break
+            at += 4 + length
+        else:
+            logging.error('BGZF member has no block size')
+            raise InvalidFileError
+        data = self.file.read(size - 12 - len(extra))
+        crc, length = struct.unpack('<Ii', data[-8:])
+        return data[:-8], crc, length
+    
+    def fill(self):
+        ''' Hands batches of members to the pool until enough are in flight '''
+        while not self.ended and len(self.pending) < 2 * self.threads:
+            batch = []
+            while len(batch) < BGZF_BATCH:
+                member = self.read_member()
+                if member is None:
+                    self.ended = True
+                    self.file.close()
+                    break
+                batch.append(member)
+            if batch:
+                self.pending.append(self.pool.apply_async(inflate_members, (batch,)))
+        if self.ended and not self.pending:
+            self.pool.close()
+    
+    def more(self):
+        ''' Adds the next decompressed batch to the buffer. Returns False at the end. '''
+        if not self.pending:
+            return False
+        self.buffer += self.pending.popleft().get()
+        self.fill()
+        return True
+    
+    def close(self):
+        self.pool.terminate()
+        self.file.close()
+
+class GzipStreamReader(InflatingReader):
+    '''
+    Reads a gzip stream that cannot seek, such as standard input, as text,
+    decompressing it as it is read. Like BGZF files, the stream may hold
+    several members one after the other.
+    '''
+    def __init__(self, f):
+        self.name = getattr(f, 'name', None)
+        self.file = f
+        self.inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    
+    def more(self):
+        data = self.file.read(BLOCK_SIZE)
+        if not data:
+            return False
+        text = self.inflater.decompress(data)
+        while self.inflater.unused_data: # The next member starts
+            data = self.inflater.unused_data
+            self.inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            text += self.inflater.decompress(data)
+        self.buffer += text
+        return True
+    
+    def close(self):
+        self.file.close()
+
+def inflate_members(members):
+    ''' Decompresses a batch of BGZF members, as read by BgzfReader.read_member, into text '''
+    texts = []
+    for data, crc, length in members:
+        text = zlib.decompress(data, -15)
+        if len(text) != length or zlib.crc32(text) & 0xffffffff != crc:
+            raise IOError('BGZF member is corrupt')
+        texts.append(text)
+    return ''.join(texts)
+
+def get_compression(path):
+    ''' Returns how a file is compressed: 'bgzf', 'gzip' or None '''
+    f = open(path, 'rb')
+    header = f.read(14)
+    f.close()
+    if not header.startswith(GZIP_MAGIC):
+        return None
+    if len(header) == 14 and ord(header[3]) & 4 and header[12:14] == 'BC':
+        return 'bgzf'
+    return 'gzip'
+
+def open_input(path):
+    ''' Opens a text input for reading, decompressing it if it is compressed with gzip or BGZF '''
+    compression = get_compression(path)
+    if compression == 'bgzf':
+        return BgzfReader(path)
+    if compression == 'gzip':
+        return gzip.open(path, 'rb')
+    return open(path, 'rt')
+
+def open_stdin():
+    ''' Opens standard input for reading, decompressing it if it starts like a gzip (or BGZF) file '''
+    f = io.open(sys.stdin.fileno(), 'rb', closefd=False)
+    if f.peek(len(GZIP_MAGIC)).startswith(GZIP_MAGIC):
+        logging.info('Decompressing standard input')
+        return GzipStreamReader(f)
+    return f
+
+def is_binary_index(path):
+    ''' Returns whether the file is a binary index written by idxtobin.py '''
+    f = open(path, 'rb')
+    magic = f.read(len(BINARY_MAGIC))
+    f.close()
+    return magic == BINARY_MAGIC
+
+def get_manager(path, indexed=False, unsorted=False, memory=SORT_MEMORY * 2 ** 20):
+    ''' Returns the chromosome manager for a path, "-" being standard input, or a list of
+    paths whose reads are pooled. If indexed, the manager of a file can seek to any
+    chromosome. If unsorted, the reads may be in
+    any order, and are sorted using at most about memory bytes besides one chromosome.
+    Compressed files and standard input are decompressed as they are read. '''
+    if not isinstance(path, basestring):
+        if len(path) > 1:
+            return MergedChromosomeManager(path, indexed, unsorted, memory)
+        path = path[0]
+    if path != '-' and is_binary_index(path):
+        return BinaryChromosomeManager(path)
+    if unsorted:
+        return UnsortedChromosomeManager(open_stdin() if path == '-' else open_input(path), memory)
+    if path == '-':
+        return BlockChromosomeManager(open_stdin())
+    if get_compression(path):
+        if indexed:
+            logging.info('Reading through "%s" as compressed files cannot be indexed' % path)
+        return BlockChromosomeManager(open_input(path))
+    index = get_chromosome_index(path) if indexed else None
+    return BlockChromosomeManager(open(path,'rt'), index=index)
+
+def build_chromosome_index(path):
+    '''
+    Reads a whole file to index its chromosomes. Returns an ordered dict of
+    chromosome name to (byte offset of the first line, byte offset past the
+    last line, lowest index, highest index, forward reads, reverse reads).
+    '''
+    logging.info('Indexing chromosomes of "%s"' % path)
+    manager = BlockChromosomeManager(open(path, 'rt'), offsets=True)
+    totals = []
+    while not manager.done:
+        lo = hi = None
+        forward = reverse = 0
+        for reads in manager.read_blocks():
+            if lo is None:
+                lo = int(reads[0, 0])
+            hi = int(reads[-1, 0])
+            forward += int(reads[:, 1].sum())
+            reverse += int(reads[:, 2].sum())
+        totals.append((lo, hi, forward, reverse))
+    starts = [offset for name, offset in manager.offsets]
+    ends = starts[1:] + [os.path.getsize(path)]
+    return collections.OrderedDict((name, (start, end) + total)
+                                   for (name, start), end, total in zip(manager.offsets, ends, totals))
+
+def get_chromosome_index(path):
+    '''
+    Returns the chromosome index of a file (see build_chromosome_index).
+    It is kept next to the file, with the INDEX_EXTENSION added, as a tab
+    separated table: a line with the size and modification time of the file
+    it indexes, then a line for every chromosome. The index is built when
+    it is missing or the file has changed since.
+    '''
+    stat = os.stat(path)
+    stamp = 'file\t%d\t%r' % (stat.st_size, stat.st_mtime)
+    index_path = path + INDEX_EXTENSION
+    if os.path.exists(index_path):
+        lines = open(index_path, 'rt').read().splitlines()
+        if lines and lines[0] == stamp:
+            rows = [line.split('\t') for line in lines[1:]]
+            return collections.OrderedDict((row[0], tuple(int(value) for value in row[1:])) for row in rows)
+        logging.info('Chromosome index "%s" is out of date' % index_path)
+    
+    index = build_chromosome_index(path)
+    try:
+        f = open(index_path, 'wt')
+        f.write(stamp + '\n')
+        for name, row in index.items():
+            f.write('%s\t%d\t%d\t%d\t%d\t%d\t%d\n' % ((name,) + row))
+        f.close()
+    except IOError:
+        logging.warning('Could not write chromosome index "%s"' % index_path)
+    return index
+
+def parse_regions(chromosomes, path):
+    '''
+    Parses the chromosomes to process, given as a comma separated list of
+    names, each optionally followed by a :first-last range of indexes, and
+    a BED file of regions (with zero based starts and exclusive ends).
+    Returns None to process all chromosomes, or an ordered dict of chromosome
+    name to a sorted list of non-overlapping (first, last) index ranges, or
+    None for the whole chromosome. Raises ValueError on invalid regions.
+    '''
+    regions = collections.OrderedDict()
+    def add(cname, region):
+        if region and region[0] > region[1]:
+            raise ValueError('Region %s:%d-%d is empty' % (cname, region[0], region[1]))
+        if region is None or regions.get(cname, []) is None:
+            regions[cname] = None
+        else:
+            regions.setdefault(cname, []).append(region)
+    
+    for spec in filter(None, chromosomes.split(',')):
+        cname, sep, span = spec.partition(':')
+        if not sep:
+            add(cname, None)
+            continue
+        try:
+            first, last = [int(value) for value in span.split('-')]
+        except ValueError:
+            raise ValueError('Could not read region "%s". Use chromosome:first-last.' % spec)
+        add(cname, (first, last))
+    if path:
+        for line in open(path, 'rt'):
+            fields = line.split()
+            if not fields or fields[0] in ('track', 'browser') or fields[0].startswith('#'):
+                continue
+            try:
+                first, last = int(fields[1]) + 1, int(fields[2])
+            except (IndexError, ValueError):
+                raise ValueError('Could not read region "%s" in %s' % (line.strip(), path))
+            add(fields[0], (first, last))
+    if not regions:
+        return None
+    
+    for cname, spans in regions.items():
+        if spans is None:
+            continue
+        merged = []
+        for first, last in sorted(spans):
+            if merged and first <= merged[-1][1] + 1:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], last))
+            else:
+                merged.append((first, last))
+        regions[cname] = merged
+    return regions
+            
+def make_keys(data):
+    return data[:, 0]
+    
 def get_window(data, start, end, keys):
     ''' Returns all reads from the data set with index between the two indexes'''
     start_index = bisect.bisect_left(keys, start)
     end_index = bisect.bisect_right(keys, end)
     return data[start_index:end_index]
     
-def get_index(value, keys):
-    ''' Returns the index of the value in the keys using bisect '''
-    return bisect.bisect_left(keys, value)
-
 def get_range(data):
-    lo = min([item[0] for item in data])
-    hi = max([item[0] for item in data])
+    lo = int(data[:, 0].min())
+    hi = int(data[:, 0].max())
     return lo, hi
 
-def get_chunks(lo, hi, size, overlap=500):
-    ''' Divides a range into chunks of maximum size size. Returns a list of 2-tuples
-    (slice_range, process_range), each a 2-tuple (start, end). process_range has zero overlap
-    and should be given to process_chromosome as-is, and slice_range is overlapped and should be used to
-    slice the data (using get_window) to be given to process_chromosome. '''
-    chunks = []
-    for start_index in range(lo, hi, size):
-        process_start = start_index
-        process_end = min(start_index + size, hi) # Don't go over upper bound
-        slice_start = max(process_start - overlap, lo) # Don't go under lower bound
-        slice_end = min(process_end + overlap, hi) # Don't go over upper bound
-        chunks.append(((slice_start, slice_end), (process_start, process_end)))
-    return chunks
-    
-def allocate_array(data, width):
+def stream_chunks(blocks, size, overlap=500, budget=None):
+    ''' Divides a chromosome given as a stream of sorted blocks of reads into chunks of at most
+    size bases from its lowest read index to its highest, generating (reads, process_range,
+    track_range) triples. The reads are those of the process range widened by overlap each side,
+    within the reads' own range, as get_window slices them. A chunk is generated as soon as a read past the end of its slice arrives, and only the
+    reads from the start of the next slice on are kept. The track ranges are the process ranges,
+    except that the first and last reach overlap past the reads, so they cover the whole track
+    once. Given a MemoryBudget, chunks are shrunk where the reads are too dense for it. '''
+    pending = []
+    lo = hi = start = None
+    for block in blocks:
+        if not len(block):
+            continue
+        if lo is None:
+            lo = start = int(block[0, 0])
+        hi = int(block[-1, 0])
+        pending.append(block)
+        if hi <= start + size + overlap:
+            continue
+        data = numpy.concatenate(pending)
+        keys = make_keys(data)
+        while hi > start + size + overlap: # Every read of this slice has arrived
+            track_start = start if start > lo else lo - overlap
+            end = start + (budget.fit(keys, start, size, overlap) if budget else size)
+            yield get_window(data, max(start - overlap, lo), end + overlap, keys), (start, end), (track_start, end)
+            start = end
+        data = data[numpy.searchsorted(keys, max(start - overlap, lo)):]
+        pending = [data]
+    
+    if lo is None:
+        return
+    data = numpy.concatenate(pending)
+    keys = make_keys(data)
+    while start < hi:
+        end = min(start + (budget.fit(keys, start, size, overlap) if budget else size), hi) # Don't go over upper bound
+        track_range = (start if start > lo else lo - overlap, end if end < hi else hi + overlap)
+        yield get_window(data, max(start - overlap, lo), min(end + overlap, hi), keys), (start, end), track_range
+        start = end
+    
+class MemoryBudget(object):
+    '''
+    Works out chunk sizes that keep a run within a memory limit, in bytes,
+    shared by its processes. Every worker may hold one chunk at a time,
+    which costs two arrays of dtype as long as the chunk and its overlap,
+    of width each side, SMOOTH_BYTES per base of them and ROW_BYTES per
+    read row in it. size is the chunk size that fits when rows are few, at most
+    largest, and fit shrinks it for dense regions.
+    '''
+    def __init__(self, limit, processes, largest, width, overhead=0, dtype=ARRAY_DTYPE):
+        self.width = width
+        workers = processes + 1 if processes > 1 else 1 # With workers, the parent is a process of its own
+        self.chunk_bytes = (limit - workers * PROCESS_BYTES - PARSE_BYTES - overhead) // processes
+        self.base_bytes = 2 * numpy.dtype(dtype).itemsize + SMOOTH_BYTES
+        self.size = min(largest, self.chunk_bytes // self.base_bytes - 4 * width)
+        if self.size < width:
+            raise ValueError('A memory limit of %dMB is too small for %d processes.' % (limit // 2 ** 20, processes))
+    
+    def cost(self, size, rows):
+        ''' Returns the bytes a chunk of size bases holding rows read rows takes '''
+        return (size + 4 * self.width) * self.base_bytes + rows * ROW_BYTES
+    
+    def fit(self, keys, start, size, overlap):
+        ''' Returns the largest chunk size, at most size, whose reads from start on in keys fit
+        the budget. Chunks are not made shorter than the overlap, however dense the reads. '''
+        first = numpy.searchsorted(keys, start - overlap)
+        def rows(size):
+            return numpy.searchsorted(keys, start + size + overlap, 'right') - first
+        if self.cost(size, rows(size)) <= self.chunk_bytes:
+            return size
+        low, high = overlap, size # Bisect for the largest size that fits
+        while low < high:
+            middle = (low + high + 1) // 2
+            if self.cost(middle, rows(middle)) <= self.chunk_bytes:
+                low = middle
+            else:
+                high = middle - 1
+        if self.cost(low, rows(low)) > self.chunk_bytes:
+            logging.warning('Reads at index %d are too dense to fit the memory limit' % start)
+        else:
+            # Unless capped by largest, self.size is the most that fits without reads, so a chunk
+            # with any reads is shrunk, if only by as many bases as its rows take the room of
+            logging.debug('Shrinking the chunk at index %d from %d to %d bases to make room for its %d read rows' %
+                          (start, size, low, rows(low)))
+        return low
+
+def get_budget(options, width):
+    ''' Returns the MemoryBudget of the --max-memory option, or None if there is no limit '''
+    if not options.max_memory:
+        return None
+    overhead = options.sort_memory * 2 ** 20 if options.unsorted else 0
+    return MemoryBudget(options.max_memory * 2 ** 20, options.processes, options.chunk_size * 10 ** 6, width, overhead,
+                        PRECISIONS[options.precision][0])
+
+def allocate_array(data, width, dtype=ARRAY_DTYPE):
     ''' Allocates a new array with the dimensions required to fit all reads in the
     argument. The new array is totally empty. Returns the array and the shift (number to add to
     a read index to get the position in the array it should be at).'''
     lo, hi = get_range(data)
     rng = hi - lo
     shift = width - lo
-    return numpy.zeros(rng+width*2, numpy.float), shift
+    return numpy.zeros(rng+width*2, dtype), shift
     
 def normal_array(width, sigma, normalize=True):
     ''' Returns an array of the normal distribution of the specified width '''
@@ -273,185 +1350,930 @@ def normal_array(width, sigma, normalize=True):
 
     return values
 
-def call_peaks(array, shift, data, keys, direction, options):
-    peaks = []
-    def find_peaks():
-        # Go through the array and call each peak
-        results = (array > numpy.roll(array, 1)) & (array > numpy.roll(array, -1))
-        indexes = numpy.where(results)
-        for index in indexes[0]:
-            pos = options.down_width or options.exclusion // 2
-            neg = options.up_width or options.exclusion // 2
-            if direction == 2: # Reverse strand
-                pos, neg = neg, pos # Swap positive and negative widths
-            peaks.append(Peak(int(index)-shift, pos, neg, array[index]))
-    find_peaks()
-        
-    def calculate_reads():
-        # Calculate the number of reads in each peak
-        for peak in peaks:
-            reads = get_window(data, peak.start, peak.end, keys)
-            peak.value = peak.height
-            peak.readcount = sum([read[direction] for read in reads])
-            indexes = [r for read in reads for r in [read[0]] * read[direction]] # Flat list of indexes with frequency
-            peak.stddev = numpy.std(indexes)
-    calculate_reads()
-        
+def populate_array(array, shift, reads, column, normal):
+    ''' Adds the normal of every read of one strand (column 1 forward, 2 reverse) to the
+    array. The reads are scattered into a dense count vector in one step, which is then
+    convolved with the normal in a single pass. '''
+    # counts[i] holds the reads whose normal starts at array[i]
+    offsets = reads[:, 0] + shift - len(normal) // 2
+    counts = numpy.bincount(offsets, weights=reads[:, column], minlength=len(array) - len(normal) + 1)
+    array += smooth_counts(counts, normal)
+
+def smooth_counts(counts, normal):
+    ''' Returns the full convolution of a count vector with the normal. Short kernels and
+    short vectors are convolved directly, wide kernels over long vectors use FFT overlap-add. '''
+    if len(normal) < FFT_MIN_KERNEL or len(counts) < FFT_SIZE:
+        return numpy.convolve(counts, normal)
+    
+    size = FFT_SIZE
+    while size < 4 * len(normal):
+        size *= 2
+    step = size - len(normal) + 1
+    kernel = numpy.fft.rfft(normal, size)
+    result = numpy.zeros(len(counts) + len(normal) - 1, numpy.float)
+    for start in range(0, len(counts), step):
+        block = counts[start:start + step]
+        if not block.any():
+            continue
+        end = start + len(block) + len(normal) - 1
+        result[start:end] += numpy.fft.irfft(numpy.fft.rfft(block, size) * kernel, size)[:end - start]
+    
+    # FFT leaves rounding noise, snap to a grid FFT_BITS below the maximum so that empty
+    # regions are exactly zero and exact sums (integer heights, plateaus) come out exact again
+    top = numpy.abs(result).max()
+    if top > 0:
+        scale = 2.0 ** (math.ceil(math.log(top, 2)) - FFT_BITS)
+        result /= scale # In place, so the temporaries take no more memory than the result
+        numpy.round(result, out=result)
+        result *= scale
+    return result
+
+def exclude_peaks(indexes, values, radius):
+    ''' Resolves the exclusion zone. Peaks are taken from highest to lowest value (ties in index
+    order) and each one removes every peak not yet taken within radius of it, even if it was
+    removed itself. A peak therefore survives when it outranks all peaks within radius, which is
+    answered for all peaks at once with a sparse table of range minimums over their ranks.
+    Takes the peak indexes in sorted order and their values, returns a boolean survivor mask. '''
+    count = len(indexes)
+    if not count:
+        return numpy.zeros(0, bool)
+    rank = numpy.empty(count, int)
+    rank[numpy.lexsort((indexes, -values))] = numpy.arange(count)
+    
+    # Every peak's zone, as a range [lo, hi) of positions in the peak list
+    lo = numpy.searchsorted(indexes, indexes - radius, 'left')
+    hi = numpy.searchsorted(indexes, indexes + radius, 'right')
+    lengths = hi - lo
+    
+    # tables[k][i] is the best rank among peaks i to i + 2**k - 1
+    tables = [rank]
+    while 2 ** len(tables) <= lengths.max():
+        half = 2 ** (len(tables) - 1)
+        tables.append(numpy.minimum(tables[-1][:-half], tables[-1][half:]))
+    
+    levels = numpy.floor(numpy.log2(lengths)).astype(int)
+    best = numpy.empty(count, int)
+    for level, table in enumerate(tables):
+        selected = levels == level
+        best[selected] = numpy.minimum(table[lo[selected]], table[hi[selected] - 2 ** level])
+    return best == rank
+
+def window_stats(indexes, counts, starts, ends):
+    ''' Returns the read count, mean index and standard deviation of the index for the reads
+    within each window [start, end], all windows at once. Uses prefix sums of count, count*index
+    and count*index**2, so a pileup costs no more than a single read. The int64 sums may wrap
+    around, but differences between them are exact modulo 2**64 and are taken relative to the
+    window start, where the true values are small (exact while count**2 * variance of a window
+    fits in an int64). Empty windows get a nan mean and deviation. '''
+    indexes = numpy.asarray(indexes, numpy.int64)
+    counts = numpy.asarray(counts, numpy.int64)
+    starts = numpy.asarray(starts, numpy.int64)
+    
+    def prefix(values):
+        return numpy.concatenate(([0], numpy.cumsum(values)))
+    sums = [prefix(counts), prefix(counts * indexes), prefix(counts * indexes * indexes)]
+    lo = numpy.searchsorted(indexes, starts, 'left')
+    hi = numpy.searchsorted(indexes, ends, 'right')
+    total, first, second = [s[hi] - s[lo] for s in sums]
+    
+    # Moments about the window start, then count**2 * variance exactly in integers
+    first = first - starts * total
+    second = second - 2 * starts * (first + starts * total) + starts * starts * total
+    spread = total * second - first * first
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        mean = starts + first / total.astype(numpy.float)
+        stddev = numpy.sqrt(spread.astype(numpy.float)) / total
+    return total, mean, stddev
+
+def call_peaks(array, shift, data, direction, options, timer=NO_TIMER):
+    ''' Calls the peaks of one strand (column 1 forward, 2 reverse) of the reads from its
+    smoothed array: every local maximum, with the reads within its width counted, that survives
+    exclusion. Returns them as a table of PEAK_DTYPE in index order. '''
+    reads = numpy.asarray(data)
+    pos = options.down_width or options.exclusion // 2
+    neg = options.up_width or options.exclusion // 2
+    if direction == 2: # Reverse strand
+        pos, neg = neg, pos # Swap positive and negative widths
+    with timer('find'):
+        # The ends are never peaks, as the array reaches width past the reads and the normal
+        # rises towards them
+        inner = array[1:-1]
+        indexes = numpy.flatnonzero((inner > array[:-2]) & (inner > array[2:])) + 1
+        peaks = numpy.zeros(len(indexes), PEAK_DTYPE)
+        peaks['index'] = indexes - shift
+        peaks['start'] = peaks['index'] - neg
+        peaks['end'] = peaks['index'] + pos
+        peaks['value'] = peaks['height'] = array[indexes]
+    
+    with timer('readcount'):
+        readcounts, means, stddevs = window_stats(reads[:, 0], reads[:, direction], peaks['start'], peaks['end'])
+        peaks['readcount'] = readcounts
+        peaks['stddev'] = stddevs
+    
     before = len(peaks)
-        
-    def perform_exclusion():
-        # Process the exclusion zone
-        peak_keys = make_peak_keys(peaks)
-        peaks_by_value = peaks[:]
-        peaks_by_value.sort(key=lambda peak: -peak.value)
-        for peak in peaks_by_value:
-            peak.safe = True
-            window = get_window(peaks, peak.index-options.exclusion//2, peak.index+options.exclusion//2, peak_keys)
-            for excluded in window:
-                if excluded.safe:
-                    continue
-                i = get_index(excluded.index, peak_keys)
-                del peak_keys[i]
-                del peaks[i]
-    perform_exclusion()
-            
+    with timer('exclusion'):
+        peaks = peaks[exclude_peaks(peaks['index'], peaks['value'], options.exclusion // 2)]
+    
     after = len(peaks)
+    timer.count('peaks_found', before)
+    timer.count('peaks_after_exclusion', after)
     if before != 0:
         logging.debug('%d of %d peaks (%d%%) survived exclusion' % (after, before, after*100/before))
             
     return peaks
     
-def process_chromosome(cname, data, process_bounds, options):
+def get_runs(array, shift, bounds, inclusive, step):
+    ''' Returns the runs of positions within bounds (2-tuple) where the array is above 0.5
+    (or equal to it, if inclusive) and has the same value, rounded to a multiple of step
+    if that is not 0, as a table of TRACK_DTYPE. '''
+    lo = max(bounds[0] + shift, 0)
+    hi = min(bounds[1] + shift, len(array))
+    values = array[lo:hi]
+    indexes = numpy.flatnonzero(values >= 0.5 if inclusive else values > 0.5)
+    values = values[indexes]
+    if step:
+        values = numpy.round(values / step) * step
+    # A run starts wherever a position does not follow the previous one or the value changes
+    starts = numpy.flatnonzero(numpy.r_[True, (numpy.diff(indexes) != 1) | (values[1:] != values[:-1])])[:len(indexes)]
+    ends = numpy.r_[starts[1:], len(indexes)][:len(starts)]
+    runs = numpy.zeros(len(starts), TRACK_DTYPE)
+    runs['start'] = indexes[starts] + lo - shift
+    runs['end'] = indexes[ends - 1] + lo - shift + 1
+    runs['value'] = values[starts]
+    return runs
+
+def process_chromosome(cname, data, process_bounds, options, track_bounds=None, cache=None, timer=None):
     '''
     Process a chromosome. Takes the chromosome name, list of reads,
-    the bounds (2-tuple) to write results in, and options.
+    the bounds (2-tuple) to write results in, options, the bounds to
+    write tracks in (default the whole chunk), a SmoothingCache to
+    take the smoothed reads from, if any, and a StageTimer to record
+    statistics in, if any. Returns the forward and reverse tables of
+    peaks to write, the forward and reverse track runs and the timer.
     '''
-    if data:
+    stats = timer or NO_TIMER
+    peaks = (numpy.zeros(0, PEAK_DTYPE), numpy.zeros(0, PEAK_DTYPE))
+    tracks = (numpy.zeros(0, TRACK_DTYPE), numpy.zeros(0, TRACK_DTYPE))
+    if len(data):
         logging.info('Processing chromosome %s indexes %d-%d' % (cname, process_bounds[0], process_bounds[1]))
     else:
         logging.info('Skipping chromosome %s indexes %d-%d because no reads within these bounds' % (cname, process_bounds[0], process_bounds[1]))
-        return
-    keys = make_keys(data)
-    # Create the arrays that hold the sum of the normals
-    forward_array, forward_shift = allocate_array(data, WIDTH)
-    reverse_array, reverse_shift = allocate_array(data, WIDTH)
-    normal = normal_array(WIDTH, options.sigma)
-    
-    
-    def populate_array():
-        # Add each read's normal to the array
-        for read in data:
-            index, forward, reverse = read
-            # Add the normals to the appropriate regions
-            if forward:
-                forward_array[index+forward_shift-WIDTH:index+forward_shift+WIDTH] += normal * forward
-            if reverse:
-                reverse_array[index+reverse_shift-WIDTH:index+reverse_shift+WIDTH] += normal * reverse
-    populate_array()
-
-    if options.bedgraph:
-        logging.debug('Generating bedgraph files')
-        f = open('forward.bedgraph','at')
-        indexes = numpy.where(forward_array >= 0.5)[0]
-        for index in indexes:
-            f.write('%s\t%d\t%d\t%s\n' % (cname, index - forward_shift, index - forward_shift + 1, forward_array[index]))
-        f.close()
+        return peaks, tracks, timer
+    reads = numpy.asarray(data)
+    stats.note('reads', int(reads[:, 1:].sum()))
+    dtype = PRECISIONS[options.precision][0]
+    if cache:
+        arrays = cache.smooth(cname, process_bounds, reads, WIDTH, options.sigma, stats, dtype)
+    else:
+        arrays = smooth_reads(reads, WIDTH, options.sigma, stats, dtype)
+    (forward_array, forward_shift), (reverse_array, reverse_shift) = arrays
+    stats.note('array_bytes', forward_array.nbytes + reverse_array.nbytes)
+
+    if options.bedgraph or options.binary_track:
+        logging.debug('Generating tracks')
+        if track_bounds is None:
+            track_bounds = (-forward_shift, len(forward_array) - forward_shift)
+        with stats('tracks'):
+            forward_runs = get_runs(forward_array, forward_shift, track_bounds, True, options.track_step)
+            reverse_runs = get_runs(reverse_array, reverse_shift, track_bounds, False, options.track_step)
+            reverse_runs['start'] += readsize
+            reverse_runs['end'] += readsize
+        tracks = forward_runs, reverse_runs
 
-        f = open('reverse.bedgraph','at')
-        indexes = numpy.where(reverse_array > 0.5)[0]
-        for index in indexes:
-            pos = index - reverse_shift + readsize
-            f.write('%s\t%d\t%d\t%s\n' % (cname, pos, pos + 1, reverse_array[index]))
+    peaks = call_strands(reads, forward_array, forward_shift, reverse_array, reverse_shift, process_bounds, options, stats)
+    stats.note('peak_rss', peak_rss())
+    return peaks, tracks, timer
+
+def smooth_reads(reads, width, sigma, timer=NO_TIMER, dtype=ARRAY_DTYPE):
+    ''' Returns the (array, shift) pairs holding the sum of the normals of the forward
+    and reverse reads, in arrays of dtype '''
+    with timer('allocate'):
+        forward_array, forward_shift = allocate_array(reads, width, dtype)
+        reverse_array, reverse_shift = allocate_array(reads, width, dtype)
+        normal = normal_array(width, sigma)
+    with timer('smooth'):
+        populate_array(forward_array, forward_shift, reads, 1, normal)
+        populate_array(reverse_array, reverse_shift, reads, 2, normal)
+    return (forward_array, forward_shift), (reverse_array, reverse_shift)
+
+def file_fingerprint(path, directory):
+    ''' Returns the SHA-1 of the contents of a file. It is remembered in the directory
+    under the path, size and modification time of the file, so an unchanged file is only
+    read once. '''
+    stat = os.stat(path)
+    name = hashlib.sha1('%s\t%d\t%r' % (os.path.abspath(path), stat.st_size, stat.st_mtime)).hexdigest()
+    memo = os.path.join(directory, name + '.fingerprint')
+    if os.path.exists(memo):
+        return open(memo, 'rt').read().strip()
+    logging.info('Fingerprinting "%s"' % path)
+    digest = hashlib.sha1()
+    f = open(path, 'rb')
+    for block in iter(lambda: f.read(HASH_BLOCK), ''):
+        digest.update(block)
+    f.close()
+    fingerprint = digest.hexdigest()
+    f = open(memo, 'wt')
+    f.write(fingerprint + '\n')
+    f.close()
+    return fingerprint
+
+class SmoothingCache(object):
+    '''
+    A directory of smoothed reads, holding the forward and reverse arrays
+    of each chunk that has been smoothed as a .npy file named after the
+    fingerprint of the input file, the chromosome, the chunk bounds, the
+    first and last index of the reads smoothed, which place the arrays,
+    sigma, readsize and the dtype of the arrays. Cached arrays are memory mapped instead of smoothed again.
+    Once the files take more than limit bytes, the least recently used are
+    removed.
+    '''
+    def __init__(self, directory, limit, fingerprint):
+        self.directory = directory
+        self.limit = limit
+        self.fingerprint = fingerprint
+    
+    def get_path(self, cname, process_bounds, read_range, sigma, dtype=ARRAY_DTYPE):
+        key = '%s\t%s\t%d\t%d\t%d\t%d\t%d\t%d' % (self.fingerprint, cname, process_bounds[0], process_bounds[1],
+                                                read_range[0], read_range[1], sigma, readsize)
+        if numpy.dtype(dtype) != numpy.dtype(ARRAY_DTYPE): # Keeps the paths of earlier caches
+            key += '\t' + numpy.dtype(dtype).name
+        return os.path.join(self.directory, hashlib.sha1(key).hexdigest() + '.npy')
+    
+    def smooth(self, cname, process_bounds, reads, width, sigma, timer=NO_TIMER, dtype=ARRAY_DTYPE):
+        ''' Returns the smoothed reads of a chunk like smooth_reads, from the cache if they are in it '''
+        read_range = get_range(reads)
+        path = self.get_path(cname, process_bounds, read_range, sigma, dtype)
+        shift = width - read_range[0]
+        try:
+            with timer('cache'):
+                arrays = numpy.load(path, mmap_mode='r')
+                os.utime(path, None) # Mark as recently used
+            logging.debug('Using cached smoothing of chromosome %s indexes %d-%d' % (cname, process_bounds[0], process_bounds[1]))
+            return (arrays[0], shift), (arrays[1], shift)
+        except (IOError, OSError, ValueError):
+            pass
+        (forward_array, shift), (reverse_array, shift) = smooth_reads(reads, width, sigma, timer, dtype)
+        temp_path = '%s.%d.tmp' % (path, os.getpid())
+        f = open(temp_path, 'wb')
+        numpy.save(f, numpy.vstack((forward_array, reverse_array)))
         f.close()
+        os.rename(temp_path, path)
+        self.evict()
+        return (forward_array, shift), (reverse_array, shift)
+    
+    def evict(self):
+        ''' Removes the least recently used files until the cache fits its limit '''
+        entries = []
+        for fname in os.listdir(self.directory):
+            if fname.endswith('.npy'):
+                try:
+                    stat = os.stat(os.path.join(self.directory, fname))
+                except OSError: # Removed by another process
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, fname))
+        total = sum(size for mtime, size, fname in entries)
+        for mtime, size, fname in sorted(entries):
+            if total <= self.limit:
+                break
+            logging.debug('Evicting %s from the smoothing cache' % fname)
+            try:
+                os.unlink(os.path.join(self.directory, fname))
+            except OSError:
+                pass
+            total -= size
+
+def get_cache(path, options):
+    ''' Returns the SmoothingCache to use for a file, or list of files pooled, or None if there is none '''
+    paths = input_paths(path)
+    if not options.cache_dir or '-' in paths:
+        return None
+    if not os.path.exists(options.cache_dir):
+        os.makedirs(options.cache_dir)
+    fingerprint = '+'.join(file_fingerprint(path, options.cache_dir) for path in paths)
+    return SmoothingCache(options.cache_dir, options.cache_size * 2 ** 20, fingerprint)
+
+def input_paths(path):
+    ''' Returns the paths of an input given as a path or as a list of paths to pool '''
+    return [path] if isinstance(path, basestring) else list(path)
+
+def check_paths(path):
+    ''' Returns whether all paths of an input exist, logging the first that does not '''
+    for path in input_paths(path):
+        if path != '-' and not os.path.exists(path):
+            logging.error('Path "%s" does not exist.' % path)
+            return False
+    return True
 
+def call_strands(reads, forward_array, forward_shift, reverse_array, reverse_shift, process_bounds, options, timer=NO_TIMER):
+    ''' Calls the peaks of both strands, returning the forward and reverse tables of
+    the peaks within the process bounds that pass the filter '''
     logging.debug('Calling forward strand')
-    forward_peaks = call_peaks(forward_array, forward_shift, data, keys, 1, options)
+    forward_peaks = call_peaks(forward_array, forward_shift, reads, 1, options, timer)
     logging.debug('Calling reverse strand')
-    reverse_peaks = call_peaks(reverse_array, reverse_shift, data, keys, 2, options)
-
-    def write(cname, strand, peak):
-        start = max(peak.start, 1)
-        end = peak.end
-        value = peak.value
-        stddev = peak.stddev
-        if value > options.filter:
-            if options.format == 'gff':
-                writerow(gff_row(cname=cname, source='genetrack', start=start, end=end,
-                                        score=value, strand=strand, attrs={'stddev':stddev, 'height':peak.height, 'readcount':peak.readcount}))
+    reverse_peaks = call_peaks(reverse_array, reverse_shift, reads, 2, options, timer)
+
+    def select(table):
+        selected = (table['value'] > options.filter) & (process_bounds[0] < table['index']) & (table['index'] < process_bounds[1])
+        table = table[selected]
+        table['start'] = numpy.maximum(table['start'], 1)
+        if forward_array.dtype != numpy.float64 and len(table):
+            # Write values as their shortest decimals at the precision they were smoothed at
+            values = [float(str(value)) for value in table['value'].astype(forward_array.dtype)]
+            table['value'] = table['height'] = values
+        return table
+    
+    with timer('select'):
+        tables = select(forward_peaks), select(reverse_peaks)
+    timer.count('peaks_written', len(tables[0]) + len(tables[1]))
+    return tables
+
+def call_peaks_array(counts, options=None):
+    '''
+    Calls peaks on reads given as an array of (index, forward count,
+    reverse count) rows, the way genetrack.py calls them on a whole
+    chromosome, for use from other programs. options may be an options
+    object or a dict holding any of the PEAK_SETTINGS, the rest take
+    their defaults. Returns the forward and reverse tables of PEAK_DTYPE
+    of the peaks that pass the filter, in index order.
+    '''
+    settings = dict(PEAK_SETTINGS)
+    if isinstance(options, dict):
+        settings.update(options)
+    elif options is not None:
+        settings.update((name, getattr(options, name)) for name in PEAK_SETTINGS if hasattr(options, name))
+    settings = Values(settings)
+    
+    reads = numpy.asarray(counts)
+    if reads.ndim != 2 or reads.shape[1] != 3:
+        raise ValueError('Reads must be given as rows of index, forward count and reverse count')
+    if not len(reads):
+        return numpy.zeros(0, PEAK_DTYPE), numpy.zeros(0, PEAK_DTYPE)
+    if (reads[1:, 0] < reads[:-1, 0]).any():
+        reads = reads[numpy.argsort(reads[:, 0], kind='mergesort')]
+    width = settings.sigma * 4
+    (forward_array, forward_shift), (reverse_array, reverse_shift) = smooth_reads(reads, width, settings.sigma,
+                                                                                  dtype=PRECISIONS[settings.precision][0])
+    lo, hi = get_range(reads)
+    return call_strands(reads, forward_array, forward_shift, reverse_array, reverse_shift, (lo - width - 1, hi + width + 1), settings)
+
+def sweep_chromosome(cname, data, process_bounds, settings, cache=None):
+    '''
+    Process a chromosome for every one of a list of settings (options
+    objects). The reads are smoothed once for each distinct sigma, or
+    taken from the SmoothingCache if one is given, and each smoothing is
+    used to call peaks with all settings of that sigma. The data must
+    reach 4 times the largest sigma past the bounds. Returns the forward
+    and reverse tables of peaks of each setting, in order.
+    '''
+    results = [None] * len(settings)
+    if len(data):
+        logging.info('Sweeping chromosome %s indexes %d-%d' % (cname, process_bounds[0], process_bounds[1]))
+    reads = numpy.asarray(data)
+    keys = make_keys(reads)
+    dtype = PRECISIONS[settings[0].precision][0]
+    for sigma in sorted(set(options.sigma for options in settings)):
+        width = sigma * 4
+        window = get_window(reads, process_bounds[0] - width, process_bounds[1] + width, keys)
+        if len(window) and cache:
+            (forward_array, forward_shift), (reverse_array, reverse_shift) = cache.smooth(cname, process_bounds, window, width, sigma,
+                                                                                          dtype=dtype)
+        elif len(window):
+            (forward_array, forward_shift), (reverse_array, reverse_shift) = smooth_reads(window, width, sigma, dtype=dtype)
+        for i, options in enumerate(settings):
+            if options.sigma != sigma:
+                continue
+            if len(window):
+                results[i] = call_strands(window, forward_array, forward_shift, reverse_array, reverse_shift, process_bounds, options)
             else:
-                writerow((cname, strand, start, end, value))
+                results[i] = numpy.zeros(0, PEAK_DTYPE), numpy.zeros(0, PEAK_DTYPE)
+    return results
+
+def validate_chromosome(cname, data, process_bounds, options):
+    '''
+    Calls the peaks of a chromosome with arrays at options.precision and
+    at double precision, and compares them. Returns the number of peaks
+    at double precision, how many of them are missing and how many others
+    were called instead at the lower precision, and the largest relative
+    difference of the value of a peak called at both.
+    '''
+    if not len(data):
+        return 0, 0, 0, 0.0
+    logging.info('Validating chromosome %s indexes %d-%d' % (cname, process_bounds[0], process_bounds[1]))
+    reads = numpy.asarray(data)
+    results = []
+    for dtype in (numpy.float64, PRECISIONS[options.precision][0]):
+        (forward_array, forward_shift), (reverse_array, reverse_shift) = smooth_reads(reads, WIDTH, options.sigma, dtype=dtype)
+        results.append(call_strands(reads, forward_array, forward_shift, reverse_array, reverse_shift, process_bounds, options))
+    total = missing = extra = 0
+    error = 0.0
+    for reference, peaks in zip(*results):
+        common = numpy.intersect1d(reference['index'], peaks['index'])
+        total += len(reference)
+        missing += len(reference) - len(common)
+        extra += len(peaks) - len(common)
+        if len(common):
+            expected = reference['value'][numpy.in1d(reference['index'], common)]
+            actual = peaks['value'][numpy.in1d(peaks['index'], common)]
+            error = max(error, float((numpy.abs(actual - expected) / expected).max()))
+    return total, missing, extra, error
+
+def format_peaks(cname, strand, peaks, format):
+    ''' Formats a table of peaks on one strand as lines of the output format, in one batch '''
+    start, end = peaks['start'], peaks['end']
+    values = map(repr, peaks['value'].tolist())
+    if format == 'gff':
+        if strand != '+':
+            start = start + readsize
+            end = end + readsize
+        rows = itertools.izip(itertools.repeat(cname), start.tolist(), end.tolist(), values, itertools.repeat(strand),
+                              peaks['readcount'].tolist(), ((start + end) // 2).tolist(),
+                              map(repr, peaks['stddev'].tolist()), map(repr, peaks['height'].tolist()))
+    elif format == 'txt':
+        rows = itertools.izip(itertools.repeat(cname), itertools.repeat(strand), start.tolist(), end.tolist(), values)
+    else:
+        rows = itertools.izip(itertools.repeat(cname), start.tolist(), end.tolist(), values, itertools.repeat(strand))
+    line = OUTPUT_LINES[format]
+    return ''.join([line % row for row in rows])
+
+class PeakWriter(object):
+    ''' Writes called peaks in one of the OUTPUT_LINES formats to a file, or to standard
+    output if no path is given. The peaks of a chunk are formatted in one batch and
+    written with a single call through a large buffer. '''
+    def __init__(self, path, format):
+        self.file = open(path, 'wt', OUTPUT_BUFFER) if path else sys.stdout
+        self.format = format
+        if format != 'bed':
+            self.file.write('##gff-version 3\n')
+    
+    def write(self, cname, forward_peaks, reverse_peaks):
+        self.file.write(format_peaks(cname, '+', forward_peaks, self.format) + format_peaks(cname, '-', reverse_peaks, self.format))
+    
+    def close(self):
+        if self.file is sys.stdout:
+            self.file.flush()
+        else:
+            self.file.close()
+
+def zoom_runs(runs, size):
+    ''' Summarizes runs in bins of size bases, returning a table of ZOOM_DTYPE with the
+    covered range, the sum of value times length, the bases covered and the highest
+    value of each bin any run falls in. Runs spanning bins are split between them. '''
+    first = runs['start'] // size
+    counts = (runs['end'] - 1) // size - first + 1
+    pieces = numpy.repeat(numpy.arange(len(runs)), counts)
+    bins = first[pieces] + numpy.arange(len(pieces)) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+    starts = numpy.maximum(runs['start'][pieces], bins * size)
+    ends = numpy.minimum(runs['end'][pieces], (bins + 1) * size)
+    values = runs['value'][pieces]
+    edges = numpy.flatnonzero(numpy.r_[True, bins[1:] != bins[:-1]])
+    zoom = numpy.zeros(len(edges), ZOOM_DTYPE)
+    zoom['bin'] = bins[edges]
+    zoom['start'] = starts[edges]
+    zoom['end'] = ends[numpy.r_[edges[1:], len(bins)] - 1]
+    zoom['sum'] = numpy.add.reduceat(values * (ends - starts), edges)
+    zoom['covered'] = numpy.add.reduceat(ends - starts, edges)
+    zoom['max'] = numpy.maximum.reduceat(values, edges)
+    return zoom
+
+class BinaryTrackWriter(object):
+    ''' Writes a binary track, read by BinaryTrack. The file holds the TRACK_MAGIC bytes, then
+    for each chromosome its runs and their summaries in bins of each of the ZOOM_SIZES, as
+    little endian TRACK_RECORD records (start, end, mean and maximum value), then a tab
+    separated table and, in its last 8 bytes, the byte offset of that table as a little endian
+    int64. The table has a line of the zoom sizes followed by a name, zoom level (0 for the
+    runs, 1 for the first of the ZOOM_SIZES and so on), byte offset and record count line
+    for each set of records. Runs must be given in order; they are written as they come. '''
+    def __init__(self, path):
+        self.file = open(path, 'wb', OUTPUT_BUFFER)
+        self.file.write(TRACK_MAGIC)
+        self.table = []
+        self.cname = None
+    
+    def write(self, cname, runs):
+        if cname != self.cname:
+            self.finish()
+            self.cname = cname
+            self.table.append((cname, 0, self.file.tell(), 0))
+            self.zooms = [[numpy.zeros(0, ZOOM_DTYPE)] for size in ZOOM_SIZES]
+        if not len(runs):
+            return
+        records = numpy.zeros(len(runs), TRACK_RECORD)
+        records['start'], records['end'] = runs['start'], runs['end']
+        records['mean'] = records['max'] = runs['value']
+        self.file.write(records.tostring())
+        self.table[-1] = self.table[-1][:3] + (self.table[-1][3] + len(runs),)
+        for zooms, size in zip(self.zooms, ZOOM_SIZES):
+            zoom, last = zoom_runs(runs, size), zooms[-1]
+            if len(last) and last[-1]['bin'] == zoom[0]['bin']: # The bin continues from the last chunk
+                zoom[0]['start'] = last[-1]['start']
+                zoom[0]['sum'] += last[-1]['sum']
+                zoom[0]['covered'] += last[-1]['covered']
+                zoom[0]['max'] = max(zoom[0]['max'], last[-1]['max'])
+                zooms[-1] = last[:-1]
+            zooms.append(zoom)
+    
+    def finish(self):
+        ''' Writes out the zoom levels of the current chromosome '''
+        if self.cname is None:
+            return
+        for level, zooms in enumerate(self.zooms):
+            zoom = numpy.concatenate(zooms)
+            records = numpy.zeros(len(zoom), TRACK_RECORD)
+            records['start'], records['end'], records['max'] = zoom['start'], zoom['end'], zoom['max']
+            records['mean'] = zoom['sum'] / zoom['covered']
+            self.table.append((self.cname, level + 1, self.file.tell(), len(records)))
+            self.file.write(records.tostring())
+        self.cname = None
     
-    for peak in forward_peaks:
-        if process_bounds[0] < peak.index < process_bounds[1]:
-            write(cname, '+', peak)
-    for peak in reverse_peaks:
-        if process_bounds[0] < peak.index < process_bounds[1]:
-            write(cname, '-', peak)
+    def close(self):
+        self.finish()
+        table_offset = self.file.tell()
+        self.file.write('zoom\t%s\n' % '\t'.join(map(str, ZOOM_SIZES)))
+        for row in self.table:
+            self.file.write('%s\t%d\t%d\t%d\n' % row)
+        self.file.write(struct.pack('<q', table_offset))
+        self.file.close()
 
-def writerow( elems ):
-    print "\t".join( map(str, elems) )
+class BinaryTrack(object):
+    ''' A binary track written by BinaryTrackWriter, memory mapped so it can be queried
+    without parsing anything. '''
+    def __init__(self, path):
+        f = open(path, 'rb')
+        if f.read(len(TRACK_MAGIC)) != TRACK_MAGIC:
+            logging.error('"%s" is not a binary track' % path)
+            raise InvalidFileError
+        f.seek(-8, os.SEEK_END)
+        table_offset, = struct.unpack('<q', f.read(8))
+        f.seek(table_offset)
+        table = [line.split('\t') for line in f.read()[:-8].splitlines()]
+        f.close()
+        
+        self.zoom_sizes = (1,) + tuple(int(size) for size in table[0][1:])
+        self.chromosomes = []
+        self.levels = {}
+        for name, level, offset, count in table[1:]:
+            if name not in self.levels:
+                self.chromosomes.append(name)
+                self.levels[name] = []
+            self.levels[name].append(((int(offset) - len(TRACK_MAGIC)) // numpy.dtype(TRACK_RECORD).itemsize, int(count)))
+        rows = (table_offset - len(TRACK_MAGIC)) // numpy.dtype(TRACK_RECORD).itemsize
+        self.records = numpy.memmap(path, TRACK_RECORD, 'r', len(TRACK_MAGIC), rows) if rows else numpy.zeros(0, TRACK_RECORD)
+    
+    def query(self, cname, start, end, level=0):
+        ''' Returns the records of a chromosome that overlap the range start-end, as runs
+        (level 0) or summaries in bins of zoom_sizes[level] bases '''
+        if cname not in self.levels:
+            return numpy.zeros(0, TRACK_RECORD)
+        first, count = self.levels[cname][level]
+        records = self.records[first:first + count]
+        return records[numpy.searchsorted(records['end'], start, 'right'):numpy.searchsorted(records['start'], end)]
+
+class TrackWriter(object):
+    ''' Writes the runs of one strand's track to a bedgraph file and to a binary track,
+    as the options ask for. name is the path without the extension. '''
+    def __init__(self, name, color, options):
+        self.bedgraph = self.binary = None
+        if options.bedgraph:
+            self.bedgraph = open(name + '.bedgraph', 'wt', OUTPUT_BUFFER)
+            self.bedgraph.write('track type=bedGraph color=%s\n' % color)
+        if options.binary_track:
+            self.binary = BinaryTrackWriter(name + '.gtt')
+        if options.precision != 'double':
+            self.digits = 7 # About all that single precision holds
+        elif options.track_step:
+            self.digits = 12
+        else:
+            self.digits = 0 # Written exactly
     
+    def write(self, cname, runs):
+        if self.bedgraph:
+            values = runs['value'].tolist()
+            values = ['%.*g' % (self.digits, value) for value in values] if self.digits else map(repr, values)
+            rows = itertools.izip(itertools.repeat(cname), runs['start'].tolist(), runs['end'].tolist(), values)
+            self.bedgraph.write(''.join(['%s\t%d\t%d\t%s\n' % row for row in rows]))
+        if self.binary:
+            self.binary.write(cname, runs)
+    
+    def close(self):
+        for f in (self.bedgraph, self.binary):
+            if f:
+                f.close()
+
+def write_results(cname, results, writer, tracks):
+    ''' Writes out the peaks and track runs returned by process_chromosome '''
+    peaks, runs = results[:2]
+    writer.write(cname, *peaks)
+    for track, strand_runs in zip(tracks, runs):
+        track.write(cname, strand_runs)
+
+def init_worker(width, size):
+    ''' Sets up the globals of a worker process to match the parent '''
+    global WIDTH, readsize
+    WIDTH = width
+    readsize = size
+
+def process_parallel(function, tasks, write, options):
+    ''' Calls function with the arguments of each of the tasks on a pool of options.processes
+    workers and writes each result with write(arguments, result). The results are written
+    in order, each as soon as it and all earlier ones are done. At most two tasks per worker
+    are in flight, so memory stays bounded. '''
+    pool = multiprocessing.Pool(options.processes, init_worker, (WIDTH, readsize))
+    pending = collections.deque()
+    try:
+        for args in tasks:
+            pending.append((args, pool.apply_async(function, args)))
+            while pending and (pending[0][1].ready() or len(pending) >= 2 * options.processes):
+                args, result = pending.popleft()
+                write(args, result.get())
+        while pending:
+            args, result = pending.popleft()
+            write(args, result.get())
+    except:
+        pool.terminate()
+        raise
+    pool.close()
+    pool.join()
+
 def process_file(path, options):
     
     global WIDTH
     WIDTH = options.sigma * 4
     
-    logging.info('Processing file "%s" with s=%d, e=%d' % (path, options.sigma, options.exclusion))
+    logging.info('Processing file "%s" with s=%d, e=%d' % ('", "'.join(input_paths(path)), options.sigma, options.exclusion))
 
-    if options.bedgraph:
-        f = open('forward.bedgraph','wt')
-        f.write("track type=bedGraph color=200,0,0\n")
-        f.close()
-            
-        f = open('reverse.bedgraph','wt')
-        f.write("track type=bedGraph color=0,0,200\n")
-        f.close()
+    if not check_paths(path):
+        return
 
-    if path == '-':
-        reader = csv.reader(sys.stdin, delimiter='\t')
-    elif os.path.exists(path):
-        reader = csv.reader(open(path,'rt'), delimiter='\t')
-    else:
+    writer = PeakWriter(options.output, options.format)
+    tracks = ()
+    if options.bedgraph or options.binary_track:
+        tracks = (TrackWriter('forward', '200,0,0', options), TrackWriter('reverse', '0,0,200', options))
+    manager = get_manager(path, options.regions is not None or options.index, options.unsorted, options.sort_memory * 2 ** 20)
+    windows = get_windows(manager, options)
+    cache = get_cache(path, options)
+    chunks = []
+    tasks = ((cname, window, process_bounds, options, track_bounds, cache, timer)
+             for cname, window, process_bounds, track_bounds, timer in time_windows(windows, options.stats))
+    def write(args, results):
+        timer = results[2] or NO_TIMER
+        with timer('write'):
+            write_results(args[0], results, writer, tracks)
+        if results[2]:
+            chunks.append(timer.report())
+    start = time.time(), cpu_time()
+    try:
+        if options.processes > 1:
+            process_parallel(process_chromosome, tasks, write, options)
+        else:
+            for args in tasks:
+                write(args, process_chromosome(*args))
+    finally:
+        writer.close()
+        for track in tracks:
+            track.close()
+    if options.stats:
+        write_stats(options.stats, path, options, chunks, start)
+
+def time_windows(windows, enabled):
+    ''' Adds a StageTimer to each work unit from get_windows, if enabled, in which the time
+    taken to load it is recorded '''
+    windows = iter(windows)
+    while True:
+        timer = StageTimer() if enabled else None
+        with (timer or NO_TIMER)('load'):
+            try:
+                cname, window, process_bounds, track_bounds = next(windows)
+            except StopIteration:
+                return
+        if timer:
+            timer.note('chromosome', cname)
+            timer.note('start', process_bounds[0])
+            timer.note('end', process_bounds[1])
+            timer.note('rows', len(window))
+        yield cname, window, process_bounds, track_bounds, timer
+
+def write_stats(path, input_path, options, chunks, start):
+    ''' Writes the statistics of a run as JSON: the settings, the totals of every stage and
+    fact over all chunks, and the statistics of each chunk, in order '''
+    stages = collections.OrderedDict()
+    totals = collections.OrderedDict()
+    for chunk in chunks:
+        for name, stage in chunk['stages'].items():
+            total = stages.setdefault(name, {'wall': 0.0, 'cpu': 0.0})
+            total['wall'] += stage['wall']
+            total['cpu'] += stage['cpu']
+        for name in ('rows', 'reads', 'array_bytes', 'peaks_found', 'peaks_after_exclusion', 'peaks_written'):
+            totals[name] = totals.get(name, 0) + chunk.get(name, 0)
+    stats = collections.OrderedDict([
+        ('input', input_path),
+        ('settings', dict((name, getattr(options, name)) for name in ('sigma', 'exclusion', 'up_width', 'down_width', 'filter',
+                                                                    'chunk_size', 'processes', 'format', 'precision'))),
+        ('wall', time.time() - start[0]),
+        ('cpu', cpu_time() - start[1]),
+        ('peak_rss', max([peak_rss()] + [chunk.get('peak_rss') for chunk in chunks])),
+        ('largest_array_bytes', max([0] + [chunk.get('array_bytes', 0) for chunk in chunks])),
+        ('totals', totals),
+        ('stages', stages),
+        ('chunks', chunks),
+    ])
+    f = open(path, 'wt')
+    json.dump(stats, f, indent=1)
+    f.write('\n')
+    f.close()
+
+def get_output_path(input_path, options):
+    ''' Returns the path to write the peaks called in a file with the given options to,
+    in a genetrack directory next to the file, named after the file and the options '''
+    directory, fname = os.path.split(input_path)
+    
+    for extension in COMPRESSED_EXTENSIONS:
+        if fname.endswith(extension):
+            fname = fname[:-len(extension)]
+    fname = ''.join(fname.split('.')[:-1]) or fname # Strip extension (will be re-added as appropriate)
+    if options.chromosome:
+        fname = '%s_%s' % (options.chromosome, fname)
+    
+    output_dir = os.path.join(directory, 'genetrack')
+    if not os.path.exists(output_dir):
+        os.mkdir(output_dir)
+    
+    settings = 's%de%d' % (options.sigma, options.exclusion)
+    if options.up_width:
+        settings += 'u%d' % options.up_width
+    if options.down_width:
+        settings += 'd%d' % options.down_width
+    settings += 'F%d' % options.filter
+    return os.path.join(output_dir, '%s_%s.%s' % (fname, settings, options.format))
+
+SWEEP_COLUMNS = {'sigma': 'sigma', 'exclusion': 'exclusion', 'up': 'up_width', 'down': 'down_width', 'filter': 'filter'}
+
+def read_sweep(path, input_paths, options):
+    '''
+    Reads a sweep file like config.txt: a tab separated table with a
+    header naming its columns, any of file, sigma, exclusion, up, down
+    and filter. Each row gives the settings to run on a file, and a
+    comma separated list in any column sweeps over all its values. Files
+    are relative to the sweep file, or to the working directory if only
+    there, and rows without one run on each of the input paths. Settings missing from a row are taken from the
+    options. Returns a list of (input path, list of settings) pairs, one
+    for each file in order of appearance.
+    '''
+    directory = os.path.dirname(path)
+    files = collections.OrderedDict()
+    for row in csv.DictReader(open(path, 'rt'), delimiter='\t'):
+        paths = input_paths
+        if row.get('file'):
+            fpath = row['file'].strip()
+            relative = os.path.join(directory, fpath)
+            paths = [relative if os.path.exists(relative) or not os.path.exists(fpath) else fpath]
+        columns = [column for column in row if column in SWEEP_COLUMNS and row[column] and row[column].strip()]
+        values = [[int(value) for value in row[column].split(',')] for column in columns]
+        for combination in itertools.product(*values):
+            settings = copy.copy(options)
+            for column, value in zip(columns, combination):
+                setattr(settings, SWEEP_COLUMNS[column], value)
+            for fpath in paths:
+                files.setdefault(fpath, []).append(settings)
+    return files.items()
+
+def sweep_file(path, settings, options):
+    '''
+    Runs a sweep over a list of settings on a file, reading it once and
+    writing the peaks called with each setting to its get_output_path.
+    '''
+    global WIDTH
+    WIDTH = max(setting.sigma for setting in settings) * 4
+    
+    logging.info('Sweeping file "%s" over %d settings' % (path, len(settings)))
+    if path != '-' and not os.path.exists(path):
         logging.error('Path "%s" does not exist.' % path)
         return
+    
+    writers = []
+    for setting in settings:
+        output_path = get_output_path(path if path != '-' else 'stdin', setting)
+        logging.info('Writing s=%d, e=%d peaks to "%s"' % (setting.sigma, setting.exclusion, output_path))
+        writers.append(PeakWriter(output_path, setting.format))
+    manager = get_manager(path, options.regions is not None or options.index, options.unsorted, options.sort_memory * 2 ** 20)
+    cache = get_cache(path, options)
+    tasks = ((cname, window, process_bounds, settings, cache) for cname, window, process_bounds, track_bounds in get_windows(manager, options))
+    def write(args, results):
+        for writer, peaks in zip(writers, results):
+            writer.write(args[0], *peaks)
+    try:
+        if options.processes > 1:
+            process_parallel(sweep_chromosome, tasks, write, options)
+        else:
+            for args in tasks:
+                write(args, sweep_chromosome(*args))
+    finally:
+        for writer in writers:
+            writer.close()
 
-    if options.format == 'idx':
-        writerow(('chrom', 'strand', 'start', 'end', 'value'))
-    else:
-        writerow(['##gff-version 3'])
+def validate_file(path, options):
+    '''
+    Calls peaks on a file at options.precision and at double precision,
+    writing how they differ in each chunk, and over the whole file, to
+    the output instead of the peaks. Returns True if the peaks called
+    are the same.
+    '''
+    global WIDTH
+    WIDTH = options.sigma * 4
     
-    manager = ChromosomeManager(reader)
-     
-    while not manager.done:
-        cname = manager.chromosome_name()
-        if not options.chromosome or options.chromosome == cname: # Should we process this chromosome?
-            logging.info('Loading chromosome %s' % cname)
-            data = manager.load_chromosome()
-            if not data:
-                continue
-            keys = make_keys(data)
-            lo, hi = get_range(data)
-            for chunk in get_chunks(lo, hi, size=options.chunk_size * 10 ** 6, overlap=WIDTH):
-                (slice_start, slice_end), process_bounds = chunk
-                window = get_window(data, slice_start, slice_end, keys)
-                process_chromosome(cname, window, process_bounds, options)
-            if options.chromosome: # A specific chromosome was specified. We're done, so terminate
-                break
-            #process_chromosome(cname, list(data), writer, options)
+    logging.info('Validating %s precision on file "%s"' % (options.precision, '", "'.join(input_paths(path))))
+    if not check_paths(path):
+        return False
+    
+    manager = get_manager(path, options.regions is not None or options.index, options.unsorted, options.sort_memory * 2 ** 20)
+    tasks = ((cname, window, process_bounds, options) for cname, window, process_bounds, track_bounds in get_windows(manager, options))
+    f = open(options.output, 'wt') if options.output else sys.stdout
+    f.write('chrom\tstart\tend\tpeaks\tmissing\textra\tlargest_relative_error\n')
+    totals = [0, 0, 0, 0.0]
+    def write(args, result):
+        f.write('%s\t%d\t%d\t%d\t%d\t%d\t%.3g\n' % ((args[0],) + tuple(args[2]) + result))
+        totals[:3] = [a + b for a, b in zip(totals[:3], result[:3])]
+        totals[3] = max(totals[3], result[3])
+    try:
+        if options.processes > 1:
+            process_parallel(validate_chromosome, tasks, write, options)
         else:
-            logging.info('Skipping chromosome %s' % cname)
-            manager.skip_chromosome()
+            for args in tasks:
+                write(args, validate_chromosome(*args))
+    finally:
+        f.write('total\t.\t.\t%d\t%d\t%d\t%.3g\n' % tuple(totals))
+        if f is sys.stdout:
+            f.flush()
+        else:
+            f.close()
+    return totals[1] == totals[2] == 0
+
+def get_windows(manager, options):
+    ''' Generates the (chromosome name, reads, process bounds, track bounds) work units of a
+    file, one for every chunk of every chromosome (or region) that should be processed. Reads
+    are taken from the manager a block at a time, so only the current chunk is held in memory.
+    Managers with an index seek straight to the chromosomes asked for. '''
+    regions = options.regions
+    if regions is None:
+        while not manager.done:
+            for window in get_chromosome_windows(manager, manager.chromosome_name(), None, options):
+                yield window
+    elif manager.index is not None:
+        for cname in regions:
+            if cname not in manager.index:
+                logging.warning('Chromosome %s is not in the file' % cname)
+        for cname in manager.index:
+            if cname in regions and manager.seek_chromosome(cname):
+                for window in get_chromosome_windows(manager, cname, regions[cname], options):
+                    yield window
+    else:
+        remaining = set(regions)
+        while not manager.done and remaining: # Stop once all chromosomes asked for are done
+            cname = manager.chromosome_name()
+            if cname in remaining:
+                remaining.remove(cname)
+                for window in get_chromosome_windows(manager, cname, regions[cname], options):
+                    yield window
+            else:
+                logging.info('Skipping chromosome %s' % cname)
+                manager.skip_chromosome()
+        for cname in remaining:
+            logging.warning('Chromosome %s is not in the file' % cname)
+
+def get_chromosome_windows(manager, cname, regions, options):
+    ''' Generates the work units of the chromosome the manager is at. Given a list of (first,
+    last) regions, only the chunks that overlap them are generated, with their bounds clipped
+    to the regions. The chunks are those of the whole chromosome, so the peaks and tracks of a
+    region are exactly those of the whole chromosome within it. '''
+    logging.info('Loading chromosome %s' % cname)
+    budget = get_budget(options, WIDTH)
+    size = budget.size if budget else options.chunk_size * 10 ** 6
+    blocks = manager.read_blocks()
+    read_dtype = PRECISIONS[options.precision][1]
+    if read_dtype != numpy.int:
+        blocks = (block.astype(read_dtype) for block in blocks)
+    for window, process_bounds, track_bounds in stream_chunks(blocks, size, WIDTH, budget):
+        if regions is None:
+            yield cname, window, process_bounds, track_bounds
+            continue
+        for first, last in regions:
+            clipped_track = (max(track_bounds[0], first), min(track_bounds[1], last + 1))
+            if clipped_track[0] < clipped_track[1]:
+                yield cname, window, (max(process_bounds[0], first - 1), min(process_bounds[1], last + 1)), clipped_track
     
 usage = '''
 input_paths may be:
 
-    - a file to run on
+    - a file to run on, which may be gzip or BGZF compressed
+    - a binary index created with idxtobin.py
     - "-" to run on standard input
+    - several of these, sorted the same way, to pool their reads (sweeps run on each separately)
 
 example usage:
 
     python genetrack.py -s 10 /path/to/a/file.txt
     python genetrack.py -s 5 -e 50 -
+    python genetrack.py -s 5 /path/to/rep1.txt /path/to/rep2.txt
+    python genetrack.py -S config.txt /path/to/a/file.txt
 '''.lstrip()
  
 # We must override the help formatter to force it to obey our newlines in our custom description
@@ -472,13 +2294,45 @@ def run():
     parser.add_option('-F', action='store', type='int', dest='filter', default='3',
                       help='Absolute read filter; outputs only peaks with larger peak height. Default %default. ')
     parser.add_option('-c', action='store', type='string', dest='chromosome', default='',
-                      help='Chromosome (ex chr11) to limit to. Default process all.')
+                      help='Chromosome (ex chr11) to limit to, or a comma separated list of them, each optionally limited to a range of indexes (ex chr11:10000-20000). Default process all.')
+    parser.add_option('-r', action='store', type='string', dest='region_file', default='',
+                      help='BED file of regions to limit to. Default process all.')
+    parser.add_option('--index', action='store_true', dest='index',
+                      help='Index text inputs to seek to their chromosomes, so pooled inputs may list them in any order. Default only with -c or -r.')
     parser.add_option('-k', action='store', type='int', dest='chunk_size', default=10,
-                      help='Size, in millions of base pairs, to chunk each chromosome into when processing. Each 1 million size uses approximately 20MB of memory. Default %default.')
+                      help='Size, in millions of base pairs, to chunk each chromosome into when processing. Each 1 million size uses approximately 50MB of memory, more where reads are dense. Default %default.')
+    parser.add_option('--max-memory', action='store', type='int', dest='max_memory', default=0,
+                      help='Memory, in MB, for all processes together. Chunks are made as large as fits, up to the -k size, and shrunk where reads are dense. Default no limit.')
     parser.add_option('-o', action='store', type='string', dest='format', default='gff',
-                      help='Output format for called peaks. Valid formats are gff and txt. Default %default.')
+                      help='Output format for called peaks. Valid formats are gff, txt and bed. Default %default.')
+    parser.add_option('-O', action='store', type='string', dest='output', default='',
+                      help='File to write called peaks to. Default writes to standard output.')
     parser.add_option('-b', action='store_true', dest='bedgraph', help='Output bed graph tracks.')
+    parser.add_option('-B', action='store_true', dest='binary_track',
+                      help='Output binary tracks (forward.gtt and reverse.gtt), indexed by chromosome and zoom level.')
+    parser.add_option('-q', action='store', type='float', dest='track_step', default=0,
+                      help='Round track values to multiples of this step, so that more bases merge into one interval. Default 0 (no rounding).')
+    parser.add_option('-p', '--processes', action='store', type='int', dest='processes', default=1,
+                      help='Number of processes to call peaks with, each working on one chunk at a time. Default %default.')
 
+    parser.add_option('--unsorted', action='store_true', dest='unsorted',
+                      help='Accept reads in any order, sorting them by chromosome and index before processing.')
+    parser.add_option('--sort-memory', action='store', type='int', dest='sort_memory', default=SORT_MEMORY,
+                      help='Size, in MB, of the reads --unsorted holds in memory before writing them to temporary files. Default %default.')
+    parser.add_option('-S', action='store', type='string', dest='sweep', default='',
+                      help='Sweep file like config.txt listing the settings to call peaks with. Each input is read and smoothed once for all of them, and the peaks of each setting are written to their own file.')
+    parser.add_option('-C', action='store', type='string', dest='cache_dir', default='',
+                      help='Directory to cache smoothed reads in, so runs on the same file with the same sigma skip smoothing. Default no cache.')
+    parser.add_option('--cache-size', action='store', type='int', dest='cache_size', default=4096,
+                      help='Size, in MB, the cache is kept within by removing the least recently used reads. Default %default.')
+    parser.add_option('--stats', action='store', type='string', dest='stats', default='',
+                      help='File to write JSON statistics to: the wall and CPU time of each stage, the reads, peaks, array size and peak memory of every chunk, and their totals. Default none.')
+    parser.add_option('--profile', action='store', type='string', dest='profile', default='',
+                      help='File to write cProfile statistics of the main process to, for reading with pstats. Default none.')
+    parser.add_option('--precision', action='store', type='choice', dest='precision', default='double', choices=sorted(PRECISIONS),
+                      help='Precision of the smoothed reads, double or single. Single halves the memory of the arrays, and of the reads by storing them as 32 bit integers. Default %default.')
+    parser.add_option('--validate', action='store_true', dest='validate',
+                      help='Instead of writing peaks, write how the peaks called at --precision differ from those called at double precision in each chunk. Exits with status 1 if they differ.')
     parser.add_option('-v', action='store_true', dest='verbose', help='Verbose mode: displays debug messages.')
  
     (options, args) = parser.parse_args()
@@ -488,23 +2342,67 @@ def run():
     else:
         logging.getLogger().setLevel(logging.ERROR)
 
-    if options.format not in ['gff','txt']:
+    if options.format not in OUTPUT_LINES:
         parser.error('%s is not a valid format. Use -h option for a list of valid methods.' % options.format)
+
+    if options.processes < 1:
+        parser.error('The number of processes must be at least 1.')
+
+    if options.region_file and not os.path.exists(options.region_file):
+        parser.error('Region file %s does not exist.' % options.region_file)
+    try:
+        options.regions = parse_regions(options.chromosome, options.region_file)
+    except ValueError, e:
+        parser.error(str(e))
+
+    if options.max_memory:
+        try:
+            get_budget(options, options.sigma * 4) # Sweeps check their largest sigma when they start
+        except ValueError, e:
+            parser.error(str(e))
                 
+    if options.sweep:
+        if not os.path.exists(options.sweep):
+            parser.error('Sweep file %s does not exist.' % options.sweep)
+        if options.stats:
+            parser.error('Statistics are not kept for sweeps.')
+        if options.validate:
+            parser.error('Sweeps cannot be validated, run each setting with --validate instead.')
+        if options.output or options.bedgraph or options.binary_track:
+            parser.error('Sweeps write the peaks of each setting to a file of its own, and no tracks, so -O, -b and -B cannot be given.')
+        for path, settings in read_sweep(options.sweep, args, options):
+            profile(sweep_file, options)(path, settings, options)
+        return
+    
     if not args:
         parser.print_help()
         sys.exit(1)
 
-    if len(args) > 1:
-        parser.error('Only one file can be processed at a time.')
+    if args.count('-') > 1:
+        parser.error('Standard input can only be read once.')
         
-    path = args[0]
+    path = args[0] if len(args) == 1 else args # Several inputs are pooled
 
-    process_file(path, options)
+    if options.validate:
+        if not profile(validate_file, options)(path, options):
+            sys.exit(1)
+        return
 
+    profile(process_file, options)(path, options)
+
+def profile(function, options):
+    ''' Returns function wrapped to write cProfile statistics to the --profile file, if given '''
+    if not options.profile:
+        return function
+    import cProfile
+    def profiled(*args):
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(function, *args)
+        finally:
+            profiler.dump_stats(options.profile)
+    return profiled
             
 if __name__ == '__main__':
     run()
-    #import cProfile
-    #cProfile.run('run()', 'profilev8.bin')
             
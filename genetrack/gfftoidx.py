@@ -19,11 +19,14 @@ from optparse import OptionParser, IndentedHelpFormatter
 
 logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO)
 
-from genetrack import ChromosomeManager
+from genetrack import get_manager, COMPRESSED_EXTENSIONS, INDEX_EXTENSION
 
 def get_output_path(input_path, options):
     directory, fname = os.path.split(input_path)
     
+    for extension in COMPRESSED_EXTENSIONS:
+        if fname.endswith(extension):
+            fname = fname[:-len(extension)]
     fname = ''.join(fname.split('.')[:-1]) # Strip extension (will be re-added as appropriate)
     
     output_dir = os.path.join(directory, 'gfftoidx')
@@ -38,18 +41,17 @@ def process_file(path, options):
     
     output_path = get_output_path(path, options)
     
-    reader = csv.reader(open(path,'rU'), delimiter='\t')
     writer = csv.writer(open(output_path, 'wt'), delimiter='\t')
     writer.writerow(['chrom', 'index', 'forward', 'reverse'])
     
-    manager = ChromosomeManager(reader)
+    manager = get_manager(path)
 
     while not manager.done:
         cname = manager.chromosome_name()
         logging.info('Processing chromosome %s' % cname)
         data = manager.load_chromosome()
         for read in data:
-            writer.writerow([cname] + read)
+            writer.writerow([cname] + list(read))
         
 usage = '''
 input_paths may be:
@@ -87,7 +89,7 @@ def run():
         if os.path.isdir(path):
             for fname in os.listdir(path):
                 fpath = os.path.join(path, fname)
-                if os.path.isfile(fpath) and not fname.startswith('.') and not fname.endswith('.gff'):
+                if os.path.isfile(fpath) and not fname.startswith('.') and not fname.endswith('.gff') and not fname.endswith(INDEX_EXTENSION):
                     process_file(fpath, options)
         else:
             process_file(path, options)
@@ -0,0 +1,91 @@
+# idxtobin.py
+#
+# Converts reads to the binary index format read by genetrack.py
+#
+# DEPENDENCY: genetrack.py must be in same directory
+#
+# Input: reads in any format genetrack.py accepts (.idx, .bed or .gff)
+#
+# Output: .bidx binary index
+# Format: per-chromosome int32 (index, + reads, - reads) rows followed by a table of
+# chromosome names, offsets and index ranges; see BinaryChromosomeManager in genetrack.py.
+# genetrack.py memory-maps these files, so re-running it with other parameters skips parsing.
+#
+# Run with no arguments or -h for usage and command line options
+
+import os, logging, sys
+from optparse import OptionParser, IndentedHelpFormatter
+
+logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO)
+
+from genetrack import get_manager, write_binary_index, INDEX_EXTENSION
+
+def get_output_path(input_path, options):
+    directory, fname = os.path.split(input_path)
+    
+    fname = ''.join(fname.split('.')[:-1]) # Strip extension (will be re-added as appropriate)
+    
+    output_dir = os.path.join(directory, 'idxtobin')
+    if not os.path.exists(output_dir):
+        os.mkdir(output_dir)
+
+    return os.path.join(output_dir, '%s.bidx' % fname)
+
+
+def process_file(path, options):
+    logging.info('Processing file "%s"' % path)
+    
+    output_path = get_output_path(path, options)
+    
+    manager = get_manager(path)
+    f = open(output_path, 'wb')
+    write_binary_index(manager, f)
+    f.close()
+    logging.info('Wrote "%s"' % output_path)
+        
+usage = '''
+input_paths may be:
+- a file or list of files to run on
+- a directory or list of directories to run on all files in them
+- "." to run in the current directory
+'''.lstrip()
+
+
+ 
+# We must override the help formatter to force it to obey our newlines in our custom description
+class CustomHelpFormatter(IndentedHelpFormatter):
+    def format_description(self, description):
+        return description
+        
+def run():   
+    parser = OptionParser(usage='%prog [options] input_paths', description=usage, formatter=CustomHelpFormatter())
+    parser.add_option('-v', action='store_true', dest='verbose', help='Verbose mode: displays debug messages')
+    parser.add_option('-q', action='store_true', dest='quiet', help='Quiet mode: suppresses all non-error messages')
+    (options, args) = parser.parse_args()
+    
+    
+    if options.verbose:
+        logging.getLogger().setLevel(logging.DEBUG) # Show all info/debug messages
+    if options.quiet:
+        logging.getLogger().setLevel(logging.ERROR) # Silence all non-error messages
+        
+    if not args:
+        parser.print_help()
+        sys.exit(1)
+        
+    for path in args:
+        if not os.path.exists(path):
+            parser.error('Path %s does not exist.' % path)
+        if os.path.isdir(path):
+            for fname in os.listdir(path):
+                fpath = os.path.join(path, fname)
+                if os.path.isfile(fpath) and not fname.startswith('.') and not fname.endswith('.bidx') and not fname.endswith(INDEX_EXTENSION):
+                    process_file(fpath, options)
+        else:
+            process_file(path, options)
+            
+     
+
+if __name__ == '__main__':       
+    run()
+    
@@ -1,67 +1,275 @@
-from optparse import OptionParser, IndentedHelpFormatter
-import csv, os, sys, subprocess, shutil, threading, logging, tempfile
+"""
+multiprocess.py
 
-from genetrack import get_output_path, ChromosomeManager
+Calls peaks on many files at once, the way genetrack.py calls them on each
 
-def shellquote(s):
-    return "'" + s.replace("'", "'\\''") + "'"
+Run with no arguments or -h for usage and command line options
 
+Input: files in any format genetrack.py reads, or directories of them
 
-class ProcessFileThread(threading.Thread):
-    semaphore = threading.Semaphore(1)
-    def __init__(self, command):
-        threading.Thread.__init__(self)
-        self.command = command
+Output: the peaks of each file, in the output file genetrack.py would write for it
+
+Example:
+
+    python multiprocess.py -p 4 -s 10 /path/to/a/data/directory/
+
+Exits with status 1 if the peaks of any file could not be called.
+"""
+
+from optparse import OptionParser, IndentedHelpFormatter, Values
+import os, sys, shutil, logging, tempfile, multiprocessing, threading, heapq, itertools, Queue
+import numpy
+
+import genetrack
+from genetrack import (get_output_path, get_manager, get_chromosome_windows, is_binary_index, process_chromosome,
+                       BinaryChromosomeManager, PeakWriter, READ_BYTES)
+
+class TaskError(Exception):
+    ''' The exception a task raised in a worker, sent back as its result '''
+    pass
+
+def run_task(function, args):
+    ''' Runs a task in a worker. An exception is returned as a TaskError rather than raised, so
+    that the pool calls back for failed tasks too. '''
+    try:
+        return function(*args)
+    except Exception, e:
+        return TaskError('%s %s' % (e.__class__.__name__, e))
+
+class Scheduler(object):
+    '''
+    Runs tasks on a pool of worker processes, largest first. A task is
+    only handed to the pool when a worker is free for it, so tasks added
+    while others run (by callbacks) still go ahead of smaller ones added
+    before them. The workers are started once and kept for all tasks.
+    Each task's callback is called in the main process with its result,
+    or with a TaskError if it failed. Feeds add items from other threads,
+    calling back in the main process with each of them, then with None.
+    '''
+    def __init__(self, processes):
+        self.pool = multiprocessing.Pool(processes)
+        self.processes = processes
+        self.queued = [] # Heap of (-size, order added, function, args, callback)
+        self.order = itertools.count()
+        self.running = 0
+        self.waiting = 0 # Running tasks and feeds not yet ended
+        self.events = Queue.Queue()
+    
+    def add(self, size, function, args, callback):
+        heapq.heappush(self.queued, (-size, next(self.order), function, args, callback))
+    
+    def feed(self, items, callback):
+        ''' Calls back with each item of an iterator, which is read on a thread of its own '''
+        def read():
+            for item in items:
+                self.events.put(('item', callback, item))
+            self.events.put(('end', callback, None))
+        thread = threading.Thread(target=read)
+        thread.daemon = True
+        thread.start()
+        self.waiting += 1
+    
     def run(self):
-        ProcessFileThread.semaphore.acquire()
-        p = subprocess.Popen(self.command, shell=True)
-        p.wait()
-        ProcessFileThread.semaphore.release()
+        ''' Runs the tasks until all are done and all feeds have ended '''
+        while self.queued or self.waiting:
+            while self.queued and self.running < self.processes:
+                size, order, function, args, callback = heapq.heappop(self.queued)
+                done = lambda result, callback=callback: self.events.put(('task', callback, result))
+                self.pool.apply_async(run_task, (function, args), callback=done)
+                self.running += 1
+                self.waiting += 1
+            kind, callback, value = self.events.get()
+            if kind != 'item':
+                self.waiting -= 1
+            if kind == 'task':
+                self.running -= 1
+            callback(value)
+    
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+    
+    def terminate(self):
+        self.pool.terminate()
+        self.pool.join()
+
+def read_files(paths, temp_dir, queue):
+    '''
+    The reader stage, run in a process of its own. Reads the files in
+    turn, a chromosome at a time, putting each chromosome on the queue
+    as ('chromosome', file number, number in the file, name, reads path,
+    size in bytes, read size) as soon as it is saved to a .npy file in
+    temp_dir, where the
+    workers memory map it. The chromosomes of binary indexes are mapped
+    from the index itself. After the chromosomes of a file it puts
+    ('file', file number, chromosome count, whether it failed), and
+    None at the end. The queue is bounded, so reading waits for the
+    chromosomes read earlier to be taken.
+    '''
+    for number, path in enumerate(paths):
+        count = 0
+        try:
+            logging.info('Reading file "%s"' % path)
+            manager = get_manager(path)
+            while not manager.done:
+                cname = manager.chromosome_name()
+                if isinstance(manager, BinaryChromosomeManager):
+                    reads_path, size = path, manager.chromosomes[manager.current][2] * READ_BYTES
+                    manager.skip_chromosome()
+                else:
+                    handle, reads_path = tempfile.mkstemp('.npy', dir=temp_dir)
+                    f = os.fdopen(handle, 'wb')
+                    data = manager.load_chromosome()
+                    numpy.save(f, data)
+                    f.close()
+                    size = data.nbytes
+                queue.put(('chromosome', number, count, cname, reads_path, size, genetrack.readsize))
+                count += 1
+        except Exception, e:
+            logging.error('Could not read "%s": %s %s' % (path, e.__class__.__name__, e))
+            queue.put(('file', number, count, True))
+            continue
+        queue.put(('file', number, count, False))
+    queue.put(None)
 
+def read_queue(queue, ahead):
+    ''' Generates the items of a queue until None. A slot of the ahead semaphore is taken for
+    each item, and released once its chromosome is done, so at most that many are read ahead. '''
+    while True:
+        ahead.acquire()
+        item = queue.get()
+        if item is None:
+            return
+        yield item
 
-def process_file(fpath, options):
-    options.chromosome = ''
+class LoadedChromosome(object):
+    ''' Stands in for a chromosome manager at a chromosome already loaded '''
+    def __init__(self, reads):
+        self.reads = reads
     
-    manager = ChromosomeManager(csv.reader(open(fpath, 'rU'), delimiter='\t'))
-    inputs = []
-    outputs = []
-    threads = []
-    genetrack_path = os.path.join(os.path.dirname(__file__), 'genetrack.py')
+    def read_blocks(self):
+        yield self.reads
+
+def call_chromosome(path, cname, options):
+    ''' Calls the peaks of a chromosome in chunks, as genetrack.py does, from its reads saved
+    by read_files, or from a binary index. The reads are views of a memory map, shared with the
+    other workers. Returns the forward and reverse tables of peaks of each chunk. '''
+    genetrack.WIDTH = options.sigma * 4
+    if is_binary_index(path):
+        manager = BinaryChromosomeManager(path)
+        manager.seek_chromosome(cname)
+    else:
+        manager = LoadedChromosome(numpy.load(path, mmap_mode='r'))
+    return [process_chromosome(cname, window, process_bounds, options, track_bounds)[0]
+            for cname, window, process_bounds, track_bounds in get_chromosome_windows(manager, cname, None, options)]
+
+class FileWriter(object):
+    '''
+    The writer stage of one file. Writes the peaks of its chromosomes
+    in file order, each as soon as it and all chromosomes before it are
+    called, to the output file of the file. If reading the file or
+    calling any of its chromosomes fails, the output file is removed.
+    '''
+    def __init__(self, path, options):
+        self.path = path
+        self.options = options
+        self.results = {}
+        self.written = 0
+        self.count = None # Chromosomes in the file, once all are read
+        self.readsize = 0
+        self.writer = None
+        self.failed = False
+    
+    def add(self, i, cname, result):
+        if isinstance(result, TaskError):
+            logging.error('Could not process chromosome %s of "%s": %s' % (cname, self.path, result))
+            self.failed = True
+        self.results[i] = cname, result
+        self.write()
+    
+    def end(self, count, failed):
+        self.count = count
+        self.failed = self.failed or failed
+        self.write()
+    
+    def write(self):
+        while not self.failed and self.written in self.results:
+            cname, chunks = self.results.pop(self.written)
+            if self.writer is None:
+                self.writer = PeakWriter(get_output_path(self.path, self.options), self.options.format)
+            genetrack.readsize = self.readsize # The gff output shifts reverse peaks by the read size
+            for forward_peaks, reverse_peaks in chunks:
+                self.writer.write(cname, forward_peaks, reverse_peaks)
+            self.written += 1
+        if self.written == self.count or (self.failed and self.count is not None and len(self.results) == self.count - self.written):
+            self.close()
+    
+    def close(self):
+        if self.failed:
+            if self.writer:
+                self.writer.close()
+                os.unlink(get_output_path(self.path, self.options))
+            return
+        if self.writer is None: # No chromosomes
+            self.writer = PeakWriter(get_output_path(self.path, self.options), self.options.format)
+        logging.info('Wrote peaks of "%s"' % self.path)
+        self.writer.close()
+
+def get_settings(options):
+    ''' Returns the options genetrack.py would call peaks with, given those multiprocess.py takes '''
+    return Values(dict(options.__dict__, chromosome='', regions=None, precision='double', max_memory=0,
+                       bedgraph=False, binary_track=False, track_step=0))
+
+def process_files(paths, options):
+    '''
+    Calls the peaks of all files as a pipeline. A reader process reads
+    the chromosomes of the files in turn, at most options.queue_depth
+    ahead of those whose peaks are written. Each one read is queued for
+    the pool of options.processes workers, the largest queued first, and
+    its peaks are written in order by the FileWriter of its file.
+    Returns whether any file failed.
+    '''
+    settings = get_settings(options)
     temp_dir = tempfile.mkdtemp()
-    logging.info('Preparing file "%s"' % fpath)
-    while not manager.done:
-        name = manager.chromosome_name()
-        logging.info('Preparing chromosome %s' % name)
-        data = manager.load_chromosome()
-        input_name = os.path.join(temp_dir, name + '.txt')
-        f = open(input_name, 'wt')
-        writer = csv.writer(f, delimiter='\t')
-        for read in data:
-            writer.writerow([name] + read)
-        f.close()
-        inputs.append(input_name)
-    # Process each chromosome
-    for input in inputs:
-        c = 'python %s %s -s %d -e %d -u %d -d %d -k %d -F %d -o %s' % (
-            genetrack_path, input, options.sigma, options.exclusion, options.up_width, options.down_width, options.chunk_size,
-            options.filter, options.format)
-        t = ProcessFileThread(c)
-        t.start()
-        threads.append(t)
-        output_path = get_output_path(input, options)
-        outputs.append(output_path)
-    # Wait for completion
-    for thread in threads:
-        thread.join()
-    # Merge together output files
-    logging.info('Merging output files')
-    options.chromosome = ''
-    real_output = open(get_output_path(fpath, options), 'wt')
-    for output in outputs:
-        shutil.copyfileobj(open(output, 'rt'), real_output)
-        os.unlink(output)
-    real_output.close()
-    shutil.rmtree(temp_dir)
+    queue = multiprocessing.Queue(1)
+    reader = multiprocessing.Process(target=read_files, args=(paths, temp_dir, queue))
+    reader.daemon = True
+    reader.start()
+    ahead = threading.Semaphore(options.queue_depth or 2 * options.processes)
+    writers = [FileWriter(path, settings) for path in paths]
+    scheduler = Scheduler(options.processes)
+    
+    def called(item, result):
+        kind, number, i, cname, reads_path, size, readsize = item
+        if reads_path != paths[number]:
+            os.unlink(reads_path)
+        ahead.release()
+        writers[number].add(i, cname, result)
+    
+    def read(item):
+        if item is None:
+            return
+        if item[0] == 'file':
+            kind, number, count, failed = item
+            ahead.release()
+            writers[number].end(count, failed)
+            return
+        kind, number, i, cname, reads_path, size, readsize = item
+        writers[number].readsize = readsize
+        scheduler.add(size, call_chromosome, (reads_path, cname, settings), lambda result: called(item, result))
+    
+    try:
+        scheduler.feed(read_queue(queue, ahead), read)
+        scheduler.run()
+    except:
+        scheduler.terminate()
+        reader.terminate()
+        raise
+    finally:
+        shutil.rmtree(temp_dir)
+    scheduler.close()
+    reader.join()
+    return any(writer.failed for writer in writers)
     
            
 usage = '''
@@ -71,9 +279,9 @@ input_paths may be:
 - "." to run in the current directory
 
 example usages:
-python genetrack.py -s 10 /path/to/a/file.txt path/to/another/file.txt
-python genetrack.py -s 5 -e 50 /path/to/a/data/directory/
-python genetrack.py .
+python multiprocess.py -s 10 /path/to/a/file.txt path/to/another/file.txt
+python multiprocess.py -s 5 -e 50 /path/to/a/data/directory/
+python multiprocess.py -p 4 .
 '''.lstrip()
 
 # We must override the help formatter to force it to obey our newlines in our custom description
@@ -99,24 +307,32 @@ def run():
                       help='Output format for called peaks. Valid formats are gff (default) and txt.')
     parser.add_option('-p', action='store', type='int', dest='processes', default=1,
                       help='Number of processes to run concurrently')
+    parser.add_option('--queue-depth', action='store', type='int', dest='queue_depth', default=0,
+                      help='Number of chromosomes to read ahead of those being processed and written. Default twice the number of processes.')
     (options, args) = parser.parse_args()
     
-    ProcessFileThread.semaphore = threading.Semaphore(options.processes)
-
     if not args:
         parser.print_help()
         sys.exit(1)
+
+    if options.processes < 1:
+        parser.error('The number of processes must be at least 1.')
+    if options.queue_depth < 0:
+        parser.error('The queue depth cannot be negative.')
         
+    paths = []
     for path in args:
         if not os.path.exists(path):
             parser.error('Path %s does not exist.' % path)
         if os.path.isdir(path):
             for fname in os.listdir(path):
                 fpath = os.path.join(path, fname)
-                if os.path.isfile(fpath) and not fname.startswith('.'): 
-                    process_file(fpath, options)
+                if os.path.isfile(fpath) and not fname.startswith('.') and not fname.endswith(genetrack.INDEX_EXTENSION):
+                    paths.append(fpath)
         else:
-            process_file(path, options)
+            paths.append(path)
+    if process_files(paths, options):
+        sys.exit(1)
             
 if __name__ == '__main__':
     run()
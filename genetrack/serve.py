@@ -0,0 +1,385 @@
+# serve.py
+#
+# Serves peaks and smoothed tracks of regions of samples held in memory, over HTTP
+#
+# DEPENDENCY: genetrack.py must be in same directory
+#
+# Input: samples in any format genetrack.py accepts, loaded once when the server starts
+#
+# Output: JSON (or peak lines in a genetrack.py output format) for each query:
+#
+#   /samples                                   the samples, their chromosomes and the cache statistics
+#   /peaks?sample=rep1&region=chr1:1000-2000   the peaks of a region, called with the settings given as
+#                                              sigma, exclusion, up, down, filter and precision parameters,
+#                                              and written as format (json, gff, txt or bed)
+#   /track?sample=rep1&region=chr1:1000-2000   the smoothed track of a region as (start, end, value) runs,
+#                                              with the sigma, precision and step parameters
+#
+# The smoothed reads of the last regions asked for are kept in memory, so asking for the same region
+# with other exclusion zones, widths or filters only calls the peaks again.
+#
+# Run with no arguments or -h for usage and command line options
+
+from optparse import OptionParser, IndentedHelpFormatter, Values
+import os, sys, logging, json, time, math, urllib, urllib2, urlparse, collections
+import BaseHTTPServer
+import numpy
+
+logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO)
+
+import genetrack
+from genetrack import (get_manager, check_paths, input_paths, make_keys, get_window, smooth_reads, call_strands, get_runs,
+                       format_peaks, PEAK_DTYPE, PEAK_SETTINGS, PRECISIONS, OUTPUT_LINES)
+
+# Query parameters giving the peak settings, named as the columns of a sweep file
+QUERY_SETTINGS = {'sigma': 'sigma', 'exclusion': 'exclusion', 'up': 'up_width', 'down': 'down_width', 'filter': 'filter'}
+
+class QueryError(Exception):
+    ''' A query that cannot be answered, with the HTTP status to answer it with '''
+    def __init__(self, message, status=400):
+        Exception.__init__(self, message)
+        self.status = status
+
+class Sample(object):
+    '''
+    The reads of a file, or of files pooled, loaded into memory as one
+    array of (index, forward count, reverse count) rows per chromosome.
+    Binary indexes stay memory mapped.
+    '''
+    def __init__(self, name, path, unsorted=False):
+        self.name = name
+        self.paths = input_paths(path)
+        self.chromosomes = collections.OrderedDict()
+        logging.info('Loading sample %s' % name)
+        genetrack.readsize = 0
+        manager = get_manager(path, unsorted=unsorted)
+        while not manager.done:
+            cname = manager.chromosome_name()
+            data = manager.load_chromosome()
+            if len(data):
+                self.chromosomes[cname] = (data, make_keys(data))
+        self.readsize = genetrack.readsize
+
+    def get_window(self, cname, start, end):
+        ''' Returns the reads of a chromosome with index between start and end '''
+        if cname not in self.chromosomes:
+            raise QueryError('Chromosome %s is not in sample %s' % (cname, self.name), 404)
+        data, keys = self.chromosomes[cname]
+        return get_window(data, start, end, keys)
+
+    def clip(self, cname, bounds):
+        ''' Clips process bounds to the first and last index of a chromosome's reads, as
+        genetrack.py clips its chunks '''
+        data, keys = self.chromosomes[cname]
+        return max(bounds[0], int(keys[0])), min(bounds[1], int(keys[-1]))
+
+    def describe(self):
+        return {'paths': self.paths, 'readsize': self.readsize,
+                'chromosomes': [{'name': cname, 'first': int(data[0, 0]), 'last': int(data[-1, 0]), 'rows': len(data)}
+                                for cname, (data, keys) in self.chromosomes.items()]}
+
+class RegionCache(object):
+    '''
+    Holds the smoothed reads of the regions queried last, up to limit
+    bytes, removing the least recently used first. Entries are keyed by
+    sample, chromosome, region, sigma and precision, and hold the reads
+    of the region (and width past it) and both smoothed arrays.
+    '''
+    def __init__(self, limit):
+        self.limit = limit
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.hits = self.misses = 0
+
+    def get(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries[key] = entry # Now the most recently used
+        self.hits += 1
+        return entry
+
+    def add(self, key, entry):
+        window, (forward_array, forward_shift), (reverse_array, reverse_shift) = entry
+        size = window.nbytes + forward_array.nbytes + reverse_array.nbytes
+        if size > self.limit:
+            return
+        self.entries[key] = entry + (size,)
+        self.size += size
+        while self.size > self.limit:
+            key, evicted = self.entries.popitem(last=False)
+            logging.debug('Evicting %s:%s:%d-%d sigma %d (%s) from the region cache' % key)
+            self.size -= evicted[-1]
+
+    def describe(self):
+        return {'entries': len(self.entries), 'bytes': self.size, 'limit': self.limit, 'hits': self.hits, 'misses': self.misses}
+
+def parse_region(region):
+    ''' Parses a chromosome:first-last region, returning the chromosome name, first and last index '''
+    cname, sep, span = (region or '').partition(':')
+    try:
+        first, last = [int(value) for value in span.split('-')]
+    except ValueError:
+        raise QueryError('Could not read region "%s". Use chromosome:first-last.' % region)
+    if first > last:
+        raise QueryError('Region %s is empty' % region)
+    return cname, first, last
+
+def parse_settings(query):
+    ''' Returns the peak settings of a query, as an options object. Settings not given take the
+    defaults of the command line. '''
+    settings = dict(PEAK_SETTINGS)
+    for name, value in query.items():
+        if name in QUERY_SETTINGS:
+            try:
+                settings[QUERY_SETTINGS[name]] = int(value)
+            except ValueError:
+                raise QueryError('%s must be an integer' % name)
+    settings['precision'] = query.get('precision', settings['precision'])
+    if settings['precision'] not in PRECISIONS:
+        raise QueryError('precision must be one of %s' % ', '.join(sorted(PRECISIONS)))
+    if settings['sigma'] < 1:
+        raise QueryError('sigma must be at least 1')
+    for name in ('exclusion', 'up', 'down'):
+        if settings[QUERY_SETTINGS[name]] < 0:
+            raise QueryError('%s must be at least 0' % name)
+    return Values(settings)
+
+class RegionServer(object):
+    '''
+    Answers queries on the samples it holds. Each query is a dict of the
+    parameters of a request, and the answers are the JSON documents the
+    HTTP server sends, or text for peaks in a genetrack.py output format.
+    The peaks of a region are those genetrack.py calls on a chunk of
+    exactly that region, from the reads within 4 sigma of it, so they
+    are the peaks genetrack.py -c calls on it unless one of its chunks
+    ends within the exclusion zone of the region's ends.
+    '''
+    def __init__(self, samples, cache_size):
+        self.samples = collections.OrderedDict((sample.name, sample) for sample in samples)
+        self.cache = RegionCache(cache_size)
+
+    def get_sample(self, query):
+        name = query.get('sample') or (self.samples.keys()[0] if len(self.samples) == 1 else None)
+        if name not in self.samples:
+            raise QueryError('Unknown sample "%s". Samples are %s.' % (name, ', '.join(self.samples)), 404)
+        return self.samples[name]
+
+    def smooth(self, sample, cname, first, last, sigma, precision):
+        ''' Returns the reads around a region and their smoothed arrays, from the cache if
+        they are in it, and whether they were '''
+        key = (sample.name, cname, first, last, sigma, precision)
+        entry = self.cache.get(key)
+        if entry is not None:
+            return entry[:3], True
+        width = sigma * 4
+        read_dtype, dtype = PRECISIONS[precision][1], PRECISIONS[precision][0]
+        window = sample.get_window(cname, first - 1 - width, last + 1 + width).astype(read_dtype)
+        if not len(window):
+            return None, False
+        entry = (window,) + smooth_reads(window, width, sigma, dtype=dtype)
+        self.cache.add(key, entry)
+        return entry, False
+
+    def peaks(self, query):
+        sample = self.get_sample(query)
+        cname, first, last = parse_region(query.get('region'))
+        settings = parse_settings(query)
+        format = query.get('format', 'json')
+        if format != 'json' and format not in OUTPUT_LINES:
+            raise QueryError('format must be json or one of %s' % ', '.join(sorted(OUTPUT_LINES)))
+
+        start = time.time()
+        entry, cached = self.smooth(sample, cname, first, last, settings.sigma, settings.precision)
+        if entry is None:
+            peaks = numpy.zeros(0, PEAK_DTYPE), numpy.zeros(0, PEAK_DTYPE)
+        else:
+            window, (forward_array, forward_shift), (reverse_array, reverse_shift) = entry
+            bounds = sample.clip(cname, (first - 1, last + 1))
+            peaks = call_strands(window, forward_array, forward_shift, reverse_array, reverse_shift, bounds, settings)
+        if format != 'json':
+            genetrack.readsize = sample.readsize # The gff output shifts reverse peaks by the read size
+            return ''.join(format_peaks(cname, strand, table, format) for strand, table in zip('+-', peaks))
+        return {'sample': sample.name, 'chromosome': cname, 'first': first, 'last': last, 'cached': cached,
+                'seconds': time.time() - start, 'settings': settings.__dict__,
+                'forward': table_rows(peaks[0]), 'reverse': table_rows(peaks[1])}
+
+    def track(self, query):
+        sample = self.get_sample(query)
+        cname, first, last = parse_region(query.get('region'))
+        settings = parse_settings(query)
+        try:
+            step = float(query.get('step', 0))
+        except ValueError:
+            raise QueryError('step must be a number')
+
+        start = time.time()
+        entry, cached = self.smooth(sample, cname, first, last, settings.sigma, settings.precision)
+        runs = [[], []]
+        if entry is not None:
+            window, (forward_array, forward_shift), (reverse_array, reverse_shift) = entry
+            forward_runs = get_runs(forward_array, forward_shift, (first, last + 1), True, step)
+            reverse_runs = get_runs(reverse_array, reverse_shift, (first, last + 1), False, step)
+            reverse_runs['start'] += sample.readsize
+            reverse_runs['end'] += sample.readsize
+            runs = [runs.tolist() for runs in (forward_runs, reverse_runs)]
+        return {'sample': sample.name, 'chromosome': cname, 'first': first, 'last': last, 'cached': cached,
+                'seconds': time.time() - start, 'forward': runs[0], 'reverse': runs[1]}
+
+    def describe(self, query):
+        return {'samples': dict((name, sample.describe()) for name, sample in self.samples.items()),
+                'cache': self.cache.describe()}
+
+    def answer(self, path, query):
+        ''' Answers a query on one of the paths /samples, /peaks and /track '''
+        handlers = {'/samples': self.describe, '/peaks': self.peaks, '/track': self.track}
+        if path not in handlers:
+            raise QueryError('Unknown path %s. Use /samples, /peaks or /track.' % path, 404)
+        return handlers[path](query)
+
+def table_rows(table):
+    ''' Returns the rows of a table as dicts of its columns, to send as JSON. Values that are
+    not finite, such as the nan deviation of a peak without reads, have no JSON form and are
+    sent as null. '''
+    names = table.dtype.names
+    return [dict(zip(names, map(json_value, row))) for row in table.tolist()]
+
+def json_value(value):
+    ''' Returns a value, or None if it is a float that is not finite '''
+    if isinstance(value, float) and (math.isnan(value) or math.isinf(value)):
+        return None
+    return value
+
+class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    ''' Passes GET requests to the RegionServer of the HTTP server '''
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        query = dict(urlparse.parse_qsl(url.query))
+        try:
+            answer = self.server.regions.answer(url.path, query)
+            status = 200
+        except QueryError, e:
+            answer, status = {'error': str(e)}, e.status
+        if isinstance(answer, basestring):
+            body, content_type = answer, 'text/plain'
+        else:
+            body, content_type = json.dumps(answer), 'application/json'
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug('%s %s' % (self.address_string(), format % args))
+
+class Client(object):
+    '''
+    Queries a running server over HTTP. Peaks and tracks come back as
+    the decoded JSON documents, or text for peaks in another format.
+    Raises QueryError with the message of the server when a query fails.
+    '''
+    def __init__(self, url='http://localhost:8000'):
+        self.url = url.rstrip('/')
+
+    def get(self, path, **query):
+        try:
+            response = urllib2.urlopen('%s%s?%s' % (self.url, path, urllib.urlencode(query)))
+        except urllib2.HTTPError, e:
+            raise QueryError(json.load(e).get('error', str(e)), e.code)
+        if response.info().gettype() == 'application/json':
+            return json.load(response)
+        return response.read()
+
+    def samples(self):
+        return self.get('/samples')
+
+    def peaks(self, region, **query):
+        return self.get('/peaks', region=region, **query)
+
+    def track(self, region, **query):
+        return self.get('/track', region=region, **query)
+
+class LocalClient(Client):
+    ''' Stands in for a Client by asking a RegionServer in the same process, without HTTP.
+    Answers go through JSON all the same, so they are those a Client gets. '''
+    def __init__(self, regions):
+        self.regions = regions
+
+    def get(self, path, **query):
+        answer = self.regions.answer(path, dict((name, str(value)) for name, value in query.items()))
+        return answer if isinstance(answer, basestring) else json.loads(json.dumps(answer))
+
+def load_samples(args, options):
+    ''' Loads the samples given on the command line, each as a path, or as name=path, with
+    paths joined by commas to pool them '''
+    samples = []
+    for arg in args:
+        name, sep, paths = arg.rpartition('=')
+        paths = paths.split(',')
+        if not name:
+            name = os.path.basename(paths[0]).split('.')[0]
+        if not check_paths(paths):
+            sys.exit(1)
+        if name in [sample.name for sample in samples]:
+            logging.error('Sample %s is given twice, name them with name=path' % name)
+            sys.exit(1)
+        samples.append(Sample(name, paths[0] if len(paths) == 1 else paths, options.unsorted))
+    return samples
+
+usage = '''
+samples may be:
+
+    - a file to load, named after the file
+    - name=path to name the sample
+    - name=path1,path2 to pool the reads of several files
+
+example usage:
+
+    python serve.py -P 8000 rep1=/path/to/rep1.idx rep2=/path/to/rep2.idx
+    curl 'http://localhost:8000/peaks?sample=rep1&region=chr1:10000-20000&sigma=10&exclusion=40'
+'''.lstrip()
+
+# We must override the help formatter to force it to obey our newlines in our custom description
+class CustomHelpFormatter(IndentedHelpFormatter):
+    def format_description(self, description):
+        return description
+
+def run():
+    parser = OptionParser(usage='%prog [options] samples', description=usage, formatter=CustomHelpFormatter())
+    parser.add_option('-H', action='store', type='string', dest='host', default='localhost',
+                      help='Host name or address to listen on. Default %default, which only takes local queries.')
+    parser.add_option('-P', action='store', type='int', dest='port', default=8000,
+                      help='Port to listen on. Default %default.')
+    parser.add_option('--cache-memory', action='store', type='int', dest='cache_memory', default=512,
+                      help='Size, in MB, of the smoothed regions kept in memory. Default %default.')
+    parser.add_option('--unsorted', action='store_true', dest='unsorted',
+                      help='Accept reads in any order, sorting them by chromosome and index when loading.')
+    parser.add_option('-v', action='store_true', dest='verbose', help='Verbose mode: displays debug messages')
+    parser.add_option('-q', action='store_true', dest='quiet', help='Quiet mode: suppresses all non-error messages')
+    (options, args) = parser.parse_args()
+
+    if options.verbose:
+        logging.getLogger().setLevel(logging.DEBUG) # Show all info/debug messages
+    if options.quiet:
+        logging.getLogger().setLevel(logging.ERROR) # Silence all non-error messages
+
+    if not args:
+        parser.print_help()
+        sys.exit(1)
+    if '-' in ','.join(args).split(','):
+        parser.error('Samples are loaded from files, not standard input.')
+
+    regions = RegionServer(load_samples(args, options), options.cache_memory * 2 ** 20)
+    server = BaseHTTPServer.HTTPServer((options.host, options.port), RequestHandler)
+    server.regions = regions
+    logging.info('Serving %d samples on http://%s:%d/' % (len(regions.samples), options.host, options.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+if __name__ == '__main__':
+    run()
@@ -22,12 +22,15 @@ Or in other python scripts::
 
 Run the script with no parameters to see the options that it takes.
 
-**Note1**: The script will invoke the system `sort` command to sort the file 
-that is substantially faster under Unix than Windows.
+**Note1**: Reads are sorted in memory, in runs of at most `--memory` megabytes
+that are spilled to binary files in the temporary directory and merged into
+the consolidated counts.
 
 """
-import os, sys, csv, shutil, re, time
+import os, sys, csv, shutil, re, time, gzip
 from itertools import *
+from array import array
+import numpy
 
 def path_join(*args):
     "Builds absolute path"
@@ -44,6 +47,19 @@ def tempdata(*args):
     "Generates paths to temporary data"
     return path_join(TEMP_DATA_DIR, *args)
 
+# reads are buffered until they take this many megabytes, then sorted and spilled as a run
+SORT_MEMORY = 512
+
+# each buffered read is a run record, plus room to sort it
+RUN_DTYPE = [('chrom', '<i4'), ('index', '<i8'), ('strand', 'i1')]
+ROW_BYTES = 40
+
+# rows read from each run at a time when merging
+MERGE_ROWS = 2 ** 18
+
+# strand codes of the buffered reads
+FORWARD, REVERSE, UNSTRANDED = 0, 1, 2
+
 def commify(n):
     """
 Formats numbers with commas
@@ -58,6 +74,18 @@ Formats numbers with commas
             break
     return n
 
+def open_input(inpname):
+    """
+    Opens an input file, decompressing it if it is gzip compressed.
+    BGZF files are gzip files too and read the same way.
+    """
+    fp = open(inpname, 'rb')
+    magic = fp.read(2)
+    fp.close()
+    if magic == '\x1f\x8b':
+        return gzip.open(inpname, 'rb')
+    return file(inpname, 'rU')
+
 class Timer(object):
     """
 A timer object for display elapsed times.
@@ -97,48 +125,120 @@ A timer object for display elapsed times.
         self.start()
         return elapsed
 
-def consolidate( inpname, outname, format):
+class RunSorter(object):
+    """
+    Sorts reads by chromosome name and index with bounded memory.
+    Reads are buffered as (chromosome id, index, strand) until there
+    are as many as fit in memory megabytes, then sorted with numpy and
+    spilled to a binary run file. Merging the runs yields the reads
+    consolidated into counts per chromosome and index.
+    """
+    def __init__(self, prefix, memory=SORT_MEMORY):
+        self.prefix = prefix
+        self.limit = max(memory * 2 ** 20 // ROW_BYTES, 1)
+        self.names = {}
+        self.runs = []
+        self.reset()
+
+    def reset(self):
+        self.chroms, self.indexes, self.strands = array('i'), array('l'), array('b')
+
+    def add(self, chrom, index, strand):
+        ident = self.names.get(chrom)
+        if ident is None:
+            ident = self.names[chrom] = len(self.names)
+        self.chroms.append(ident)
+        self.indexes.append(index)
+        self.strands.append(strand)
+        if len(self.indexes) >= self.limit:
+            self.spill()
+
+    def sort_run(self):
+        "Returns the buffered reads as a run sorted by chromosome id and index"
+        run = numpy.zeros(len(self.indexes), RUN_DTYPE)
+        run['chrom'] = numpy.frombuffer(self.chroms, 'i')
+        run['index'] = numpy.frombuffer(self.indexes, 'l')
+        run['strand'] = numpy.frombuffer(self.strands, 'b')
+        self.reset()
+        return run[numpy.lexsort((run['index'], run['chrom']))]
+
+    def spill(self):
+        path = '%s.run%d.npy' % (self.prefix, len(self.runs))
+        numpy.save(path, self.sort_run())
+        self.runs.append(path)
+
+    def merge(self):
+        """
+        Merges the runs, generating (chromosome, indexes, forward counts,
+        reverse counts, total counts) batches in the order the system sort
+        gave: chromosomes by name, then indexes by value.
+        """
+        runs = [numpy.load(path, mmap_mode='r') for path in self.runs]
+        if len(self.indexes):
+            runs.append(self.sort_run())
+        for chrom in sorted(self.names):
+            ident = self.names[chrom]
+            segments = []
+            for run in runs:
+                lo, hi = numpy.searchsorted(run['chrom'], [ident, ident + 1])
+                if lo < hi:
+                    segments.append([run, lo, hi])
+            for batch in merge_segments(segments):
+                yield (chrom,) + batch
+
+    def close(self):
+        for path in self.runs:
+            os.remove(path)
+        self.runs = []
+
+def merge_segments(segments):
     """
-    Consolidates an input file. 
-    Merges multiple indentical indices into one line
+    Merges [run, start, end] segments of runs, each sorted by index,
+    a batch at a time. The bound of a batch is the lowest last index of
+    the MERGE_ROWS rows read ahead from each segment, and the batch takes
+    every row up to it, including rows equal to it past the rows read
+    ahead, so no index is split between batches. Generates (indexes,
+    forward counts, reverse counts, total counts) for each batch.
+    """
+    while segments:
+        bound = min(run['index'][min(start + MERGE_ROWS, end) - 1] for run, start, end in segments)
+        rows = []
+        for segment in segments:
+            run, start, end = segment
+            stop = start + numpy.searchsorted(run['index'][start:end], bound, 'right')
+            rows.append(run[start:stop])
+            segment[1] = stop
+        segments = [segment for segment in segments if segment[1] < segment[2]]
+        rows = numpy.concatenate(rows)
+        indexes, inverse = numpy.unique(rows['index'], return_inverse=True)
+        forward = numpy.bincount(inverse, rows['strand'] == FORWARD, len(indexes)).astype(int)
+        reverse = numpy.bincount(inverse, rows['strand'] == REVERSE, len(indexes)).astype(int)
+        total = numpy.bincount(inverse, minlength=len(indexes))
+        yield indexes, forward, reverse, total
+
+def consolidate( batches, outname, source, format):
+    """
+    Writes the consolidated counts merged by RunSorter.merge, one line
+    per chromosome and index.
     """
     fp = open(outname, 'wt')
 
-    # recover the original basename
-    basename = os.path.basename(inpname).replace('.sorted', '')
-
     # create a few information headers
     fp.write("#\n# created with tabs2genetrack\n")
-    fp.write("# source: %s, format %s\n#\n" % (basename, format) )
+    fp.write("# source: %s, format %s\n#\n" % (source, format) )
     fp.write("chrom\tindex\tforward\treverse\tvalue\n")
     
-    # the main reader
-    reader = csv.reader(open(inpname, 'rb'), delimiter='\t')
-
-    # will duplicate some code to avoid an extra conditional internally
-    chrom, index, fwd, rev, val = reader.next()
-    lastindex, fwd, rev, val = int(index), int(fwd), int(rev), int(val)
-    collect = [ chrom, lastindex, fwd, rev, val ]
-
-    for row in reader:
-        chrom, index, fwd, rev, val = row
-        index, fwd, rev, val = int(index), int(fwd), int(rev), int(val)
-        if index == lastindex:
-            collect[2] += fwd
-            collect[3] += rev
-            collect[4] += val
-        else:
-            # write out the collected data
-            fp.write( '%s\t%s\t%s\t%s\t%s\n' % tuple(collect) )
-            collect = [ chrom, index, fwd, rev, val ]
-            lastindex = index
+    for chrom, indexes, fwd, rev, val in batches:
+        rows = izip(repeat(chrom), indexes.tolist(), fwd.tolist(), rev.tolist(), val.tolist())
+        fp.write( ''.join(['%s\t%d\t%d\t%d\t%d\n' % row for row in rows]) )
 
     fp.close()
 
-def transform(inpname, outname, format, shift=0, index=False, options=None):
+def transform(inpname, outname, format, shift=0, index=False, options=None, memory=SORT_MEMORY):
     """
     Transforms reads stored in bedfile to a genetrack input file.
-    Requires at least 6 bed columns to access the strand.
+    Requires at least 6 bed columns to access the strand. Sorting
+    uses about memory megabytes besides the output being written.
     """
 
     # detect file formats
@@ -150,44 +250,41 @@ def transform(inpname, outname, format, shift=0, index=False, options=None):
         raise Exception('Invalid file format' % format)
 
     # two sanity checks, one day someone will thank me
-    if format == 'BED' and inpname.endswith('gff'):
+    plainname = re.sub(r'\.b?gz$', '', inpname)
+    if format == 'BED' and plainname.endswith('gff'):
         raise Exception('BED format on a gff file?')
-    if format == 'GFF' and inpname.endswith('bed'):
+    if format == 'GFF' and plainname.endswith('bed'):
         raise Exception('GFF format on a bed file?')
 
     # find the basename of the outputname
     basename = os.path.basename(outname)
-   
-    # two files store intermediate results
-    flat   = tempdata( '%s.flat' % basename )
-    sorted = tempdata( '%s.sorted' % basename )
 
-    # check for track information on first line, 
+    # count the track and comment lines on top,
     # much faster this way than conditional checking on each line
-    fp = file(inpname, 'rU')
-    first = fp.readline()
+    fp = open_input(inpname)
+    header = 0
+    for line in fp:
+        if not (line.startswith('#') or line.startswith('track') or line.startswith('browser')):
+            break
+        header += 1
     fp.close()
 
-    # create the reader
-    reader = csv.reader(file(inpname, 'rU'), delimiter='\t')
-
-    # skip if trackline exists
-    if first.startswith == 'track':
+    # create the reader and skip the header
+    reader = csv.reader(open_input(inpname), delimiter='\t')
+    for i in range(header):
         reader.next()
 
-    # unwind the comments
-    list(takewhile(lambda x: x[0].startswith('#'), reader))
-
     # copious timing info for those who enjoy these
     timer, full = Timer(), Timer()
 
     print("parsing '%s'" % inpname)
     print("output to '%s'" % outname)
 
-    # create the unsorted output file and apply corrections
-    print("unsorted flat file '%s'" % flat)
+    # sort the reads in runs spilled to the temporary directory
+    sorter = RunSorter(tempdata(basename), memory)
+    print("sorting in runs of %s reads" % commify(sorter.limit))
 
-    fp = file(flat, 'wt')
+    linec = 0
     for linec, row in enumerate(reader):
         try:
             chrom, start, end, strand = row[CHROM], row[START], row[END], row[STRAND]
@@ -204,43 +301,27 @@ def transform(inpname, outname, format, shift=0, index=False, options=None):
 
         if strand == '+':
             # on forward strand, 5' is at start
-            idx = int(start) + shift
-            fwd, rev, val = 1, 0, 1
+            sorter.add(chrom, int(start) + shift, FORWARD)
         elif strand == '-':
             # on reverse strand, 5' is at end
-            idx = int(end) - shift
-            fwd, rev, val = 0, 1, 1
+            sorter.add(chrom, int(end) - shift, REVERSE)
         else:
             # no strand specified, generate interval centers
-            idx = (int(start)+int(end))/2
-            fwd, rev, val = 0, 0, 1
+            sorter.add(chrom, (int(start)+int(end))/2, UNSTRANDED)
 
-        # it is essential be able to sort the index as a string! 
-        fp.write('%s\t%012d\t%s\t%s\t%s\n' % (chrom, idx, fwd, rev, val))
-
-    fp.close()
     linet = commify(linec)
-    print("parsing %s lines finished in %s" % (linet, timer.report()))
-
-    # if it is producing coverage then it will expand reads into full intervaals
-
-    # now let the sorting commence
-    cmd = "sort %s > %s" % (flat, sorted)
-    print("sorting into '%s'" % sorted)
-    os.system(cmd)
-    print("sorting finished in %s" % timer.report() )
-
-    print("consolidating into '%s'" % outname)
-    consolidate( sorted, outname, format=format)
-    print("consolidate finished in %s" % timer.report() )
+    print("parsing and sorting %s lines into %s run(s) finished in %s" % (linet, len(sorter.runs) + (len(sorter.indexes) > 0), timer.report()))
+
+    try:
+        print("consolidating into '%s'" % outname)
+        consolidate( sorter.merge(), outname, source=basename, format=format)
+        print("consolidate finished in %s" % timer.report() )
+    finally:
+        # cleanup the spilled runs
+        sorter.close()
     print("output saved to '%s'" % outname)
     print("full conversion finished in %s" % full.report() )
 
-    # attempting to cleanup the remaining files
-    for name in (flat, sorted):
-        print("removing temporary file '%s'" % name )
-        os.remove(name)
-
 def option_parser():
     "The option parser may be constructed in other tools invoking this script"
     import optparse
@@ -288,6 +369,13 @@ def option_parser():
         action="store_true", dest="index", default=False,
         help="also creates an hdf index for the file")
 
+    # memory used to sort the reads
+    parser.add_option(
+        '-m', '--memory', action="store", 
+        dest="memory", type="int", default=SORT_MEMORY, 
+        help="memory in MB to sort reads in before spilling them to disk (default=%d)" % SORT_MEMORY,
+    )
+
     parser.add_option(
         '-w', '--workdir', action="store", 
         dest="workdir", type='str', default=None,
@@ -316,4 +404,4 @@ if __name__ == '__main__':
         sys.exit(-1)
     else:
         transform(inpname=options.inpname, outname=options.outname,\
-            format=options.format, shift=options.shift, index=options.index, options=options)
+            format=options.format, shift=options.shift, index=options.index, options=options, memory=options.memory)
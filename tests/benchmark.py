@@ -0,0 +1,241 @@
+""" Benchmarks the stages of genetrack.py on synthetic genomes
+
+Reads are generated from a seeded random state: a uniform background plus
+peaks whose read counts follow a Pareto distribution (lower skew values give
+a few very tall pileups), forward reads upstream of each peak center and
+reverse reads downstream. They are written as idx, BED and GFF files, and
+each stage is timed separately for every input size and sigma:
+
+    parse     reading a file into per-chromosome arrays (per format)
+    populate  populate_array on both strands
+    call      call_peaks on both strands, exclusion included
+    exclude   exclude_peaks alone, on the peaks found before exclusion
+    output    formatting the called peaks (per output format)
+
+The timings, best of a number of repeats, are written as a JSON report.
+Giving the report of an earlier run with -C prints the ratio of every
+timing to it, so regressions can be compared between commits.
+
+example usage:
+
+    python benchmark.py -z 1,4,16 -s 5,10,20 -R report.json
+    python benchmark.py -R new.json -C old.json
+"""
+
+from optparse import OptionParser, Values
+import os, sys, time, json, shutil, tempfile, platform, subprocess
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'genetrack'))
+import genetrack
+
+READ_SIZE = 36
+FORMATS = ('idx', 'bed', 'gff')
+
+def generate_reads(random, length, options):
+    ''' Returns the sorted positions and strands (0 forward, 1 reverse) of the reads
+    of one synthetic chromosome '''
+    background = random.poisson(options.depth * length / 1000.0)
+    positions = [random.randint(1, length + 1, background)]
+    strands = [random.randint(0, 2, background)]
+
+    peaks = random.poisson(options.peaks * length / 1e6)
+    centers = random.randint(1, length + 1, peaks)
+    counts = ((random.pareto(options.skew, peaks) + 1) * options.peak_reads).astype(int)
+    centers = numpy.repeat(centers, counts)
+    peak_strands = random.randint(0, 2, len(centers))
+    offsets = random.normal(options.shift, options.spread, len(centers)).astype(int)
+    positions.append(centers + numpy.where(peak_strands, offsets, -offsets))
+    strands.append(peak_strands)
+
+    positions = numpy.clip(numpy.concatenate(positions), 1, length)
+    strands = numpy.concatenate(strands)
+    order = numpy.lexsort((strands, positions))
+    return positions[order], strands[order]
+
+def write_reads(path, format, chromosomes):
+    ''' Writes the reads of (name, positions, strands) chromosomes in a format '''
+    f = open(path, 'wt')
+    if format == 'idx':
+        f.write('chrom\tindex\tforward\treverse\n')
+    for name, positions, strands in chromosomes:
+        if format == 'idx':
+            indexes, inverse = numpy.unique(positions, return_inverse=True)
+            forward = numpy.bincount(inverse, 1 - strands, len(indexes)).astype(int)
+            reverse = numpy.bincount(inverse, strands, len(indexes)).astype(int)
+            rows = zip(indexes.tolist(), forward.tolist(), reverse.tolist())
+            f.write(''.join(['%s\t%d\t%d\t%d\n' % ((name,) + row) for row in rows]))
+        else:
+            signs = numpy.array(['+', '-'])[strands].tolist()
+            if format == 'bed':
+                rows = zip((positions - 1).tolist(), (positions - 1 + READ_SIZE).tolist(), signs)
+                f.write(''.join(['%s\t%d\t%d\tread\t0\t%s\n' % ((name,) + row) for row in rows]))
+            else:
+                rows = zip(positions.tolist(), (positions + READ_SIZE - 1).tolist(), signs)
+                f.write(''.join(['%s\tsynthetic\tread\t%d\t%d\t.\t%s\t.\t.\n' % ((name,) + row) for row in rows]))
+    f.close()
+
+def best_time(function, repeat):
+    ''' Returns the shortest of repeat timings of a call and its last result '''
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        result = function()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def load_file(path):
+    ''' Reads a file into a list of (name, reads) pairs '''
+    manager = genetrack.get_manager(path)
+    chromosomes = []
+    while not manager.done:
+        name = manager.chromosome_name()
+        chromosomes.append((name, manager.load_chromosome()))
+    return chromosomes
+
+def benchmark_size(size, directory, options):
+    ''' Times every stage on a genome of size megabases, returning a list of results '''
+    random = numpy.random.RandomState(options.seed)
+    length = int(size * 1e6 / options.chromosomes)
+    chromosomes = [('chr%02d' % (i + 1),) + generate_reads(random, length, options) for i in range(options.chromosomes)]
+    total = sum(len(positions) for name, positions, strands in chromosomes)
+    results = []
+    def record(stage, seconds, items, **settings):
+        result = dict(size=size, reads=total, stage=stage, seconds=seconds, items=items, **settings)
+        results.append(result)
+        print '%6gMb %-8s %-24s %9.4fs %10d items' % (size, stage, ' '.join('%s=%s' % item for item in sorted(settings.items())),
+                                                    seconds, items)
+
+    for format in FORMATS:
+        path = os.path.join(directory, 'synthetic_%g.%s' % (size, format))
+        write_reads(path, format, chromosomes)
+        seconds, loaded = best_time(lambda: load_file(path), options.repeat)
+        record('parse', seconds, total, format=format, bytes=os.path.getsize(path))
+        if format == 'idx':
+            data = loaded
+
+    for sigma in options.sigmas:
+        genetrack.WIDTH = sigma * 4
+        genetrack.readsize = 0
+        settings = Values(dict(sigma=sigma, exclusion=options.exclusion, up_width=0, down_width=0, filter=options.filter))
+        unexcluded = Values(dict(settings.__dict__, exclusion=0))
+
+        def populate():
+            arrays = []
+            for name, reads in data:
+                normal = genetrack.normal_array(genetrack.WIDTH, sigma)
+                for column in (1, 2):
+                    array, shift = genetrack.allocate_array(reads, genetrack.WIDTH)
+                    genetrack.populate_array(array, shift, reads, column, normal)
+                    arrays.append((array, shift, reads, column))
+            return arrays
+        seconds, arrays = best_time(populate, options.repeat)
+        record('populate', seconds, sum(len(array) for array, shift, reads, column in arrays), sigma=sigma)
+
+        def call(settings):
+            return [genetrack.call_peaks(array, shift, reads, column, settings) for array, shift, reads, column in arrays]
+        seconds, peaks = best_time(lambda: call(settings), options.repeat)
+        record('call', seconds, sum(map(len, peaks)), sigma=sigma)
+
+        found = [(strand['index'], strand['value']) for strand in call(unexcluded)]
+        def exclude():
+            return [genetrack.exclude_peaks(indexes, values, options.exclusion // 2) for indexes, values in found]
+        seconds, survivors = best_time(exclude, options.repeat)
+        record('exclude', seconds, sum(len(indexes) for indexes, values in found), sigma=sigma)
+
+        tables = [(name, strands) for (name, reads), strands in zip(data, zip(peaks[::2], peaks[1::2]))]
+        for format in sorted(genetrack.OUTPUT_LINES):
+            def output():
+                return sum(len(genetrack.format_peaks(name, strand, table, format))
+                           for name, pair in tables for strand, table in zip('+-', pair))
+            seconds, length = best_time(output, options.repeat)
+            record('output', seconds, sum(len(table) for name, pair in tables for table in pair), sigma=sigma, format=format)
+    return results
+
+def get_commit():
+    ''' Returns the git commit of the working tree, if there is one '''
+    try:
+        p = subprocess.Popen(['git', 'rev-parse', 'HEAD'], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                             cwd=os.path.dirname(os.path.abspath(__file__)))
+        return p.communicate()[0].strip() or None
+    except OSError:
+        return None
+
+def result_key(result):
+    return tuple(sorted((name, value) for name, value in result.items() if name not in ('seconds', 'items', 'reads', 'bytes')))
+
+def compare(report, path):
+    ''' Prints the ratio of each timing of a report to the same timing in an earlier report '''
+    earlier = dict((result_key(result), result['seconds']) for result in json.load(open(path, 'rt'))['results'])
+    print 'Compared to %s (ratio above 1 is slower):' % path
+    for result in report['results']:
+        key = result_key(result)
+        if earlier.get(key):
+            print '  %-60s %6.2f' % (' '.join('%s=%s' % item for item in key), result['seconds'] / earlier[key])
+
+def run():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-z', action='store', type='string', dest='sizes', default='1,2,4',
+                      help='Comma separated genome sizes, in megabases, to benchmark. Default %default.')
+    parser.add_option('-n', action='store', type='int', dest='chromosomes', default=4,
+                      help='Number of chromosomes to divide each genome into. Default %default.')
+    parser.add_option('-D', action='store', type='float', dest='depth', default=20,
+                      help='Background reads per kilobase. Default %default.')
+    parser.add_option('-P', action='store', type='float', dest='peaks', default=2000,
+                      help='Peaks per megabase. Default %default.')
+    parser.add_option('-H', action='store', type='float', dest='peak_reads', default=10,
+                      help='Smallest number of reads in a peak. Default %default.')
+    parser.add_option('-k', action='store', type='float', dest='skew', default=1.5,
+                      help='Pareto shape of the reads per peak; lower values give more skewed pileups. Default %default.')
+    parser.add_option('-o', action='store', type='float', dest='shift', default=10,
+                      help='Mean distance of the reads of a peak from its center. Default %default.')
+    parser.add_option('-w', action='store', type='float', dest='spread', default=4,
+                      help='Standard deviation of the distance of the reads of a peak from its center. Default %default.')
+    parser.add_option('-s', action='store', type='string', dest='sigmas', default='5,10,20',
+                      help='Comma separated sigmas to benchmark. Default %default.')
+    parser.add_option('-e', action='store', type='int', dest='exclusion', default=20,
+                      help='Exclusion zone to call peaks with. Default %default.')
+    parser.add_option('-F', action='store', type='int', dest='filter', default=3,
+                      help='Filter to call peaks with. Default %default.')
+    parser.add_option('-r', action='store', type='int', dest='repeat', default=3,
+                      help='Times to repeat each timing, keeping the best. Default %default.')
+    parser.add_option('-S', action='store', type='int', dest='seed', default=1,
+                      help='Seed of the read generator. Default %default.')
+    parser.add_option('-R', action='store', type='string', dest='report',
+                      default=os.path.join(tempfile.gettempdir(), 'genetrack-benchmark.json'),
+                      help='Path to write the JSON report to. Default %default.')
+    parser.add_option('-C', action='store', type='string', dest='compare', default='',
+                      help='Earlier report to compare the timings with.')
+    (options, args) = parser.parse_args()
+    if args:
+        parser.error('Too many arguments')
+    options.sigmas = [int(sigma) for sigma in options.sigmas.split(',')]
+
+    directory = tempfile.mkdtemp(prefix='genetrack-benchmark')
+    try:
+        results = []
+        for size in [float(size) for size in options.sizes.split(',')]:
+            results.extend(benchmark_size(size, directory, options))
+    finally:
+        shutil.rmtree(directory)
+
+    report = {
+        'commit': get_commit(),
+        'python': platform.python_version(),
+        'numpy': numpy.__version__,
+        'machine': platform.machine(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'settings': dict((name, getattr(options, name)) for name in ('sizes', 'chromosomes', 'depth', 'peaks', 'peak_reads',
+                          'skew', 'shift', 'spread', 'sigmas', 'exclusion', 'filter', 'repeat', 'seed')),
+        'results': results,
+    }
+    f = open(options.report, 'wt')
+    json.dump(report, f, indent=1, sort_keys=True)
+    f.close()
+    print 'Report written to %s' % options.report
+    if options.compare:
+        compare(report, options.compare)
+
+if __name__ == '__main__':
+    run()
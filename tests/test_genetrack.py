@@ -0,0 +1,901 @@
+""" Behaviour tests of genetrack.py and the scripts around it
+
+Run from anywhere with:
+
+    python tests/test_genetrack.py
+"""
+
+import os, sys, shutil, tempfile, unittest, logging, StringIO, gzip, subprocess, json, bisect, zlib, struct, multiprocessing
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'genetrack'))
+import genetrack, tabs2genetrack, serve, multiprocess
+
+class TempDirTest(unittest.TestCase):
+    ''' Gives each test a temporary directory to write files in '''
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='genetrack-test')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, text):
+        path = os.path.join(self.directory, name)
+        f = open(path, 'wt')
+        f.write(text)
+        f.close()
+        return path
+
+class RecordingHandler(logging.Handler):
+    ''' Keeps the messages logged at ERROR or above '''
+    def __init__(self):
+        logging.Handler.__init__(self, logging.ERROR)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+class SmoothingCacheTest(TempDirTest):
+    def test_same_bounds_other_window(self):
+        ''' Chunks with the same bounds but other reads, as -c clipping makes, are cached apart '''
+        cache = genetrack.SmoothingCache(self.directory, 2 ** 30, 'fingerprint')
+        wide = numpy.array([[100, 1, 0], [150, 2, 1], [200, 0, 3]])
+        narrow = wide[1:]
+        cache.smooth('chr1', (120, 180), wide, 20, 5)
+        (forward, shift), (reverse, shift) = cache.smooth('chr1', (120, 180), narrow, 20, 5)
+        (expected_forward, expected_shift), (expected_reverse, expected_shift) = genetrack.smooth_reads(narrow, 20, 5)
+        self.assertEqual(shift, expected_shift)
+        self.assertTrue(numpy.array_equal(forward, expected_forward))
+        self.assertTrue(numpy.array_equal(reverse, expected_reverse))
+
+class CallPeaksTest(unittest.TestCase):
+    def test_plateau(self):
+        ''' Maxima are strictly above both neighbours, so two equal neighbouring maxima make no
+        peak, as genetrack.py has always called them '''
+        for sigma in (3, 5, 20):
+            forward, reverse = genetrack.call_peaks_array([[100, 4, 0], [101, 4, 0]], {'sigma': sigma, 'exclusion': 10})
+            self.assertEqual(len(forward), 0)
+            self.assertEqual(len(reverse), 0)
+
+    def test_step_is_not_peak(self):
+        ''' A run of equal values on a slope is not a peak '''
+        peaks = genetrack.call_peaks(numpy.array([0., 5, 3, 3, 1, 0]), 0, numpy.array([[1, 5, 0]]), 1,
+                                     genetrack.Values(dict(genetrack.PEAK_SETTINGS)))
+        self.assertEqual(peaks['index'].tolist(), [1])
+
+def greedy_exclusion(indexes, values, radius):
+    ''' The exclusion of genetrack.py before exclude_peaks: from highest to lowest value, each
+    peak removes the peaks left within radius of it that have not been taken yet '''
+    order = sorted(range(len(indexes)), key=lambda i: -values[i])
+    left = range(len(indexes))
+    keys = list(indexes)
+    taken = set()
+    for i in order:
+        taken.add(i)
+        start = bisect.bisect_left(keys, indexes[i] - radius)
+        end = bisect.bisect_right(keys, indexes[i] + radius)
+        kept = [j for j in left[start:end] if j in taken]
+        left[start:end] = kept
+        keys[start:end] = [indexes[j] for j in kept]
+    survivors = numpy.zeros(len(indexes), bool)
+    survivors[left] = True
+    return survivors
+
+class ExcludePeaksTest(unittest.TestCase):
+    def test_greedy_exclusion(self):
+        ''' Random peaks, with tied values, survive exclusion as they did one peak at a time '''
+        random = numpy.random.RandomState(2)
+        for trial in range(200):
+            count = random.randint(0, 60)
+            indexes = numpy.unique(random.randint(0, 300, count))
+            values = random.randint(1, 6, len(indexes)).astype(float)
+            for exclusion in (0, 1, 2, 3, 7, 20, 41, 1000):
+                expected = greedy_exclusion(indexes.tolist(), values.tolist(), exclusion // 2)
+                survivors = genetrack.exclude_peaks(indexes, values, exclusion // 2)
+                self.assertEqual(survivors.tolist(), expected.tolist())
+
+def loaded_chunks(data, size, overlap):
+    ''' The chunks genetrack.py took from a loaded chromosome before stream_chunks, as
+    (reads, process_range) pairs '''
+    lo, hi = int(data[0, 0]), int(data[-1, 0])
+    keys = genetrack.make_keys(data)
+    chunks = []
+    for start in range(lo, hi, size):
+        end = min(start + size, hi)
+        chunks.append((genetrack.get_window(data, max(start - overlap, lo), min(end + overlap, hi), keys), (start, end)))
+    return chunks
+
+class StreamChunksTest(unittest.TestCase):
+    def test_blocks_split_anywhere(self):
+        ''' A chromosome is chunked the same however its reads are split into blocks, and the
+        track ranges cover it once '''
+        random = numpy.random.RandomState(3)
+        for trial in range(100):
+            indexes = numpy.unique(random.randint(1, random.choice([50, 2000, 20000]), random.randint(1, 300)))
+            data = numpy.column_stack((indexes, random.randint(0, 4, len(indexes)), random.randint(0, 4, len(indexes))))
+            size, overlap = random.randint(1, 3000), random.randint(0, 600)
+            cuts = numpy.sort(random.randint(0, len(data) + 1, random.randint(0, 10)))
+            blocks = numpy.split(data, cuts)
+            chunks = list(genetrack.stream_chunks(blocks, size, overlap))
+            expected = loaded_chunks(data, size, overlap)
+            self.assertEqual([process_range for reads, process_range, track_range in chunks],
+                             [process_range for reads, process_range in expected])
+            for (reads, process_range, track_range), (expected_reads, expected_range) in zip(chunks, expected):
+                self.assertEqual(reads.tolist(), expected_reads.tolist())
+            if chunks:
+                tracks = [track_range for reads, process_range, track_range in chunks]
+                self.assertEqual(tracks[0][0], data[0, 0] - overlap)
+                self.assertEqual(tracks[-1][1], data[-1, 0] + overlap)
+                self.assertTrue(all(a[1] == b[0] for a, b in zip(tracks, tracks[1:])))
+
+def loop_stats(reads, starts, ends):
+    ''' The read count, mean and standard deviation of the reads in each window, one window at a
+    time over their flat list of indexes, as genetrack.py counted them before window_stats '''
+    keys = genetrack.make_keys(reads)
+    stats = []
+    for start, end in zip(starts, ends):
+        window = genetrack.get_window(reads, start, end, keys)
+        indexes = [index for read in window for index in [read[0]] * read[1]]
+        stats.append((sum(read[1] for read in window), numpy.mean(indexes) if indexes else numpy.nan,
+                      numpy.std(indexes) if indexes else numpy.nan))
+    return stats
+
+class WindowStatsTest(unittest.TestCase):
+    def test_per_window_loop(self):
+        ''' Windows get the statistics the loop over their reads gave, near index 0 and near 2**40,
+        where the prefix sums of count * index**2 wrap around '''
+        random = numpy.random.RandomState(4)
+        for offset in (0, 2 ** 40):
+            for trial in range(50):
+                indexes = numpy.unique(random.randint(1, 5000, random.randint(1, 400))) + offset
+                reads = numpy.column_stack((indexes, random.randint(0, 50, len(indexes))))
+                starts = random.randint(-100, 5100, 30) + offset
+                ends = starts + random.randint(0, 300, 30)
+                readcounts, means, stddevs = genetrack.window_stats(reads[:, 0], reads[:, 1], starts, ends)
+                expected = loop_stats(reads, starts, ends)
+                self.assertEqual(readcounts.tolist(), [readcount for readcount, mean, stddev in expected])
+                expected_means = numpy.array([mean for readcount, mean, stddev in expected])
+                expected_stddevs = numpy.array([stddev for readcount, mean, stddev in expected])
+                self.assertTrue(numpy.allclose(means, expected_means, rtol=0, atol=1e-6, equal_nan=True))
+                self.assertTrue(numpy.allclose(stddevs, expected_stddevs, rtol=1e-9, atol=1e-6, equal_nan=True))
+
+def row_lines(cname, strand, peaks, format):
+    ''' Formats peaks a row at a time, as genetrack.py printed them before PeakWriter '''
+    lines = []
+    for peak in peaks:
+        start, end = peak['start'], peak['end']
+        if format == 'gff':
+            if strand != '+':
+                start += genetrack.readsize
+                end += genetrack.readsize
+            attrs = {'stddev': peak['stddev'], 'height': peak['height'], 'readcount': peak['readcount']}
+            attrs['ID'] = (start + end) / 2
+            row = (cname, 'genetrack', '.', start, end, peak['value'], strand, '.', ';'.join('%s=%s' % item for item in attrs.items()))
+        else:
+            row = (cname, strand, start, end, peak['value'])
+        lines.append('\t'.join(map(str, row)) + '\n')
+    return ''.join(lines)
+
+class PeakWriterTest(TempDirTest):
+    def test_same_as_rows(self):
+        ''' Peaks are written byte for byte as they were printed a row at a time '''
+        random = numpy.random.RandomState(8)
+        indexes = numpy.unique(random.randint(1, 100000, 4000))
+        reads = numpy.column_stack((indexes, random.randint(0, 8, (len(indexes), 2))))
+        path = os.path.join(self.directory, 'peaks')
+        self.addCleanup(setattr, genetrack, 'readsize', genetrack.readsize)
+        for sigma, size in ((5, 0), (10, 36), (20, 50)):
+            genetrack.readsize = size
+            peaks = genetrack.call_peaks_array(reads, {'sigma': sigma})
+            self.assertTrue(min(map(len, peaks)) > 10)
+            for format in ('gff', 'txt'):
+                writer = genetrack.PeakWriter(path, format)
+                writer.write('chr1', *peaks)
+                writer.write('chr2', peaks[0][:3], peaks[1][:0])
+                writer.close()
+                expected = ('##gff-version 3\n' + row_lines('chr1', '+', peaks[0], format) + row_lines('chr1', '-', peaks[1], format) +
+                            row_lines('chr2', '+', peaks[0][:3], format))
+                self.assertEqual(open(path, 'rt').read(), expected)
+
+class MemoryBudgetTest(unittest.TestCase):
+    def rows(self, keys, start, size, overlap):
+        return numpy.searchsorted(keys, start + size + overlap, 'right') - numpy.searchsorted(keys, start - overlap)
+
+    def test_size(self):
+        ''' The chunk size fills the limit left to each process, and is at most the largest '''
+        limit = 400 * 2 ** 20
+        for processes in (1, 2, 4):
+            budget = genetrack.MemoryBudget(limit, processes, 10 ** 9, 20)
+            workers = processes + 1 if processes > 1 else 1
+            self.assertTrue(budget.cost(budget.size, 0) * processes + workers * genetrack.PROCESS_BYTES + genetrack.PARSE_BYTES <= limit)
+            self.assertTrue(budget.cost(budget.size + 1, 0) > budget.chunk_bytes)
+        size = genetrack.MemoryBudget(limit, 1, 10 ** 9, 20).size
+        self.assertEqual(genetrack.MemoryBudget(limit, 1, 10 ** 6, 20).size, 10 ** 6)
+        self.assertTrue(genetrack.MemoryBudget(limit, 1, 10 ** 9, 20, dtype=genetrack.PRECISIONS['single'][0]).size > size)
+        self.assertTrue(genetrack.MemoryBudget(limit, 1, 10 ** 9, 20, 100 * 2 ** 20).size < size)
+        self.assertRaises(ValueError, genetrack.MemoryBudget, 100 * 2 ** 20, 2, 10 ** 9, 20)
+
+    def test_fit(self):
+        ''' Dense reads shrink a chunk to the largest size whose reads fit, but not below the overlap '''
+        budget = genetrack.MemoryBudget(200 * 2 ** 20, 1, 10 ** 9, 20)
+        random = numpy.random.RandomState(10)
+        keys = numpy.sort(random.randint(0, 2 * budget.size, 500000))
+        logging.disable(logging.WARNING)
+        try:
+            for start in random.randint(0, budget.size, 20):
+                for overlap in (0, 80, 500):
+                    size = budget.fit(keys, start, budget.size, overlap)
+                    self.assertTrue(overlap <= size <= budget.size)
+                    self.assertTrue(budget.cost(size, self.rows(keys, start, size, overlap)) <= budget.chunk_bytes)
+                    if size < budget.size:
+                        self.assertTrue(budget.cost(size + 1, self.rows(keys, start, size + 1, overlap)) > budget.chunk_bytes)
+            dense = numpy.repeat(numpy.arange(1000), 10000)
+            self.assertEqual(budget.fit(dense, 0, budget.size, 500), 500)
+        finally:
+            logging.disable(logging.NOTSET)
+        self.assertEqual(budget.fit(numpy.arange(10), 0, 1000, 500), 1000)
+
+class ParseTest(unittest.TestCase):
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def load(self, text):
+        manager = genetrack.BlockChromosomeManager(StringIO.StringIO(text))
+        return manager.load_chromosome()
+
+    def test_integers(self):
+        reads = self.load('chr1\t10\t1\t0\nchr1\t20\t+3\t 2\r\n')
+        self.assertEqual(reads.tolist(), [[10, 1, 0], [20, 3, 2]])
+
+    def test_malformed_last_value(self):
+        ''' A malformed value is rejected rather than cut to its leading digits '''
+        for value in ('2.5', '2x', '1e3'):
+            self.assertRaises(genetrack.InvalidFileError, self.load, 'chr1\t10\t1\t0\nchr1\t20\t1\t%s\n' % value)
+
+    def test_malformed_value_named(self):
+        ''' The error names the malformed value and its line, wherever it is '''
+        logging.disable(logging.NOTSET)
+        handler = RecordingHandler()
+        root = logging.getLogger()
+        handlers, root.handlers = root.handlers, [handler]
+        try:
+            self.assertRaises(genetrack.InvalidFileError, self.load, 'chr1\t10\t1\t0\nchr1\t20\t2x\t1\nchr1\t30\t1\t1\n')
+        finally:
+            root.handlers = handlers
+        self.assertEqual(handler.messages, ['Could not read "2x" as an integer in line "chr1\t20\t2x\t1"'])
+
+    def test_no_valid_line(self):
+        self.assertRaises(genetrack.InvalidFileError, self.load, '# comment\n\n')
+
+class CompressedInputTest(TempDirTest):
+    READS = 'chr1\t10\t1\t0\nchr1\t20\t2\t1\nchr2\t50\t3\t0\n'
+
+    def compress(self, text):
+        data = StringIO.StringIO()
+        f = gzip.GzipFile(fileobj=data, mode='wb')
+        f.write(text)
+        f.close()
+        return data.getvalue()
+
+    def test_members(self):
+        ''' A stream of several gzip members, as in BGZF files, is read through '''
+        data = self.compress(self.READS[:15]) + self.compress(self.READS[15:])
+        self.assertEqual(list(genetrack.GzipStreamReader(StringIO.StringIO(data))), self.READS.splitlines(True))
+
+    def test_standard_input(self):
+        ''' Compressed standard input is detected and called like the file itself '''
+        path = self.write('reads.idx', self.READS)
+        script = os.path.join(os.path.dirname(genetrack.__file__), 'genetrack.py')
+        command = [sys.executable, script, '-o', 'txt', '-F', '0']
+        expected = subprocess.Popen(command + [path], stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()[0]
+        process = subprocess.Popen(command + ['-'], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        output = process.communicate(self.compress(self.READS))[0]
+        self.assertEqual(process.returncode, 0)
+        self.assertTrue(expected.count('\n') > 1)
+        self.assertEqual(output, expected)
+
+class MergedReplicatesTest(TempDirTest):
+    A = 'chr1\t10\t1\t0\nchr1\t20\t2\t1\nchr10\t40\t2\t2\nchr2\t50\t3\t0\n'
+    B = 'chr1\t10\t1\t1\nchr2\t60\t1\t0\n'
+    POOLED = {'chr1': [[10, 2, 1], [20, 2, 1]], 'chr10': [[40, 2, 2]], 'chr2': [[50, 3, 0], [60, 1, 0]]}
+
+    def load(self, paths, indexed=False, unsorted=False):
+        manager = genetrack.get_manager(paths, indexed, unsorted)
+        chromosomes = {}
+        while not manager.done:
+            cname = manager.chromosome_name()
+            self.assertFalse(cname in chromosomes)
+            chromosomes[cname] = manager.load_chromosome().tolist()
+        return chromosomes
+
+    def test_chromosome_missing_from_one(self):
+        ''' Chromosomes sorted by name are pooled from every replicate that has them, streaming
+        the replicates without indexing them '''
+        paths = [self.write('a.idx', self.A), self.write('b.idx', self.B)]
+        self.assertEqual(self.load(paths), self.POOLED)
+        self.assertEqual(self.load(paths[::-1]), self.POOLED)
+        self.assertEqual(self.load(paths, unsorted=True), self.POOLED)
+        self.assertEqual(sorted(os.listdir(self.directory)), ['a.idx', 'b.idx'])
+
+    def test_natural_order(self):
+        ''' Replicates listing chromosomes with their numbers in order are pooled once what they
+        listed rules out sorting by name '''
+        a = self.write('a.idx', 'chr1\t10\t1\t0\nchr2\t10\t1\t0\nchr3\t10\t1\t0\nchr10\t10\t1\t0\n')
+        b = self.write('b.idx', 'chr1\t10\t0\t1\nchr2\t10\t0\t1\nchr10\t10\t0\t1\n')
+        expected = {'chr1': [[10, 1, 1]], 'chr2': [[10, 1, 1]], 'chr3': [[10, 1, 0]], 'chr10': [[10, 1, 1]]}
+        self.assertEqual(self.load([a, b]), expected)
+        self.assertEqual(self.load([b, a]), expected)
+
+    def test_unclear_order(self):
+        ''' Replicates whose order is taken wrongly fail rather than pool a chromosome from only
+        some of them, and are pooled when indexed '''
+        a = self.write('a.idx', 'chr1\t10\t1\t0\nchr2\t10\t1\t0\nchr10\t10\t1\t0\n')
+        b = self.write('b.idx', 'chr1\t10\t0\t1\nchr10\t10\t0\t1\n')
+        logging.disable(logging.ERROR)
+        try:
+            self.assertRaises(genetrack.InvalidFileError, self.load, [a, b])
+        finally:
+            logging.disable(logging.NOTSET)
+        expected = {'chr1': [[10, 1, 1]], 'chr2': [[10, 1, 0]], 'chr10': [[10, 1, 1]]}
+        self.assertEqual(self.load([a, b], indexed=True), expected)
+
+    def test_compressed_replicate(self):
+        ''' A compressed replicate is streamed alongside the others, indexed or not '''
+        path = os.path.join(self.directory, 'b.idx.gz')
+        f = gzip.open(path, 'wb')
+        f.write(self.B)
+        f.close()
+        a = self.write('a.idx', self.A)
+        self.assertEqual(self.load([a, path]), self.POOLED)
+        self.assertEqual(self.load([a, path], indexed=True), self.POOLED)
+
+class LocalClientTest(TempDirTest):
+    REGION = 'chr1:5000-15000'
+
+    def setUp(self):
+        TempDirTest.setUp(self)
+        random = numpy.random.RandomState(1)
+        indexes = numpy.unique(random.randint(1, 20000, 3000))
+        self.path = self.write('reads.idx', ''.join('chr1\t%d\t%d\t%d\n' % (index, random.randint(0, 5), random.randint(0, 5))
+                                                    for index in indexes))
+        logging.disable(logging.INFO)
+        self.client = serve.LocalClient(serve.RegionServer([serve.Sample('reads', self.path)], 2 ** 26))
+        logging.disable(logging.NOTSET)
+
+    def rows(self, text):
+        ''' Splits peaks in txt format into (chromosome, strand, start, end) and heights '''
+        rows = [line.split('\t') for line in text.splitlines() if not line.startswith('#')]
+        return [tuple(row[:2]) + (int(row[2]), int(row[3])) for row in rows], [float(row[4]) for row in rows]
+
+    def call(self, *args):
+        ''' Returns the peaks genetrack.py calls on the region, as rows '''
+        script = os.path.join(os.path.dirname(genetrack.__file__), 'genetrack.py')
+        command = [sys.executable, script, '-o', 'txt', '-c', self.REGION] + list(args) + [self.path]
+        return self.rows(subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()[0])
+
+    def test_peaks_as_command_line(self):
+        ''' The peaks of a region are those genetrack.py -c calls on it. Heights may differ in
+        their last bits, as smoothing with sigma 10 and up depends on the length smoothed. '''
+        for sigma, exclusion in ((5, 20), (10, 40)):
+            peaks, heights = self.call('-s', str(sigma), '-e', str(exclusion))
+            self.assertTrue(len(peaks) > 10)
+            text = self.client.peaks(self.REGION, format='txt', sigma=sigma, exclusion=exclusion)
+            served_peaks, served_heights = self.rows(text)
+            self.assertEqual(served_peaks, peaks)
+            self.assertTrue(numpy.allclose(served_heights, heights, rtol=0, atol=1e-9))
+            answer = self.client.peaks(self.REGION, sigma=sigma, exclusion=exclusion)
+            starts = sorted(peak['start'] for strand in ('forward', 'reverse') for peak in answer[strand])
+            self.assertEqual(starts, sorted(peak[2] for peak in peaks))
+
+    def test_negative_settings(self):
+        for name in ('exclusion', 'up', 'down'):
+            try:
+                self.client.peaks(self.REGION, **{name: -1})
+            except serve.QueryError, e:
+                self.assertEqual(e.status, 400)
+            else:
+                self.fail('%s=-1 was accepted' % name)
+
+    def test_json_rows(self):
+        ''' Peaks are sent as valid JSON, with null for deviations that are not finite '''
+        peaks = numpy.zeros(3, genetrack.PEAK_DTYPE)
+        peaks['index'] = [10, 20, 30]
+        peaks['stddev'] = [1.5, numpy.nan, numpy.inf]
+        rows = json.loads(json.dumps(serve.table_rows(peaks), allow_nan=False))
+        self.assertEqual([row['stddev'] for row in rows], [1.5, None, None])
+        self.assertEqual([row['index'] for row in rows], [10, 20, 30])
+        answer = self.client.peaks(self.REGION, format='json')
+        json.dumps(answer, allow_nan=False)
+        self.assertTrue(len(answer['forward']) > 10)
+
+class SweepTest(TempDirTest):
+    def test_file_relative_to_sweep(self):
+        ''' A file in the sweep file's directory is taken over one of the same name in the working
+        directory '''
+        os.mkdir(os.path.join(self.directory, 'sweep'))
+        self.write('reads.idx', 'chr1\t10\t1\t0\n')
+        path = self.write(os.path.join('sweep', 'reads.idx'), 'chr1\t10\t1\t0\n')
+        sweep = self.write(os.path.join('sweep', 'config.txt'), 'file\tsigma\nreads.idx\t5,10\n')
+        cwd = os.getcwd()
+        os.chdir(self.directory)
+        try:
+            files = genetrack.read_sweep(sweep, [], genetrack.Values(dict(genetrack.PEAK_SETTINGS)))
+        finally:
+            os.chdir(cwd)
+        self.assertEqual([(fpath, [setting.sigma for setting in settings]) for fpath, settings in files], [(path, [5, 10])])
+
+    def test_output_options(self):
+        ''' Sweeps reject the options that name a single output '''
+        sweep = self.write('config.txt', 'file\tsigma\nreads.idx\t5\n')
+        script = os.path.join(os.path.dirname(genetrack.__file__), 'genetrack.py')
+        for option in (['-O', 'peaks.gff'], ['-b'], ['-B']):
+            process = subprocess.Popen([sys.executable, script, '-S', sweep] + option, cwd=self.directory,
+                                       stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            error = process.communicate()[1]
+            self.assertEqual(process.returncode, 2)
+            self.assertTrue('cannot be given' in error)
+
+def synthetic_reads(seed, names, length, count):
+    ''' Returns idx lines of count random reads on each of the named chromosomes, with some
+    piled up so that peaks are called '''
+    random = numpy.random.RandomState(seed)
+    lines = []
+    for name in names:
+        indexes = numpy.unique(numpy.concatenate((random.randint(1, length, count),
+                                                  numpy.repeat(random.randint(100, length - 100, count // 20), 5) +
+                                                  random.randint(-30, 30, count // 4))))
+        counts = random.randint(0, 6, (len(indexes), 2))
+        lines.extend('%s\t%d\t%d\t%d\n' % (name, index, forward, reverse) for index, (forward, reverse) in zip(indexes, counts))
+    return lines
+
+class ScriptTest(TempDirTest):
+    ''' Runs genetrack.py in the temporary directory '''
+    def genetrack(self, *args):
+        ''' Returns the standard output of genetrack.py run with the arguments '''
+        script = os.path.join(os.path.dirname(genetrack.__file__), 'genetrack.py')
+        process = subprocess.Popen([sys.executable, script] + list(args), cwd=self.directory,
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        output, error = process.communicate()
+        self.assertEqual(process.returncode, 0, error)
+        return output
+
+    def read(self, name):
+        f = open(os.path.join(self.directory, name), 'rb')
+        text = f.read()
+        f.close()
+        return text
+
+class ProcessesTest(ScriptTest):
+    def test_same_output_as_serial(self):
+        ''' Chunks called on several processes are written in the order a single process writes them '''
+        self.write('reads.idx', ''.join(synthetic_reads(5, ['chr1', 'chr2', 'chr3'], 2500000, 3000)))
+        serial = self.genetrack('-k', '1', '-b', 'reads.idx')
+        tracks = [self.read(name) for name in ('forward.bedgraph', 'reverse.bedgraph')]
+        self.assertTrue(serial.count('\n') > 100)
+        for processes in ('2', '3'):
+            self.assertEqual(self.genetrack('-k', '1', '-b', '-p', processes, 'reads.idx'), serial)
+            self.assertEqual([self.read(name) for name in ('forward.bedgraph', 'reverse.bedgraph')], tracks)
+
+class BinaryIndexTest(ScriptTest):
+    def load(self, path):
+        manager = genetrack.get_manager(path)
+        chromosomes = []
+        while not manager.done:
+            chromosomes.append((manager.chromosome_name(), manager.load_chromosome().tolist()))
+        return chromosomes
+
+    def convert(self, name):
+        ''' Converts a file with idxtobin.py, returning the name of the binary index '''
+        script = os.path.join(os.path.dirname(genetrack.__file__), 'idxtobin.py')
+        process = subprocess.Popen([sys.executable, script, name], cwd=self.directory, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        error = process.communicate()[1]
+        self.assertEqual(process.returncode, 0, error)
+        return os.path.join('idxtobin', name.split('.')[0] + '.bidx')
+
+    def test_round_trip(self):
+        ''' A binary index holds the reads of the text file it was converted from, and calls the
+        same peaks, whole or limited to regions '''
+        self.write('reads.idx', ''.join(synthetic_reads(6, ['chr1', 'chr10', 'chr2'], 200000, 2000)))
+        binary = self.convert('reads.idx')
+        self.assertEqual(self.load(os.path.join(self.directory, binary)), self.load(os.path.join(self.directory, 'reads.idx')))
+        manager = genetrack.get_manager(os.path.join(self.directory, binary))
+        self.assertTrue(manager.seek_chromosome('chr2'))
+        self.assertEqual(manager.load_chromosome().tolist(), self.load(os.path.join(self.directory, 'reads.idx'))[2][1])
+        self.assertFalse(manager.seek_chromosome('chr3'))
+        for args in ([], ['-c', 'chr2,chr1:50000-120000']):
+            self.assertEqual(self.genetrack(*(args + [binary])), self.genetrack(*(args + ['reads.idx'])))
+
+    def test_read_size(self):
+        ''' A binary index of BED reads keeps their size, which places reverse gff peaks '''
+        random = numpy.random.RandomState(7)
+        starts = numpy.sort(random.randint(0, 5000, 600))
+        self.write('reads.bed', ''.join('chr1\t%d\t%d\tread\t0\t%s\n' % (start, start + 50, '+-'[random.randint(0, 2)])
+                                        for start in starts))
+        binary = self.convert('reads.bed')
+        self.assertEqual(self.genetrack(binary), self.genetrack('reads.bed'))
+
+class TrackTest(ScriptTest):
+    def setUp(self):
+        ScriptTest.setUp(self)
+        self.reads = numpy.array([map(int, line.split('\t')[1:]) for line in synthetic_reads(9, ['chr1'], 2500000, 1500)])
+        self.write('reads.idx', ''.join('chr1\t%d\t%d\t%d\n' % tuple(read) for read in self.reads))
+
+    def bases(self):
+        ''' Returns the positions and values of the bases of each strand's track, the forward
+        ones at or above 0.5 and the reverse ones above it, as genetrack.py wrote them one per
+        line when it smoothed the whole chromosome at once '''
+        strands = []
+        for (array, shift), inclusive in zip(genetrack.smooth_reads(self.reads, 20, 5), (True, False)):
+            indexes = numpy.flatnonzero(array >= 0.5 if inclusive else array > 0.5)
+            strands.append((indexes - shift, array[indexes]))
+        return strands
+
+    def test_bedgraph_runs(self):
+        ''' Bedgraph intervals of chunked calls are the longest runs of equal values, and expand
+        to the bases of the track smoothed at once '''
+        self.genetrack('-k', '1', '-b', 'reads.idx')
+        for name, (positions, values) in zip(('forward.bedgraph', 'reverse.bedgraph'), self.bases()):
+            lines = self.read(name).splitlines()
+            self.assertTrue(lines[0].startswith('track type=bedGraph'))
+            runs = [line.split('\t') for line in lines[1:]]
+            starts = numpy.array([int(run[1]) for run in runs])
+            ends = numpy.array([int(run[2]) for run in runs])
+            run_values = numpy.array([float(run[3]) for run in runs])
+            self.assertTrue(((ends[:-1] < starts[1:]) | (run_values[:-1] != run_values[1:])).all())
+            expanded = numpy.concatenate([numpy.arange(start, end) for start, end in zip(starts, ends)])
+            self.assertEqual(expanded.tolist(), positions.tolist())
+            self.assertTrue(numpy.allclose(numpy.repeat(run_values, ends - starts), values, rtol=1e-12, atol=0))
+
+    def test_binary_zoom(self):
+        ''' Binary tracks hold the runs, and the mean and maximum of the bases in each zoom bin,
+        queried by overlap with a range '''
+        self.genetrack('-k', '1', '-B', 'reads.idx')
+        for name, (positions, values) in zip(('forward.gtt', 'reverse.gtt'), self.bases()):
+            track = genetrack.BinaryTrack(os.path.join(self.directory, name))
+            self.assertEqual(track.chromosomes, ['chr1'])
+            self.assertEqual(track.zoom_sizes, (1,) + genetrack.ZOOM_SIZES)
+            runs = track.query('chr1', 0, 2 ** 31 - 1)
+            expanded = numpy.concatenate([numpy.arange(start, end) for start, end in zip(runs['start'], runs['end'])])
+            self.assertEqual(expanded.tolist(), positions.tolist())
+            self.assertTrue(numpy.allclose(numpy.repeat(runs['mean'], runs['end'] - runs['start']), values, rtol=1e-6, atol=0))
+            for level, size in enumerate(genetrack.ZOOM_SIZES):
+                zoom = track.query('chr1', 0, 2 ** 31 - 1, level + 1)
+                bins, edges = numpy.unique(positions // size, return_index=True)
+                self.assertEqual(zoom['start'].tolist(), positions[edges].tolist())
+                self.assertEqual(zoom['end'].tolist(), (positions[numpy.r_[edges[1:], len(positions)] - 1] + 1).tolist())
+                self.assertTrue(numpy.allclose(zoom['mean'], numpy.add.reduceat(values, edges) / numpy.diff(numpy.r_[edges, len(positions)]),
+                                               rtol=1e-5, atol=0))
+                self.assertTrue(numpy.allclose(zoom['max'], numpy.maximum.reduceat(values, edges), rtol=1e-6, atol=0))
+                start, end = positions[len(positions) // 3], positions[len(positions) // 2]
+                selected = zoom[(zoom['end'] > start) & (zoom['start'] < end)]
+                self.assertEqual(track.query('chr1', start, end, level + 1).tolist(), selected.tolist())
+            self.assertEqual(len(track.query('chr2', 0, 100)), 0)
+
+class PrecisionTest(ScriptTest):
+    def test_single_agrees(self):
+        ''' Single precision calls nearly all the peaks double precision does, at nearly the same heights '''
+        random = numpy.random.RandomState(11)
+        indexes = numpy.unique(random.randint(1, 200000, 6000))
+        reads = numpy.column_stack((indexes, random.randint(0, 8, (len(indexes), 2))))
+        for sigma in (5, 20):
+            double = genetrack.call_peaks_array(reads, {'sigma': sigma})
+            single = genetrack.call_peaks_array(reads, {'sigma': sigma, 'precision': 'single'})
+            for expected, peaks in zip(double, single):
+                common, expected_at, at = numpy.intersect1d(expected['index'], peaks['index'], return_indices=True)
+                self.assertTrue(len(common) >= 0.99 * max(len(expected), len(peaks)))
+                self.assertTrue(numpy.allclose(peaks['value'][at], expected['value'][expected_at], rtol=1e-5, atol=0))
+                self.assertEqual(peaks['readcount'][at].tolist(), expected['readcount'][expected_at].tolist())
+
+    def validate(self, *args):
+        ''' Returns the exit status and the rows of genetrack.py --validate '''
+        script = os.path.join(os.path.dirname(genetrack.__file__), 'genetrack.py')
+        process = subprocess.Popen([sys.executable, script, '--validate', '-k', '1'] + list(args) + ['reads.idx'],
+                                   cwd=self.directory, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        output = process.communicate()[0]
+        return process.returncode, [line.split('\t') for line in output.splitlines()]
+
+    def test_validate(self):
+        ''' --validate counts the peaks single precision misses or adds in each chunk, and exits
+        with status 1 only if there are any '''
+        self.write('reads.idx', ''.join(synthetic_reads(12, ['chr1', 'chr2'], 1500000, 3000)))
+        status, rows = self.validate('--precision', 'double')
+        self.assertEqual(status, 0)
+        self.assertEqual(rows[0], ['chrom', 'start', 'end', 'peaks', 'missing', 'extra', 'largest_relative_error'])
+        self.assertEqual(len(rows), 6)
+        self.assertEqual([row[4:] for row in rows[1:]], [['0', '0', '0']] * 5)
+
+        status, rows = self.validate('--precision', 'single')
+        total, missing, extra, error = int(rows[-1][3]), int(rows[-1][4]), int(rows[-1][5]), float(rows[-1][6])
+        self.assertEqual(status, 1 if missing or extra else 0)
+        self.assertEqual([total, missing, extra], [sum(int(row[column]) for row in rows[1:-1]) for column in (3, 4, 5)])
+        self.assertTrue(error < 1e-5)
+        self.assertEqual(total, len(self.genetrack('-o', 'txt', 'reads.idx').splitlines()) - 1)
+        single = len(self.genetrack('-o', 'txt', '--precision', 'single', 'reads.idx').splitlines()) - 1
+        self.assertEqual(single, total - missing + extra)
+
+def bgzf_member(text):
+    ''' Returns text compressed as one BGZF member, as bgzip writes each block '''
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+    deflated = compressor.compress(text) + compressor.flush()
+    header = '\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff' + struct.pack('<H2sHH', 6, 'BC', 2, 18 + len(deflated) + 8 - 1)
+    return header + deflated + struct.pack('<Ii', zlib.crc32(text) & 0xffffffff, len(text))
+
+def bgzf(text, block):
+    ''' Returns text compressed as BGZF members of block bytes, ending with the empty member '''
+    return ''.join(bgzf_member(text[at:at + block]) for at in range(0, len(text), block)) + bgzf_member('')
+
+class BgzfTest(ScriptTest):
+    def setUp(self):
+        ScriptTest.setUp(self)
+        self.text = ''.join(synthetic_reads(13, ['chr1', 'chr2'], 500000, 3000))
+        self.path = os.path.join(self.directory, 'reads.idx.gz')
+        f = open(self.path, 'wb')
+        f.write(bgzf(self.text, 500)) # Blocks end mid line, and make several batches
+        f.close()
+
+    def test_read(self):
+        ''' Blocks decompressed on threads are joined in order, whole or a line at a time '''
+        self.assertEqual(genetrack.get_compression(self.path), 'bgzf')
+        self.assertTrue(len(self.text) > 3 * genetrack.BGZF_BATCH * 500)
+        for threads in (1, 3):
+            self.assertEqual(genetrack.BgzfReader(self.path, threads).read(), self.text)
+            self.assertEqual(list(genetrack.BgzfReader(self.path, threads)), self.text.splitlines(True))
+            reader = genetrack.BgzfReader(self.path, threads)
+            self.assertEqual(reader.read(12345) + reader.read(), self.text)
+
+    def test_peaks(self):
+        ''' A BGZF file is parsed and called like the text it holds '''
+        plain = self.write('reads.idx', self.text)
+        load = lambda path: [(manager.chromosome_name(), manager.load_chromosome().tolist())
+                             for manager in [genetrack.get_manager(path)] for i in range(2)]
+        self.assertEqual(load(self.path), load(plain))
+        self.assertEqual(self.genetrack('reads.idx.gz'), self.genetrack('reads.idx'))
+
+    def test_corrupt(self):
+        ''' A block whose checksum does not match its text is an error '''
+        data = bytearray(open(self.path, 'rb').read())
+        member = bgzf_member(self.text[:500])
+        data[len(member) - 8] ^= 1
+        f = open(self.path, 'wb')
+        f.write(str(data))
+        f.close()
+        self.assertRaises(IOError, genetrack.BgzfReader(self.path).read)
+
+class SchedulerTest(unittest.TestCase):
+    def test_largest_first(self):
+        ''' Queued tasks run largest first, a task added by a callback going ahead of smaller ones
+        queued before it, and a failed task calls back with a TaskError '''
+        scheduler = multiprocess.Scheduler(1)
+        results = []
+        def done(result):
+            results.append(result)
+            if result == 5:
+                scheduler.add(4, abs, (-4,), done)
+        for size in (1, 5, 3, 2):
+            scheduler.add(size, abs, (-size,), done)
+        scheduler.add(0, int, ('x',), done)
+        try:
+            scheduler.run()
+        finally:
+            scheduler.close()
+        self.assertEqual(results[:5], [5, 4, 3, 2, 1])
+        self.assertTrue(isinstance(results[5], multiprocess.TaskError))
+
+    def test_feed(self):
+        ''' Fed items call back in the main process, then None, and tasks they add are run '''
+        scheduler = multiprocess.Scheduler(2)
+        items, results = [], []
+        def read(item):
+            items.append(item)
+            if item is not None:
+                scheduler.add(item, abs, (-item,), results.append)
+        scheduler.feed(iter(range(10)), read)
+        try:
+            scheduler.run()
+        finally:
+            scheduler.close()
+        self.assertEqual(items, range(10) + [None])
+        self.assertEqual(sorted(results), range(10))
+
+class MultiprocessTest(ScriptTest):
+    def run_script(self, *args):
+        script = os.path.join(os.path.dirname(genetrack.__file__), 'multiprocess.py')
+        process = subprocess.Popen([sys.executable, script] + list(args), cwd=self.directory,
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        process.communicate()
+        return process.returncode
+
+    def test_exit_status(self):
+        ''' The exit status tells whether the peaks of every file were called '''
+        self.write('good.idx', 'chr1\t10\t1\t0\nchr1\t20\t2\t1\n')
+        self.write('bad.idx', 'chr1\t10\t1\t0\nchr1\t20\t2x\t1\n')
+        self.assertEqual(self.run_script('good.idx'), 0)
+        self.assertEqual(self.run_script('.'), 1)
+        self.assertEqual(os.listdir(os.path.join(self.directory, 'genetrack')), ['good_s5e20F1.gff'])
+
+    def test_same_as_genetrack(self):
+        ''' Chromosomes called on a pool of workers, largest first, are written as genetrack.py
+        writes them '''
+        self.write('reads.idx', ''.join(synthetic_reads(14, ['chr1', 'chr2', 'chr3', 'chr4'], 300000, 500) +
+                                        synthetic_reads(15, ['chr5'], 2500000, 5000)))
+        self.assertEqual(self.run_script('-p', '3', '-k', '1', 'reads.idx'), 0)
+        expected = self.genetrack('-F', '1', '-k', '1', 'reads.idx')
+        self.assertTrue(expected.count('\n') > 100)
+        self.assertEqual(self.read(os.path.join('genetrack', 'reads_s5e20F1.gff')), expected)
+
+    def test_mapped_reads(self):
+        ''' The reader saves each chromosome for the workers to memory map, or points them to the
+        binary index holding it, and both call the peaks of the loaded chromosome '''
+        self.write('reads.idx', ''.join(synthetic_reads(16, ['chr1', 'chr2'], 1500000, 2000)))
+        self.assertEqual(self.run_script('-k', '1', 'reads.idx'), 0)
+        expected = self.read(os.path.join('genetrack', 'reads_s5e20F1.gff'))
+        self.assertEqual(expected, self.genetrack('-F', '1', '-k', '1', 'reads.idx'))
+        script = os.path.join(os.path.dirname(genetrack.__file__), 'idxtobin.py')
+        subprocess.Popen([sys.executable, script, 'reads.idx'], cwd=self.directory, stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()
+        self.assertEqual(self.run_script('-k', '1', os.path.join('idxtobin', 'reads.bidx')), 0)
+        self.assertEqual(self.read(os.path.join('idxtobin', 'genetrack', 'reads_s5e20F1.gff')), expected)
+
+        paths = [os.path.join(self.directory, 'reads.idx'), os.path.join(self.directory, 'idxtobin', 'reads.bidx')]
+        temp_dir = os.path.join(self.directory, 'temp')
+        os.mkdir(temp_dir)
+        queue = multiprocessing.Queue()
+        multiprocess.read_files(paths, temp_dir, queue)
+        items = [queue.get() for i in range(7)]
+        self.assertEqual([item[:4] for item in items[:6]], [('chromosome', 0, 0, 'chr1'), ('chromosome', 0, 1, 'chr2'), ('file', 0, 2, False),
+                                                           ('chromosome', 1, 0, 'chr1'), ('chromosome', 1, 1, 'chr2'), ('file', 1, 2, False)])
+        self.assertEqual(items[6], None)
+        settings = multiprocess.get_settings(genetrack.Values(dict(genetrack.PEAK_SETTINGS, chunk_size=1, filter=1)))
+        for kind, number, i, cname, reads_path, size, readsize in items[:2] + items[3:5]:
+            if number == 0:
+                self.assertEqual(os.path.dirname(reads_path), temp_dir)
+                self.assertTrue(isinstance(numpy.load(reads_path, mmap_mode='r'), numpy.memmap))
+            else:
+                self.assertEqual(reads_path, paths[1])
+            chunks = multiprocess.call_chromosome(reads_path, cname, settings)
+            self.assertEqual(len(chunks), 2)
+            self.assertEqual([[peaks.tolist() for peaks in chunk] for chunk in chunks],
+                             [[peaks.tolist() for peaks in chunk] for chunk in multiprocess.call_chromosome(items[i][4], cname, settings)])
+
+    def test_file_writer(self):
+        ''' Chromosomes called out of order are written in file order, each once all before it
+        are, and a failed chromosome removes the output '''
+        settings = multiprocess.get_settings(genetrack.Values(dict(genetrack.PEAK_SETTINGS, chunk_size=1, filter=1, format='txt')))
+        random = numpy.random.RandomState(17)
+        chromosomes = []
+        for cname in ('chr1', 'chr2', 'chr3'):
+            indexes = numpy.unique(random.randint(1, 20000, 500))
+            reads = numpy.column_stack((indexes, random.randint(0, 5, (len(indexes), 2))))
+            chromosomes.append((cname, [genetrack.call_peaks_array(reads[:250]), genetrack.call_peaks_array(reads[250:])]))
+        path = os.path.join(self.directory, 'reads.idx')
+        output = genetrack.get_output_path(path, settings)
+        writer = multiprocess.FileWriter(path, settings)
+        writer.add(2, *chromosomes[2])
+        writer.add(1, *chromosomes[1])
+        self.assertFalse(os.path.exists(output))
+        writer.add(0, *chromosomes[0])
+        writer.end(3, False)
+        expected = genetrack.PeakWriter(os.path.join(self.directory, 'expected'), 'txt')
+        for cname, chunks in chromosomes:
+            for peaks in chunks:
+                expected.write(cname, *peaks)
+        expected.close()
+        self.assertTrue(self.read('expected').count('\n') > 10)
+        self.assertEqual(self.read(output), self.read('expected'))
+
+        writer = multiprocess.FileWriter(path, settings)
+        writer.add(0, *chromosomes[0])
+        logging.disable(logging.ERROR)
+        try:
+            writer.add(1, 'chr2', multiprocess.TaskError('ValueError'))
+        finally:
+            logging.disable(logging.NOTSET)
+        writer.add(2, *chromosomes[2])
+        writer.end(3, False)
+        self.assertFalse(os.path.exists(output))
+
+    def test_pipeline(self):
+        ''' Files read ahead only as far as the queue depth are each written as genetrack.py writes them '''
+        names = []
+        for number in range(4):
+            names.append('reads%d.idx' % number)
+            self.write(names[-1], ''.join(synthetic_reads(18 + number, ['chr%d' % i for i in range(1, 2 + number)], 200000 * (4 - number), 400)))
+        for depth in ('1', '5'):
+            self.assertEqual(self.run_script('-p', '3', '--queue-depth', depth, '-o', 'txt', *names), 0)
+            for name in names:
+                self.assertEqual(self.read(os.path.join('genetrack', name[:-4] + '_s5e20F1.txt')),
+                                 self.genetrack('-F', '1', '-o', 'txt', name))
+
+class BenchmarkTest(TempDirTest):
+    def test_report(self):
+        ''' A small benchmark times every stage into its report, and compares it with another '''
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark.py')
+        report = os.path.join(self.directory, 'report.json')
+        command = [sys.executable, script, '-z', '0.02', '-n', '2', '-s', '3', '-r', '1', '-R', report]
+        for extra in ([], ['-C', report]):
+            process = subprocess.Popen(command + extra, cwd=self.directory, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            output = process.communicate()[0]
+            self.assertEqual(process.returncode, 0)
+        self.assertTrue('Compared to' in output)
+        results = json.load(open(report, 'rt'))['results']
+        self.assertEqual(set(result['stage'] for result in results), set(['parse', 'populate', 'call', 'exclude', 'output']))
+        self.assertEqual(sorted(os.listdir(self.directory)), ['report.json'])
+
+def shuffled_reads(seed, count):
+    ''' Returns BED lines of reads on three chromosomes, in random order '''
+    random = numpy.random.RandomState(seed)
+    names = numpy.array(['chr1', 'chr2', 'chr10'])[random.randint(0, 3, count)]
+    starts = random.randint(0, 500, count)
+    strands = numpy.array(['+', '-'])[random.randint(0, 2, count)]
+    return ['%s\t%d\t%d\tread\t0\t%s\n' % (name, start, start + 36, strand) for name, start, strand in zip(names, starts, strands)]
+
+class UnsortedTest(unittest.TestCase):
+    def load(self, manager):
+        chromosomes = {}
+        while not manager.done:
+            cname = manager.chromosome_name()
+            chromosomes[cname] = manager.load_chromosome().tolist()
+        return chromosomes
+
+    def test_spilled_partitions(self):
+        ''' Reads in any order, spilled to temporary files, load as the sorted reads do '''
+        lines = shuffled_reads(2, 3000)
+        ordered = sorted(lines, key=lambda line: (line.split('\t')[0], int(line.split('\t')[1])))
+        expected = self.load(genetrack.BlockChromosomeManager(StringIO.StringIO(''.join(ordered))))
+        for memory in (2 ** 20, 1000):
+            manager = genetrack.UnsortedChromosomeManager(StringIO.StringIO(''.join(lines)), memory)
+            self.assertEqual(bool(manager.spilled), memory < 2 ** 20)
+            self.assertEqual(self.load(manager), expected)
+            manager.close()
+
+class RunSorterTest(TempDirTest):
+    def test_runs(self):
+        ''' Reads sorted in many small runs merge into the counts of each index '''
+        expected = {}
+        sorter = tabs2genetrack.RunSorter(os.path.join(self.directory, 'reads'), 100 * tabs2genetrack.ROW_BYTES / 2.0 ** 20)
+        for line in shuffled_reads(3, 2000):
+            name, start, end, _, _, strand = line.split()
+            forward, index = strand == '+', int(start) if strand == '+' else int(end)
+            sorter.add(name, index, tabs2genetrack.FORWARD if forward else tabs2genetrack.REVERSE)
+            counts = expected.setdefault((name, index), [0, 0])
+            counts[not forward] += 1
+        self.assertEqual(len(sorter.runs), 20)
+        merged = []
+        for name, indexes, forward, reverse, total in sorter.merge():
+            merged.extend(((name, index), [f, r]) for index, f, r in zip(indexes.tolist(), forward.tolist(), reverse.tolist()))
+        sorter.close()
+        self.assertEqual(merged, sorted(expected.items())) # By chromosome name, then index
+
+class MergeSegmentsTest(unittest.TestCase):
+    def setUp(self):
+        self.merge_rows = tabs2genetrack.MERGE_ROWS
+        tabs2genetrack.MERGE_ROWS = 4
+
+    def tearDown(self):
+        tabs2genetrack.MERGE_ROWS = self.merge_rows
+
+    def merge(self, *runs):
+        segments = []
+        for indexes in runs:
+            run = numpy.zeros(len(indexes), tabs2genetrack.RUN_DTYPE)
+            run['index'] = indexes
+            segments.append([run, 0, len(run)])
+        merged = []
+        for indexes, forward, reverse, total in tabs2genetrack.merge_segments(segments):
+            merged.extend(zip(indexes.tolist(), total.tolist()))
+        return merged
+
+    def test_index_across_batch_cut(self):
+        ''' An index running past the rows read ahead is emitted once '''
+        self.assertEqual(self.merge([1, 2, 3, 5, 5, 5, 5, 6, 7, 8]),
+            [(1, 1), (2, 1), (3, 1), (5, 4), (6, 1), (7, 1), (8, 1)])
+
+    def test_index_across_runs(self):
+        ''' An index present in several runs is pooled into one row '''
+        self.assertEqual(self.merge([1, 2, 3, 5, 5, 5, 5, 6, 7, 8], [5, 9, 10]),
+            [(1, 1), (2, 1), (3, 1), (5, 5), (6, 1), (7, 1), (8, 1), (9, 1), (10, 1)])
+
+if __name__ == '__main__':
+    unittest.main()